@@ -24,6 +24,11 @@ def main():
     print response2.headers
     print response2.body
 
+    #or let concurrent tasks share the connection, requests queued at the same time are sent together
+    futures = [cnn.request_async(cnn.get('/')) for _ in range(3)]
+    for future in futures:
+        print future.get().status
+
     cnn.close()
 
 if __name__ == '__main__':
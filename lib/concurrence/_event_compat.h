@@ -0,0 +1,22 @@
+/*
+ * Copyright (C) 2009, Hyves (Startphone Ltd.)
+ *
+ * This module is part of the Concurrence Framework and is released under
+ * the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+ */
+
+/* 
+ * smooths over the differences between libevent 1.4 and 2.x for _event.pyx
+ * edge triggered events (EV_ET) are only available from libevent 2.0 on and only
+ * for backends that support them (epoll, kqueue)
+ */
+
+#include <event.h>
+
+#ifdef EV_ET
+#define CONCURRENCE_EV_ET EV_ET
+#define concurrence_has_et(base) ((event_base_get_features((struct event_base *)(base)) & EV_FEATURE_ET) != 0)
+#else
+#define CONCURRENCE_EV_ET 0
+#define concurrence_has_et(base) 0
+#endif
@@ -30,6 +30,7 @@ import collections
 cdef extern from "Python.h":
     void  Py_INCREF(object o)
     void  Py_DECREF(object o)
+    int   PyList_Append(object list, object item) except -1
     
 ctypedef void (*event_handler)(int fd, short evtype, void *arg)
 
@@ -49,7 +50,8 @@ cdef extern from "event.h":
         int   ev_flags
         void *ev_arg
 
-    void event_init()
+    void *event_init()
+    int event_reinit(void *base)
     char *event_get_version()
     char *event_get_method()
     void event_set(event_t *ev, int fd, short event,
@@ -63,16 +65,45 @@ cdef extern from "event.h":
     int EVLOOP_ONCE
     int EVLOOP_NONBLOCK
 
+cdef extern from "_event_compat.h":
+    int CONCURRENCE_EV_ET
+    int concurrence_has_et(void *base)
+
 EV_TIMEOUT = 0x01
 EV_READ    = 0x02
 EV_WRITE   = 0x04
 EV_SIGNAL  = 0x08
 EV_PERSIST = 0x10
+EV_ET      = CONCURRENCE_EV_ET #0 if not supported by libevent version
+
+cdef void *_base
 
 triggered = collections.deque()
 
+#native dispatch mode: instead of calling back into python to append a (callback, evtype) tuple
+#to the triggered deque, the libevent callback appends the callback and the evtype of the event
+#to two lists, which loop() hands to the dispatcher as a whole. The callbacks are still called
+#by the dispatcher in python, so that they do not run on top of the C stack of event_loop.
+cdef int _native
+cdef object _callbacks
+cdef object _evtypes
+
+_native = 0
+_callbacks = []
+_evtypes = []
+
+cdef class event
+
 cdef void __event_handler(int fd, short evtype, void *arg):
-    (<object>arg).__callback(evtype)
+    cdef event ev
+    if _native:
+        ev = <event>arg
+        PyList_Append(_callbacks, ev.callback)
+        PyList_Append(_evtypes, evtype)
+        if not event_pending(&ev.ev, EV_TIMEOUT|EV_SIGNAL|EV_READ|EV_WRITE, NULL):
+            Py_DECREF(ev) #release the reference that was taken by add()
+    else:
+        (<object>arg).__callback(evtype)
 
 class EventError(Exception):
     def __init__(self, msg):
@@ -150,12 +181,40 @@ def version():
 def method():
     return event_get_method()
 
+def has_edge_triggered():
+    """Returns whether the libevent method in use supports edge triggered (EV_ET) events."""
+    return concurrence_has_et(_base)
+
+def reinit():
+    """Re-initializes the event base in a child process after a fork. This must be called before the child
+    adds any events, otherwise it would share the kernel event queue (e.g. epoll) of its parent."""
+    if event_reinit(_base) == -1:
+        raise EventError("error in event_reinit")
+
+def set_native(int native):
+    """Enables (1) or disables (0) native dispatch of triggered events. 
+    In native mode :func:`loop` returns a list of the callbacks of the triggered events and a list of their evtypes, 
+    which are collected without calling back into python, otherwise :func:`loop` returns a deque of (callback, evtype) 
+    tuples. In both cases the caller must call the callbacks."""
+    global _native
+    _native = native
+
+def get_native():
+    """Returns whether native dispatch of triggered events is enabled."""
+    return _native
+
 def loop():
     """Dispatch all pending events on queue in a single pass."""
+    global _callbacks, _evtypes
     if event_loop(EVLOOP_ONCE) ==  -1:
         raise EventError("error in event_loop")
+    if _native:
+        callbacks, evtypes = _callbacks, _evtypes
+        _callbacks = []
+        _evtypes = []
+        return callbacks, evtypes
     return triggered
 
 # XXX - make sure event queue is always initialized.
-event_init()
+_base = event_init()
 
@@ -9,6 +9,8 @@ import logging
 import weakref
 import collections
 import gc
+import math
+from itertools import izip
 
 try:
     import stackless
@@ -30,9 +32,24 @@ if '-Xleak' in sys.argv:
 from signal import SIGINT
 from concurrence import _event
 
+if '-Xnativedispatch' in sys.argv:
+    #let _event.loop hand us the callbacks and evtypes of triggered events as two lists,
+    #instead of a deque of (callback, evtype) tuples
+    _event.set_native(1)
+
+#use edge triggered, persistent registration of socket readiness (see EdgeTriggeredFileDescriptorEvent)
+EDGE_TRIGGERED = False
+if '-Xedgetriggered' in sys.argv:
+    if _event.has_edge_triggered():
+        EDGE_TRIGGERED = True
+    else:
+        logging.warn('edge triggered events not supported by libevent method: %s', _event.method())
+
 def get_version_info():
     return {'libevent_version': _event.version(),
-            'libevent_method': _event.method()}
+            'libevent_method': _event.method(),
+            'native_dispatch': bool(_event.get_native()),
+            'edge_triggered': EDGE_TRIGGERED}
     
 if '-Xversion' in sys.argv:
     print 'libevent: version: %s, method: %s' % (_event.version(),  _event.method())
@@ -95,6 +112,43 @@ class FileDescriptorEvent(Event):
         self._event = None
         self._current_channel = None
 
+class EdgeTriggeredFileDescriptorEvent(FileDescriptorEvent):
+    """A :class:`FileDescriptorEvent` that is registered only once with libevent, as a persistent edge triggered event 
+    and stays registered until it is closed. This saves a (epoll_ctl) syscall for every wait.
+    Note that :func:`wait` only returns on the next edge, e.g. when the fd *becomes* readable or writable. So the caller must 
+    first try its read or write and only wait when that fails with EAGAIN."""
+    def __init__(self, fd, rw):
+        if rw == 'r':
+            ev = _event.EV_READ
+        elif rw == 'w':
+            ev = _event.EV_WRITE
+        else:
+            assert False, "rw must be one of ['r', 'w']"
+        self._event = _event.event(self._on_event, ev | _event.EV_PERSIST | _event.EV_ET, fd)
+        self._event.add()
+        self._current_channel = None
+        
+    def _on_event(self, ev_type):
+        channel = self._current_channel
+        if channel is None:
+            return #nobody waiting, the edge will be noticed by the next read or write attempt
+        self._current_channel = None #notify only once
+        channel.send(self)
+
+    def notify(self, channel = None, timeout = -1.0):
+        assert timeout == -1.0, "use wait to wait with a timeout on an edge triggered event"
+        if channel is None: channel = Channel()
+        self._current_channel = channel
+        
+    def wait(self, channel = None, timeout = -1.0):
+        if channel is None: channel = Channel()
+        self._current_channel = channel
+        try:
+            return channel.receive(timeout)
+        finally:
+            if self._current_channel is channel:
+                self._current_channel = None
+
 class SignalEvent(Event):
     def __init__(self, signo, callback, persist = True):
         self._persist = persist
@@ -134,6 +188,194 @@ class TimeoutEvent(Event):
         del self._event
         del self._callback
 
+class Timer(object):
+    """A timer that was scheduled on the :class:`TimerWheel`, see :func:`TimerWheel.add`."""
+    __slots__ = ['expires', 'callback', 'args', '_wheel', '_slot', '_level']
+    
+    def __init__(self, wheel, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._slot = None
+        self._level = -1
+
+    def cancel(self):
+        """Cancels the timer, it is safe to cancel a timer that has already expired."""
+        if self._slot is not None:
+            self._wheel._remove(self)
+        self.callback = None
+        self.args = None
+
+class TimerWheel(object):
+    """A hierarchical timing wheel, used for the (mostly cancelled before they fire) timeouts of :func:`Channel.receive`, 
+    :func:`Channel.send` and :func:`Tasklet.sleep`. Adding and cancelling a timer is O(1) and the whole wheel is driven 
+    by a single libevent timer that is set to the next tick at which something can expire. 
+    
+    The wheel has a resolution of *tick* seconds. Its first level has 256 slots of 1 tick, each of the next 4 levels has 64 slots
+    spanning the whole previous level. Timers are moved (cascaded) down a level when the lower level wraps around.  
+    """
+    LEVEL_BITS = [8, 6, 6, 6, 6]
+    
+    def __init__(self, tick = 0.001):
+        self._tick = tick
+        self._start = time.time()
+        self._next_tick = 0 #the next tick to process
+        self._levels = [[set() for _ in range(1 << bits)] for bits in self.LEVEL_BITS]
+        self._counts = [0] * len(self.LEVEL_BITS)
+        self._shifts = [sum(self.LEVEL_BITS[:i]) for i in range(len(self.LEVEL_BITS))]
+        self._max_delta = (1 << sum(self.LEVEL_BITS)) - 1
+        self._expired = [] #zero timeouts, fired in order on the next run regardless of tick
+        self._event = _event.event(self._on_event, 0)
+        self._armed = None #tick for which our libevent timer was set, -1 for immediately
+
+    def _current_tick(self):
+        return int((time.time() - self._start) / self._tick)
+
+    def __len__(self):
+        return sum(self._counts) + len([timer for timer in self._expired if timer.callback is not None])
+        
+    def add(self, timeout, callback, *args):
+        """Calls *callback* (with *args*) from the dispatcher after *timeout* seconds. 
+        Returns a :class:`Timer` that can be cancelled."""
+        if timeout <= 0.0:
+            #cancelling these just clears the callback, so that yielding tasks keep their order
+            timer = Timer(self, 0, callback, args)
+            self._expired.append(timer)
+            if self._armed != -1:
+                self._armed = -1
+                self._event.add(0.0)
+        else:
+            #round up, so that we never expire early
+            expires = int(math.ceil((time.time() + timeout - self._start) / self._tick))
+            timer = Timer(self, expires, callback, args)
+            self._insert(timer)
+            if self._armed is None or (self._armed != -1 and expires < self._armed):
+                self._arm(expires)
+        return timer
+
+    def _insert(self, timer):
+        delta = timer.expires - self._next_tick
+        if delta < 0:
+            timer.expires = self._next_tick
+            delta = 0
+        elif delta > self._max_delta:
+            timer.expires = self._next_tick + self._max_delta
+            delta = self._max_delta
+        level = self._level_for(delta)
+        slots = self._levels[level]
+        slot = slots[(timer.expires >> self._shifts[level]) & (len(slots) - 1)]
+        slot.add(timer)
+        timer._slot = slot
+        timer._level = level
+        self._counts[level] += 1
+
+    def _level_for(self, delta):
+        for level in range(len(self.LEVEL_BITS) - 1):
+            if delta < (1 << (self._shifts[level] + self.LEVEL_BITS[level])):
+                return level
+        return len(self.LEVEL_BITS) - 1
+    
+    def _remove(self, timer):
+        timer._slot.remove(timer)
+        self._counts[timer._level] -= 1
+        timer._slot = None
+        timer._level = -1
+        
+    def _arm(self, tick):
+        self._armed = tick
+        self._event.add(max(0.0, self._start + (tick * self._tick) - time.time()))
+        
+    def _fire(self, slot):
+        while slot:
+            timer = slot.pop()
+            self._counts[timer._level] -= 1
+            timer._slot = None
+            timer._level = -1
+            self._call(timer)
+
+    def _call(self, timer):
+        callback, args = timer.callback, timer.args
+        timer.callback = timer.args = None
+        try:
+            callback(*args)
+        except TaskletExit:
+            raise
+        except:
+            logging.exception("unhandled exception in timer callback")
+        
+    def _cascade(self, level):
+        """moves the timers of the current slot of *level* to the lower levels"""
+        slots = self._levels[level]
+        slot = slots[(self._next_tick >> self._shifts[level]) & (len(slots) - 1)]
+        while slot:
+            timer = slot.pop()
+            self._counts[level] -= 1
+            self._insert(timer)
+        
+    def _advance(self, now_tick):
+        """processes all ticks up to and including *now_tick*"""
+        levels = self._levels
+        mask = len(levels[0]) - 1
+        while self._next_tick <= now_tick:
+            if sum(self._counts) == 0:
+                self._next_tick = now_tick + 1 #nothing scheduled, just jump ahead
+                break
+            index = self._next_tick & mask
+            if index == 0:
+                level = 1
+                while level < len(levels):
+                    self._cascade(level)
+                    if (self._next_tick >> self._shifts[level]) & (len(levels[level]) - 1):
+                        break
+                    level += 1
+            elif self._counts[0] == 0:
+                #nothing in the first level, skip to the next cascade 
+                self._next_tick = min(now_tick + 1, (self._next_tick | mask) + 1)
+                continue
+            slot = levels[0][index]
+            self._next_tick += 1
+            if slot:
+                self._fire(slot)
+
+    def _next_expiry(self):
+        """returns the next tick at which a timer could expire, or None if the wheel is empty"""
+        if self._expired:
+            return -1
+        if sum(self._counts) == 0:
+            return None
+        slots = self._levels[0]
+        mask = len(slots) - 1
+        boundary = (self._next_tick | mask) + 1
+        if self._counts[0]:
+            tick = self._next_tick
+            while tick < boundary:
+                if slots[tick & mask]:
+                    return tick
+                tick += 1
+        return boundary
+
+    def _on_event(self, ev_type):
+        self._armed = None
+        if self._expired:
+            expired, self._expired = self._expired, []
+            for timer in expired:
+                if timer.callback is not None:
+                    self._call(timer)
+        self._advance(self._current_tick())
+        #callbacks may have added timers (and armed us), so always re-arm for the earliest one 
+        tick = self._next_expiry()
+        if tick == -1:
+            self._armed = -1
+            self._event.add(0.0)
+        elif tick is not None:
+            self._arm(tick)
+
+    def close(self):
+        self._event.delete()
+        
+_timer_wheel = TimerWheel()
+        
 class Message():
     def __init__(self, reply_channel = None):
         self._reply_channel = reply_channel
@@ -491,12 +733,17 @@ class Tasklet(stackless.tasklet):
 
     @classmethod 
     def sleep(cls, timeout):
-        """Blocks the current task for the given *timeout* in seconds."""
-        sleep_channel = Channel()
+        """Blocks the current task for the given *timeout* in seconds, or forever if *timeout* is -1."""
+        #wake up trough the timer wheel by a plain send, instead of raising TimeoutError in the sleeper
+        sleep_channel = stackless.channel()
+        if timeout == -1:
+            sleep_channel.receive()
+            return
+        timer = _timer_wheel.add(timeout, sleep_channel.send, None)
         try:
-            sleep_channel.receive(timeout)
-        except TimeoutError:
-            pass #expected to happen after timeout
+            sleep_channel.receive()
+        finally:
+            timer.cancel()
 
     @classmethod       
     def current(cls):
@@ -602,14 +849,11 @@ class Channel(object):
             #most common without timeout
             return self._channel.receive()
         else:
-            current_task = Tasklet.current()
-            def on_timeout():
-                current_task.raise_exception(TimeoutError)
-            event_timeout = TimeoutEvent(timeout, on_timeout)
+            timer = _timer_wheel.add(timeout, Tasklet.current().raise_exception, TimeoutError)
             try:
                 return self._channel.receive()
             finally:
-                event_timeout.close()
+                timer.cancel()
 
     def send(self, value, timeout = -1):
         """Sends to the channel. If there is no receiver, the caller will block until there is one.
@@ -621,15 +865,12 @@ class Channel(object):
             #most common without timeout
             self._channel.send(value)
         else:
-            #setup timeout event
-            current_task = Tasklet.current()
-            def on_timeout():
-                current_task.raise_exception(TimeoutError)
-            event_timeout = TimeoutEvent(timeout, on_timeout)
+            #setup timeout on the timer wheel
+            timer = _timer_wheel.add(timeout, Tasklet.current().raise_exception, TimeoutError)
             try:
                 self._channel.send(value)
             finally:
-                event_timeout.close()
+                timer.cancel()
 
 _running = False #whether we are currently in dispatch, used stop the dispatch (use quit method)
 _exitcode = EXIT_CODE_OK
@@ -707,15 +948,27 @@ def _dispatch(f = None):
             #it returns the list of callbacks that have to be called.
             #calling from pyevent would give us a C stack which is not
             #optimal (stackless would hardswitch instead of softswitch)
-            triggered = _event.loop()
-            while triggered:
-                callback, evtype = triggered.popleft()
-                try:
-                    callback(evtype)
-                except TaskletExit:
-                    raise
-                except:
-                    logging.exception("unhandled exception in dispatch event callback")
+            #in native dispatch mode (-Xnativedispatch) it returns a list of callbacks and a list
+            #of their evtypes instead, that are collected without calling back into python
+            if _event.get_native():
+                callbacks, evtypes = _event.loop()
+                for callback, evtype in izip(callbacks, evtypes):
+                    try:
+                        callback(evtype)
+                    except TaskletExit:
+                        raise
+                    except:
+                        logging.exception("unhandled exception in dispatch event callback")
+            else:
+                triggered = _event.loop()
+                while triggered:
+                    callback, evtype = triggered.popleft()
+                    try:
+                        callback(evtype)
+                    except TaskletExit:
+                        raise
+                    except:
+                        logging.exception("unhandled exception in dispatch event callback")
     finally:
         event_interrupt.close()
         event_heartbeat.close()
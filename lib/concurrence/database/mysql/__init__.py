@@ -17,6 +17,7 @@ AUTH_RESULT_STATES = _mysql.AUTH_RESULT_STATES
 COMMAND = _mysql.COMMAND
 
 PacketReader = _mysql.PacketReader
+escape_string = _mysql.escape_string
 PacketReadError = _mysql.PacketReadError
 ProxyProtocol = _mysql.ProxyProtocol
 
@@ -30,6 +31,12 @@ class COMMAND:
     QUERY = 0x03
     LIST = 0x04
     PING = 0x0e
+    STMT_PREPARE = 0x16
+    STMT_EXECUTE = 0x17
+    STMT_CLOSE = 0x19
+
+class SERVER_STATUS:
+    MORE_RESULTS_EXISTS = 8
     
 class CAPS(object):
     LONG_PASSWORD =   1   # new more secure passwords 
@@ -152,6 +159,13 @@ class BufferedPacketReader(BufferedReader):
         self.stream = stream
         self.buffer = buffer
         self.reader = PacketReader(buffer)
+        self.server_status = 0 #the server status of the last end of rows
+
+    def _read_eof(self):
+        """reads the server status from the EOF packet at the end of the rows"""
+        packet = self.reader.packet
+        packet.skip(3) #0xfe and warning count
+        self.server_status = packet.read_short()
 
     def read_packets(self):
         reader = self.reader
@@ -172,7 +186,9 @@ class BufferedPacketReader(BufferedReader):
     def read_length_coded_binary(self):
         return self.reader.read_length_coded_binary()
     
-    def read_fields(self, field_count):
+    def read_fields(self, field_count, flags = False):
+        """reads the field packets of a resultset, returns a list of (name, type_code) tuples, or 
+        (name, type_code, flags) tuples if *flags* is True"""
         
         #generator for rest of result packets
         packets = self.read_packets()
@@ -183,8 +199,12 @@ class BufferedPacketReader(BufferedReader):
         reader = self.reader
         i = 0
         while i < field_count:            
-            _ = packets.next()
-            fields.append(reader.read_field_type())
+            packet = packets.next()
+            if flags:
+                name, type_code = reader.read_field_type()
+                fields.append((name, type_code, packet.read_short()))
+            else:
+                fields.append(reader.read_field_type())
             i += 1
 
         #end of field types
@@ -193,19 +213,38 @@ class BufferedPacketReader(BufferedReader):
         
         return fields 
 
-    def read_rows(self, fields, row_count = 100):
+    def read_rows(self, fields, row_count = 100, binary = False):
         reader = self.reader
         
         READ_RESULT_EOF = PACKET_READ_RESULT.EOF
         READ_RESULT_MORE = PACKET_READ_RESULT.MORE
 
         while True:
-            read_result, rows = reader.read_rows(fields, row_count)
+            read_result, rows = reader.read_rows(fields, row_count, binary)
             for row in rows:
                 yield row
             if read_result & READ_RESULT_EOF:
+                self._read_eof()
                 break
             if not (read_result & READ_RESULT_MORE):
                 self._read_more()
 
+    def read_columns(self, fields, columns, row_count, binary = False):
+        """reads at most *row_count* rows into *columns*, returns (number of rows read, whether the end of the rows was reached)"""
+        reader = self.reader
+        
+        READ_RESULT_EOF = PACKET_READ_RESULT.EOF
+        READ_RESULT_MORE = PACKET_READ_RESULT.MORE
+
+        n = 0
+        while n < row_count:
+            read_result, m = reader.read_columns(fields, columns, row_count - n, binary)
+            n += m
+            if read_result & READ_RESULT_EOF:
+                self._read_eof()
+                return n, True
+            if not (read_result & READ_RESULT_MORE):
+                self._read_more()
+        return n, False
+
             
@@ -9,10 +9,13 @@ from concurrence import TimeoutError
 from concurrence.io import Buffer 
 from concurrence.io.socket import Socket 
 from concurrence.timer import Timeout
-from concurrence.database.mysql import BufferedPacketReader, BufferedPacketWriter, PACKET_READ_RESULT, CAPS, COMMAND 
+from concurrence.containers.dequedict import DequeDict
+from concurrence.database.mysql import BufferedPacketReader, BufferedPacketWriter, PACKET_READ_RESULT, CAPS, COMMAND, SERVER_STATUS
 
 import logging
 import time
+import struct
+import datetime
 
 try:
     #python 2.6
@@ -36,30 +39,56 @@ class ClientProgrammingError(ClientError): pass
     
 class ResultSet(object):
     """Represents the current resultset being read from a Connection.
-    The resultset implements an iterator over rows. A Resultset must
-    be iterated entirely and closed explicitly."""
+    The resultset implements an iterator over rows, that reads the rows from the connection as they are needed. 
+    Alternatively the rows can be read in batches of columns with :func:`fetch_columns`. A Resultset must
+    be read entirely and closed explicitly."""
     STATE_INIT = 0
     STATE_OPEN = 1
     STATE_EOF = 2
     STATE_CLOSED = 3
     
-    def __init__(self, connection, field_count):
+    def __init__(self, connection, field_count, binary = False):
         self.state = self.STATE_INIT
         
         self.connection = connection
         
-        self.fields = connection.reader.read_fields(field_count)
+        self.binary = binary #whether the rows are in the binary format of a prepared statement
+        if binary:
+            #the binary rows need the field flags as well
+            self._row_fields = connection.reader.read_fields(field_count, True)
+            self.fields = [(name, type_code) for name, type_code, _ in self._row_fields]
+        else:
+            self.fields = connection.reader.read_fields(field_count)
+            self._row_fields = self.fields
+        
+        self._iterating = False
         
         self.state = self.STATE_OPEN
         
     def __iter__(self):
         assert self.state == self.STATE_OPEN, "cannot iterate a resultset when it is not open"
         
-        for row in self.connection.reader.read_rows(self.fields):
+        self._iterating = True
+        for row in self.connection.reader.read_rows(self._row_fields, binary = self.binary):
             yield row
 
         self.state = self.STATE_EOF
         
+    def fetch_columns(self, n, columns = None):
+        """Reads at most *n* rows and returns their values by column, as a list with a list for each field. Alternatively 
+        the values are appended to *columns*, a container for each field (an array.array for instance). Fewer than *n* values 
+        per column are returned at the end of the resultset. This can not be used after iterating the rows."""
+        assert not self._iterating, "cannot read columns from a resultset that is being iterated"
+        if columns is None:
+            columns = [[] for _ in self.fields]
+        if self.state == self.STATE_EOF:
+            return columns
+        assert self.state == self.STATE_OPEN, "cannot read a resultset when it is not open"
+        _, eof = self.connection.reader.read_columns(self._row_fields, columns, n, self.binary)
+        if eof:
+            self.state = self.STATE_EOF
+        return columns
+        
     def close(self, connection_close = False):  
         """Closes the current resultset. Make sure you have iterated over all rows before closing it!"""
         #print 'close on ResultSet', id(self.connection)
@@ -70,6 +99,82 @@ class ResultSet(object):
         del self.fields
         connection._close_current_resultset(self)
         self.state = self.STATE_CLOSED
+
+def _length_coded_string(s):
+    n = len(s)
+    if n < 251:
+        return chr(n) + s
+    elif n < 0x10000:
+        return '\xfc' + struct.pack('<H', n) + s
+    elif n < 0x1000000:
+        return '\xfd' + struct.pack('<I', n)[:3] + s
+    else:
+        return '\xfe' + struct.pack('<Q', n) + s
+
+class PreparedStatement(object):
+    """A server side prepared statement, created by :func:`Connection.prepare`. The statement is executed
+    by passing it to :func:`Connection.execute`."""
+    def __init__(self, sql, statement_id, param_count, fields):
+        self.sql = sql
+        self.statement_id = statement_id
+        self.param_count = param_count
+        self.fields = fields #(name, type_code) of the result columns
+        
+    def pack_execute(self, params, encoding = None):
+        """returns the COM_STMT_EXECUTE payload that executes this statement with *params*"""
+        if len(params) != self.param_count:
+            raise ClientProgrammingError("statement needs %d parameters, %d given" % (self.param_count, len(params)))
+        payload = [struct.pack('<IBI', self.statement_id, 0, 1)] #no cursor, 1 iteration
+        if not params:
+            return payload[0]
+        null_bitmap = [0] * ((len(params) + 7) / 8)
+        types = []
+        values = []
+        for i, param in enumerate(params):
+            t = type(param)
+            if param is None:
+                null_bitmap[i / 8] |= 1 << (i % 8)
+                types.append('\x06\x00')
+            elif t is int or t is long or t is bool:
+                if -0x8000000000000000 <= param < 0x8000000000000000:
+                    types.append('\x08\x00')
+                    values.append(struct.pack('<q', param))
+                else:
+                    types.append('\x08\x80') #unsigned
+                    values.append(struct.pack('<Q', param))
+            elif t is float:
+                types.append('\x05\x00')
+                values.append(struct.pack('<d', param))
+            elif t is str:
+                types.append('\xfd\x00')
+                values.append(_length_coded_string(param))
+            elif t is unicode:
+                types.append('\xfd\x00')
+                if encoding:
+                    values.append(_length_coded_string(param.encode(encoding)))
+                else:
+                    values.append(_length_coded_string(param.encode()))
+            elif isinstance(param, datetime.datetime):
+                types.append('\x0c\x00')
+                values.append(struct.pack('<BHBBBBBI', 11, param.year, param.month, param.day, 
+                                          param.hour, param.minute, param.second, param.microsecond))
+            elif isinstance(param, datetime.date):
+                types.append('\x0a\x00')
+                values.append(struct.pack('<BHBB', 4, param.year, param.month, param.day))
+            elif isinstance(param, datetime.timedelta):
+                negative = param < datetime.timedelta(0)
+                if negative:
+                    param = -param
+                types.append('\x0b\x00')
+                values.append(struct.pack('<BBIBBBI', 12, negative, param.days, param.seconds / 3600, (param.seconds / 60) % 60, 
+                                          param.seconds % 60, param.microseconds))
+            else:
+                raise ClientProgrammingError("unsupported parameter type: %s %s" % (t, repr(param)))
+        payload.append(''.join(map(chr, null_bitmap)))
+        payload.append('\x01') #types follow
+        payload.extend(types)
+        payload.extend(values)
+        return ''.join(payload)
             
 class Connection(object):
     """Represents a single connection to a MySQL Database host."""
@@ -80,7 +185,8 @@ class Connection(object):
     STATE_CLOSING = 3
     STATE_CLOSED = 4
     
-    def __init__(self):
+    def __init__(self, statement_cache_size = 100):
+        """*statement_cache_size* is the maximum number of prepared statements kept open on the server by :func:`prepare`"""
         self.state = self.STATE_INIT
         self.buffer = Buffer(1024 * 16)        
         self.socket = None
@@ -90,6 +196,10 @@ class Connection(object):
         self._command_time = -1
         self._incommand = False
         self.current_resultset = None
+        self._statements = DequeDict() #sql -> PreparedStatement, most recently used first
+        self._statement_cache_size = statement_cache_size
+        self._pending_results = 0 #pipelined commands whose results were not read yet
+        self._more_results = False #whether the server has more results for the last command
 
     def _scramble(self, password, seed):
         """taken from java jdbc driver, scrambles the password using the given seed
@@ -102,7 +212,7 @@ class Connection(object):
         #i love python :-):
         return ''.join(map(chr, [x ^ ord(stage1[i]) for i, x in enumerate(map(ord, md.digest()))])) 
         
-    def _handshake(self, user, password, database):
+    def _handshake(self, user, password, database, multi_statements = False):
         """performs the mysql login handshake"""
         
         #init buffer for reading (both pos and lim = 0)
@@ -146,6 +256,9 @@ class Connection(object):
         #always turn off compression
         client_caps &= ~CAPS.COMPRESS
         
+        if multi_statements:
+            client_caps |= CAPS.MULTI_STATEMENTS | CAPS.MULTI_RESULTS
+        
         if not server_caps & CAPS.CONNECT_WITH_DB and database:
             assert False, "initial db given but not supported by server"
         if server_caps & CAPS.CONNECT_WITH_DB and not database:
@@ -184,22 +297,45 @@ class Connection(object):
     def _close_current_resultset(self, resultset):
         assert resultset == self.current_resultset
         self.current_resultset = None
+        self._more_results = bool(self.reader.server_status & SERVER_STATUS.MORE_RESULTS_EXISTS)
         
-    def _send_command(self, cmd, cmd_text):
-        """sends a command with the given text"""
-        #self.log.debug('cmd %s %s', cmd, cmd_text)
-        
+    def _write_command(self, cmd, cmd_text):
         #note: we are not using normal writer.start/finish here, because the cmd
         #could not fit in buffer, causing flushes in write_string, in that case 'finish' would
         #not be able to go back to the header of the packet to write the length in that case
-        self.writer.clear()
-        self.writer.write_header(len(cmd_text) + 1 + 4, 0) #1 is len of cmd, 4 is len of header, 0 is packet number
-        self.writer.write_byte(cmd)
+        self.writer.write_bytes(struct.pack('<IB', len(cmd_text) + 1, cmd)) #header with packet number 0, and cmd
         self.writer.write_bytes(cmd_text)
+
+    def _send_command(self, cmd, cmd_text):
+        """sends a command with the given text"""
+        #self.log.debug('cmd %s %s', cmd, cmd_text)
+        self.writer.clear()
+        self._write_command(cmd, cmd_text)
         self.writer.flush()
+        
+    def _read_result(self, binary = False):
+        """reads the result of a command, the OK, ERROR or result set header"""
+        packet = self.reader.read_packet()
+        result = packet.read_byte()
+        #print 'res', result
+        if result == 0x00:
+            #OK, return (affected rows, last row id)
+            rowcount = self.reader.read_length_coded_binary()
+            lastrowid = self.reader.read_length_coded_binary()
+            self._more_results = bool(packet.read_short() & SERVER_STATUS.MORE_RESULTS_EXISTS)
+            return (rowcount, lastrowid)
+        elif result == 0xff:
+            self._more_results = False
+            raise ClientCommandError.from_error_packet(packet)
+        else: #result set
+            self.current_resultset = ResultSet(self, result, binary) 
+            return self.current_resultset
 
     def _close(self):
         #self.log.debug("close mysql client %s", id(self))
+        self._statements = DequeDict() #closed by the server with the connection
+        self._pending_results = 0 #the results that were not read yet are lost with the connection
+        self._more_results = False
         try:
             self.state = self.STATE_CLOSING
             if self.current_resultset: 
@@ -210,8 +346,10 @@ class Connection(object):
             self.state = self.STATE_ERROR
             raise
         
-    def connect(self, host = "localhost", port = 3306, user = "", passwd = "", db = "", autocommit = None, charset = None):
-        """connects to the given host and port with user and passwd"""
+    def connect(self, host = "localhost", port = 3306, user = "", passwd = "", db = "", autocommit = None, charset = None, 
+                multi_statements = False):
+        """connects to the given host and port with user and passwd. If *multi_statements* is True, a query may contain
+        multiple statements separated by ';', whose results are read with :func:`next_result`"""
         #self.log.debug("connect mysql client %s %s %s %s %s", id(self), host, port, user, passwd)
         try:
             #print 'connect', host, user, passwd, db
@@ -232,7 +370,7 @@ class Connection(object):
             self.socket = Socket.connect(addr, timeout = Timeout.current())
             self.reader = BufferedPacketReader(self.socket, self.buffer)
             self.writer = BufferedPacketWriter(self.socket, self.buffer)
-            self._handshake(user, passwd, db)
+            self._handshake(user, passwd, db, multi_statements)
             #handshake complete client can now send commands
             self.state = self.STATE_CONNECTED
             
@@ -263,13 +401,15 @@ class Connection(object):
         if self._incommand != False: assert False, "cannot close while still in a command"
         self._close()
         
-    def command(self, cmd, cmd_text):
-        """sends a COM_XXX command with the given text and possibly return a resultset (select)"""
+    def command(self, cmd, cmd_text, binary = False):
+        """sends a COM_XXX command with the given text and possibly return a resultset (select), if *binary* is True
+        the rows of the resultset are in the binary format of a prepared statement"""
         #print 'command', cmd, repr(cmd_text), type(cmd_text)        
         assert type(cmd_text) == str #as opposed to unicode
         assert self.is_connected(), "make sure connection is connected before query"
         if self._incommand != False: assert False, "overlapped commands not supported"
         if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        if self.has_more_results(): assert False, "overlapped commands not supported, pls read the remaining results first"
         try:
             self._incommand = True
             if self._time_command:
@@ -277,24 +417,140 @@ class Connection(object):
             self._send_command(cmd, cmd_text)
             #read result, expect 1 of OK, ERROR or result set header
             self.buffer.flip()
+            try:
+                return self._read_result(binary)
+            finally:
+                if self._time_command:
+                    end_time = time.time()
+                    self._command_time = end_time - start_time			
+        finally:
+            self._incommand = False 
+        
+    def pipeline(self, queries):
+        """Sends all *queries* at once, without waiting for the result of each query before sending the next one. Their 
+        results are read in order with :func:`next_result`, a query that fails raises its error without affecting 
+        the results of the other queries. For instance::
+        
+            cnn.pipeline(["select 1", "update foo set bar = 1"])
+            rs = cnn.next_result()
+            rows = list(rs)
+            rs.close()
+            affected_rows, _ = cnn.next_result()
+        """
+        assert self.is_connected(), "make sure connection is connected before query"
+        if self._incommand != False: assert False, "overlapped commands not supported"
+        if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        if self.has_more_results(): assert False, "overlapped commands not supported, pls read the remaining results first"
+        if not queries:
+            return
+        try:
+            self._incommand = True
+            self.writer.clear()
+            for query in queries:
+                assert type(query) == str #as opposed to unicode
+                self._write_command(COMMAND.QUERY, query)
+            self.writer.flush()
+            self.buffer.flip()
+            self._pending_results = len(queries)
+        finally:
+            self._incommand = False 
+
+    def has_more_results(self):
+        """Whether there are results that can be read with :func:`next_result`"""
+        return self._more_results or self._pending_results > 0
+            
+    def has_more_query_results(self):
+        """Whether the next result read with :func:`next_result` belongs to the same query as the previous one (a query with
+        multiple statements, or a CALL), as opposed to being the first result of the next pipelined query"""
+        return self._more_results
+
+    def next_result(self):
+        """Reads the next result of a query with multiple statements, or of the pipelined queries, see :func:`pipeline`. 
+        Returns None if there are no more results."""
+        if self.current_resultset: assert False, "pls read prev resultset and close it first"
+        if self._more_results:
+            pass #another result of the same query
+        elif self._pending_results > 0:
+            self._pending_results -= 1
+        else:
+            return None
+        try:
+            self._incommand = True
+            return self._read_result()
+        except ClientCommandError:
+            raise #the query failed, the results of the other queries can still be read
+        except:
+            #the connection failed, the remaining results can not be read anymore
+            self._pending_results = 0
+            self._more_results = False
+            raise
+        finally:
+            self._incommand = False 
+        
+    def _prepare(self, sql):
+        assert self.is_connected(), "make sure connection is connected before prepare"
+        if self._incommand != False: assert False, "overlapped commands not supported"
+        if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        if self.has_more_results(): assert False, "overlapped commands not supported, pls read the remaining results first"
+        try:
+            self._incommand = True
+            self._send_command(COMMAND.STMT_PREPARE, sql)
+            self.buffer.flip()
             packet = self.reader.read_packet()
             result = packet.read_byte()
-            #print 'res', result
-            if self._time_command:
-                end_time = time.time()
-                self._command_time = end_time - start_time			
-            if result == 0x00:
-                #OK, return (affected rows, last row id)
-                rowcount = self.reader.read_length_coded_binary()
-                lastrowid = self.reader.read_length_coded_binary()
-                return (rowcount, lastrowid)
-            elif result == 0xff:
+            if result == 0xff:
                 raise ClientCommandError.from_error_packet(packet)
-            else: #result set
-                self.current_resultset = ResultSet(self, result) 
-                return self.current_resultset
+            statement_id = packet.read_int()
+            field_count = packet.read_short()
+            param_count = packet.read_short()
+            if param_count:
+                self.reader.read_fields(param_count)
+            if field_count:
+                fields = self.reader.read_fields(field_count)
+            else:
+                fields = []
+            return PreparedStatement(sql, statement_id, param_count, fields)
         finally:
             self._incommand = False 
+
+    def prepare(self, sql):
+        """Returns a :class:`PreparedStatement` for *sql*, parameters in *sql* are given by ?. The statement is prepared on 
+        the server once and cached, when more than *statement_cache_size* statements are cached, the least recently used 
+        statement is closed."""
+        assert type(sql) == str #as opposed to unicode
+        if sql in self._statements:
+            self._statements.movehead(sql)
+            return self._statements[sql]
+        statement = self._prepare(sql)
+        self._statements.appendleft(sql, statement)
+        if len(self._statements) > self._statement_cache_size:
+            _, evicted = self._statements.pop()
+            self.close_statement(evicted)
+        return statement
+    
+    def close_statement(self, statement):
+        """Closes the prepared *statement* on the server, the server does not answer this command"""
+        assert self.is_connected(), "make sure connection is connected before closing a statement"
+        if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        if self.has_more_results(): assert False, "overlapped commands not supported, pls read the remaining results first"
+        if statement.sql in self._statements and self._statements[statement.sql] is statement:
+            del self._statements[statement.sql]
+        self._send_command(COMMAND.STMT_CLOSE, struct.pack('<I', statement.statement_id))
+
+    def execute(self, statement, params = ()):
+        """Executes a prepared *statement* with the given *params*, or the statement prepared for the sql string 
+        *statement*. A statement that was closed in the meantime (when it was evicted from the cache of :func:`prepare`) 
+        is prepared again. Returns (affected rows, last row id) or a resultset whose rows are decoded from the binary 
+        row format, so that numbers and dates need no parsing.
+        
+        Note that the values are typed differently than those of :func:`query` (and of the dbapi), which returns 
+        DATE, DATETIME, TIMESTAMP and TIME columns as the strings sent by the server. Here they are returned as 
+        datetime.date, datetime.datetime and datetime.timedelta."""
+        if type(statement) != str and not (statement.sql in self._statements and self._statements[statement.sql] is statement):
+            statement = statement.sql
+        if type(statement) == str:
+            statement = self.prepare(statement)
+        return self.command(COMMAND.STMT_EXECUTE, statement.pack_execute(params, self.reader.reader.encoding), True)
         
     def is_connected(self):
         return self.state == self.STATE_CONNECTED
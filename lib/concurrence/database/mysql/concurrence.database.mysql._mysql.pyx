@@ -7,14 +7,20 @@
 base aynchronous mysql io library
 """
 
+import datetime
+
 from concurrence.io._io cimport Buffer
 from concurrence.io._io import BufferUnderflowError
 
 cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *, int)
     object PyString_FromString(char *)
+    char *PyString_AsString(object obj) except NULL
     int PyString_AsStringAndSize(object obj, char **s, Py_ssize_t *len) except -1
 
+cdef extern from "string.h":
+    void *memcpy(void *dest, void *src, int n)
+
 cdef enum:
     COMMAND_SLEEP = 0
     COMMAND_QUIT  = 1
@@ -53,10 +59,86 @@ FLOAT_TYPES = set([4,5])
 BLOB_TYPES = set([0xf9, 0xfa, 0xfb, 0xfc])
 STRING_TYPES = set([0x0f, 0xfd, 0xfe])
 DATE_TYPES = set([7,10,11,12,13,14])
+
+#column types and flags needed to decode the binary rows of prepared statements
+cdef enum:
+    FIELD_TYPE_TINY = 1
+    FIELD_TYPE_SHORT = 2
+    FIELD_TYPE_LONG = 3
+    FIELD_TYPE_FLOAT = 4
+    FIELD_TYPE_DOUBLE = 5
+    FIELD_TYPE_TIMESTAMP = 7
+    FIELD_TYPE_LONGLONG = 8
+    FIELD_TYPE_INT24 = 9
+    FIELD_TYPE_DATE = 10
+    FIELD_TYPE_TIME = 11
+    FIELD_TYPE_DATETIME = 12
+    FIELD_TYPE_YEAR = 13
+    
+cdef enum:
+    UNSIGNED_FLAG = 32
+
+cdef unsigned long long _read_uint(unsigned char *p, int n):
+    """reads a little endian unsigned integer of *n* bytes"""
+    cdef unsigned long long v
+    v = 0
+    n = n - 1
+    while n >= 0:
+        v = (v << 8) | p[n]
+        n = n - 1
+    return v
             
 class PacketReadError(Exception):
     pass
 
+def escape_string(s):
+    """Returns the string *s* with the characters that are special in a mysql string literal escaped with a backslash,
+    as done by mysql_real_escape_string"""
+    cdef char *src
+    cdef char *dst
+    cdef Py_ssize_t n, i, j
+    cdef char c
+    PyString_AsStringAndSize(s, &src, &n)
+    i = 0
+    while i < n:
+        c = src[i]
+        if c == 0 or c == 10 or c == 13 or c == 92 or c == 39 or c == 34 or c == 26:
+            break
+        i = i + 1
+    if i == n:
+        return s #nothing to escape
+    result = PyString_FromStringAndSize(NULL, n * 2)
+    dst = PyString_AsString(result)
+    memcpy(dst, src, i)
+    j = i
+    while i < n:
+        c = src[i]
+        if c == 0:
+            dst[j] = 92
+            dst[j + 1] = 48 #0
+            j = j + 2
+        elif c == 10:
+            dst[j] = 92
+            dst[j + 1] = 110 #n
+            j = j + 2
+        elif c == 13:
+            dst[j] = 92
+            dst[j + 1] = 114 #r
+            j = j + 2
+        elif c == 26:
+            dst[j] = 92
+            dst[j + 1] = 90 #Z
+            j = j + 2
+        elif c == 92 or c == 39 or c == 34: #backslash, single and double quote
+            dst[j] = 92
+            dst[j + 1] = c
+            j = j + 2
+        else:
+            dst[j] = c
+            j = j + 1
+        i = i + 1
+    return PyString_FromStringAndSize(dst, j)
+
 MAX_PACKET_SIZE = 4 * 1024 * 1024 #4mb
             
 cdef class PacketReader:
@@ -237,8 +319,14 @@ cdef class PacketReader:
                 if packet._position + 2 > packet._limit: raise  BufferUnderflowError()
                 n = packet._buff[packet._position + 1] | ((packet._buff[packet._position + 2]) << 8)  
                 w = 3
+            elif n == 253:
+                if packet._position + 3 > packet._limit: raise  BufferUnderflowError()
+                n = <unsigned int>_read_uint(packet._buff + packet._position + 1, 3)
+                w = 4
             else:
-                assert False, 'not implemented yet, n: %02x' % n
+                if packet._position + 8 > packet._limit: raise  BufferUnderflowError()
+                n = <unsigned int>_read_uint(packet._buff + packet._position + 1, 8)
+                w = 9
         
         if (n + w) > (packet._limit - packet._position):
             raise BufferUnderflowError()
@@ -317,7 +405,124 @@ cdef class PacketReader:
                     i = i + 1
         return r
     
-    def read_rows(self, object fields, int row_count):
+    cdef object _read_binary_value(self, int t, int unsigned):
+        cdef Buffer packet
+        cdef unsigned char *p
+        cdef int n
+        cdef unsigned long long v
+        cdef unsigned int v32
+        cdef float f
+        cdef double d
+        
+        packet = self.packet
+        p = packet._buff + packet._position
+        n = packet._limit - packet._position
+        if t == FIELD_TYPE_TINY:
+            if n < 1: raise BufferUnderflowError()
+            packet._position = packet._position + 1
+            if unsigned:
+                return p[0]
+            return <signed char>p[0]
+        elif t == FIELD_TYPE_SHORT or t == FIELD_TYPE_YEAR:
+            if n < 2: raise BufferUnderflowError()
+            packet._position = packet._position + 2
+            v = _read_uint(p, 2)
+            if unsigned:
+                return <unsigned int>v
+            return <short>v
+        elif t == FIELD_TYPE_LONG or t == FIELD_TYPE_INT24:
+            if n < 4: raise BufferUnderflowError()
+            packet._position = packet._position + 4
+            v = _read_uint(p, 4)
+            if unsigned:
+                return v
+            return <int>v
+        elif t == FIELD_TYPE_LONGLONG:
+            if n < 8: raise BufferUnderflowError()
+            packet._position = packet._position + 8
+            v = _read_uint(p, 8)
+            if unsigned:
+                return v
+            return <long long>v
+        elif t == FIELD_TYPE_FLOAT:
+            if n < 4: raise BufferUnderflowError()
+            packet._position = packet._position + 4
+            v32 = <unsigned int>_read_uint(p, 4)
+            memcpy(&f, &v32, 4)
+            return f
+        elif t == FIELD_TYPE_DOUBLE:
+            if n < 8: raise BufferUnderflowError()
+            packet._position = packet._position + 8
+            v = _read_uint(p, 8)
+            memcpy(&d, &v, 8)
+            return d
+        elif t == FIELD_TYPE_DATE or t == FIELD_TYPE_DATETIME or t == FIELD_TYPE_TIMESTAMP:
+            if n < 1 or n < 1 + p[0]: raise BufferUnderflowError()
+            packet._position = packet._position + 1 + p[0]
+            if p[0] < 4 or (p[1] == 0 and p[2] == 0) or p[3] == 0 or p[4] == 0:
+                return None #zero date, can not be represented
+            if t == FIELD_TYPE_DATE:
+                return datetime.date(<int>_read_uint(p + 1, 2), p[3], p[4])
+            elif p[0] < 7:
+                return datetime.datetime(<int>_read_uint(p + 1, 2), p[3], p[4])
+            elif p[0] < 11:
+                return datetime.datetime(<int>_read_uint(p + 1, 2), p[3], p[4], p[5], p[6], p[7])
+            else:
+                return datetime.datetime(<int>_read_uint(p + 1, 2), p[3], p[4], p[5], p[6], p[7], <int>_read_uint(p + 8, 4))
+        elif t == FIELD_TYPE_TIME:
+            if n < 1 or n < 1 + p[0]: raise BufferUnderflowError()
+            packet._position = packet._position + 1 + p[0]
+            if p[0] < 8:
+                return datetime.timedelta(0)
+            if p[0] < 12:
+                value = datetime.timedelta(<int>_read_uint(p + 2, 4), p[6] * 3600 + p[7] * 60 + p[8])
+            else:
+                value = datetime.timedelta(<int>_read_uint(p + 2, 4), p[6] * 3600 + p[7] * 60 + p[8], <int>_read_uint(p + 9, 4))
+            if p[1]:
+                return -value
+            return value
+        else:
+            #decimals, strings and blobs are sent as length coded strings
+            return self._read_bytes_length_coded()
+
+    cdef int _read_binary_row(self, object row, object fields, int field_count) except PACKET_READ_ERROR:
+        """reads a row of a prepared statement result, *fields* are tuples (name, type_code, flags)"""
+        cdef int i, r, t, null_bitmap
+        cdef int decode
+        cdef Buffer packet
+        
+        if self.encoding: 
+            decode = 1
+            encoding = self.encoding
+        else:
+            decode = 0
+         
+        r = self._read_packet()
+        if r & PACKET_READ_END: #whole packet recv                    
+            packet = self.packet
+            if packet._buff[packet._position] == 0xFE: 
+                return r | PACKET_READ_EOF
+            else:
+                #the row starts with a 0 byte, and a bitmap of the null columns that is offset by 2 bits
+                null_bitmap = packet._position + 1
+                packet._position = null_bitmap + (field_count + 9) / 8
+                if packet._position > packet._limit: raise BufferUnderflowError()
+                i = 0
+                string_types = STRING_TYPES
+                while i < field_count:
+                    if packet._buff[null_bitmap + (i + 2) / 8] & (1 << ((i + 2) % 8)):
+                        row[i] = None
+                    else:
+                        field = fields[i]
+                        t = field[1] #type_code
+                        row[i] = self._read_binary_value(t, field[2] & UNSIGNED_FLAG)
+                        if decode and t in string_types:
+                            row[i] = row[i].decode(encoding)
+                    i = i + 1
+        return r
+    
+    def read_rows(self, object fields, int row_count, int binary = 0):
+        """reads at most *row_count* rows, in the binary row format of prepared statements if *binary* is true"""
         cdef int r, i, field_count
         field_count = len(fields)
         i = 0
@@ -326,7 +531,10 @@ cdef class PacketReader:
         row = [None] * field_count
         add = rows.append
         while i < row_count:
-            r = self._read_row(row, fields, field_count)
+            if binary:
+                r = self._read_binary_row(row, fields, field_count)
+            else:
+                r = self._read_row(row, fields, field_count)
             if r & PACKET_READ_END:
                 if r & PACKET_READ_EOF:
                     break
@@ -336,6 +544,35 @@ cdef class PacketReader:
                 break
             i = i + 1
         return r, rows
+
+    def read_columns(self, object fields, object columns, int row_count, int binary = 0):
+        """as :func:`read_rows`, but appends the values of each row to *columns*, a container for each field (for instance 
+        a list or an array), instead of building a tuple for each row. Returns (r, number of rows read)"""
+        cdef int r, i, j, n, field_count
+        field_count = len(fields)
+        i = 0
+        n = 0
+        r = 0
+        row = [None] * field_count
+        appends = [column.append for column in columns]
+        while i < row_count:
+            if binary:
+                r = self._read_binary_row(row, fields, field_count)
+            else:
+                r = self._read_row(row, fields, field_count)
+            if r & PACKET_READ_END:
+                if r & PACKET_READ_EOF:
+                    break
+                else:
+                    j = 0
+                    while j < field_count:
+                        appends[j](row[j])
+                        j = j + 1
+                    n = n + 1
+            if not (r & PACKET_READ_MORE):
+                break
+            i = i + 1
+        return r, n
     
 cdef enum:
     PROXY_STATE_UNDEFINED = -2
@@ -10,11 +10,15 @@
 
 
 import sys
+import re
 import logging
+import itertools
 import exceptions
 
-from datetime import datetime
-from concurrence.database.mysql import client
+import datetime
+import decimal
+
+from concurrence.database.mysql import client, escape_string
 from concurrence import TimeoutError as ConcurrenceTimeoutError
 
 threadsafety = 1
@@ -37,26 +41,146 @@ class NotSupportedError(DatabaseError): pass
 #concurrence specific
 class TimeoutError(DatabaseError): pass
 
+#escapes of unicode strings, these are escaped before encoding, so that multibyte charsets can not hide a quote
+_UNICODE_ESCAPES = {0: u'\\0', ord('\n'): u'\\n', ord('\r'): u'\\r', ord('\\'): u'\\\\', ord("'"): u"\\'", ord('"'): u'\\"', 
+                    0x1a: u'\\Z'}
+
+def _literal_sequence(arg, charset):
+    if not arg:
+        raise ProgrammingError("an empty sequence has no sql literal")
+    return '(' + ','.join([literal(item, charset) for item in arg]) + ')'
+
+def _literal_timedelta(arg, charset):
+    sign = ''
+    if arg < datetime.timedelta(0):
+        sign, arg = '-', -arg
+    if arg.microseconds:
+        return "'%s%02d:%02d:%02d.%06d'" % (sign, arg.days * 24 + arg.seconds / 3600, (arg.seconds / 60) % 60, arg.seconds % 60,
+                                           arg.microseconds)
+    return "'%s%02d:%02d:%02d'" % (sign, arg.days * 24 + arg.seconds / 3600, (arg.seconds / 60) % 60, arg.seconds % 60)
+
+def _literal_float(arg, charset):
+    if arg - arg != 0.0:
+        #nan or inf, which have no sql literal
+        raise ProgrammingError("a float that is not finite has no sql literal: %r" % arg)
+    return repr(arg)
+
+#functions that return the sql literal of an argument, by its type
+_LITERALS = {
+    str: lambda arg, charset: "'%s'" % escape_string(arg),
+    unicode: lambda arg, charset: "'%s'" % arg.translate(_UNICODE_ESCAPES).encode(charset),
+    int: lambda arg, charset: str(arg),
+    long: lambda arg, charset: str(arg),
+    bool: lambda arg, charset: arg and '1' or '0',
+    float: _literal_float,
+    decimal.Decimal: lambda arg, charset: str(arg),
+    type(None): lambda arg, charset: 'null',
+    #isoformat, as strftime does not support years before 1900, and it keeps the microseconds
+    datetime.datetime: lambda arg, charset: "'%s'" % arg.isoformat(' '),
+    datetime.date: lambda arg, charset: "'%s'" % arg.isoformat(),
+    datetime.time: lambda arg, charset: "'%s'" % arg.isoformat(),
+    datetime.timedelta: _literal_timedelta,
+    buffer: lambda arg, charset: "'%s'" % escape_string(str(arg)),
+    bytearray: lambda arg, charset: "'%s'" % escape_string(str(arg)),
+    tuple: _literal_sequence,
+    list: _literal_sequence,
+    set: _literal_sequence,
+    frozenset: _literal_sequence,
+}
+
+def literal(arg, charset = default_charset):
+    """Returns *arg* as an sql literal, sequences become a list for use with IN, e.g. (1,2,3)."""
+    f = _LITERALS.get(type(arg), None)
+    if f is None:
+        #a subclass of one of the known types
+        for t in type(arg).__mro__:
+            if t in _LITERALS:
+                f = _LITERALS[t]
+                break
+        else:
+            raise ProgrammingError("unknown argument type: %s %s" % (type(arg), repr(arg)))
+    return f(arg, charset)
+
+#number of queries executemany sends at once, bounded so that the results do not fill up the socket buffers while sending
+PIPELINE_SIZE = 100
+
+#query string -> the parts of the query between the %s placeholders
+_queries = {}
+MAX_CACHED_QUERIES = 1024
+
+def format_query(qry, args, charset = default_charset):
+    """Returns *qry* with each %s replaced by the sql literal of the corresponding argument in *args*."""
+    parts = _queries.get(qry, None)
+    if parts is None:
+        parts = qry.split('%s')
+        if len(_queries) >= MAX_CACHED_QUERIES:
+            _queries.clear()
+        _queries[qry] = parts
+    if len(parts) - 1 != len(args):
+        raise ProgrammingError("query has %d arguments, %d given" % (len(parts) - 1, len(args)))
+    if not args:
+        return qry
+    result = [parts[0]]
+    for arg, part in zip(args, parts[1:]):
+        result.append(literal(arg, charset))
+        result.append(part)
+    return ''.join(result)
+
+#an insert or replace statement with a single row of values, optionally followed by an 'on duplicate key update' clause
+_INSERT_VALUES = re.compile(r'^(\s*(?:INSERT|REPLACE)\b.*?\bVALUES\s*)(\(.*?\))(\s*(?:ON\s+DUPLICATE\s+KEY\s+UPDATE\b.*)?)$', 
+                            re.IGNORECASE | re.DOTALL)
+
+def _match_insert(qry):
+    """returns (prefix, values, suffix) if the rows of *qry* can be inserted with a single multi-row statement"""
+    match = _INSERT_VALUES.match(qry)
+    if match is None:
+        return None
+    prefix, values, suffix = match.groups()
+    if '%s' in prefix or '%s' in suffix:
+        return None #arguments outside of the values are different for each row
+    return prefix, values, suffix
+
+def _batch_insert(prefix, values, suffix, seq_of_args, charset, max_length):
+    """yields multi-row insert statements for *seq_of_args*, each at most *max_length* long unless a single row is longer"""
+    rows = []
+    length = len(prefix) + len(suffix)
+    for args in seq_of_args:
+        row = format_query(values, args, charset)
+        if rows and length + len(row) + 1 > max_length:
+            yield prefix + ','.join(rows) + suffix
+            rows = []
+            length = len(prefix) + len(suffix)
+        rows.append(row)
+        length += len(row) + 1
+    if rows:
+        yield prefix + ','.join(rows) + suffix
+
 class Cursor(object):
+    """A cursor does not buffer the result of a query, the rows are read from the connection as they are fetched, so that
+    large results can be read in constant memory. Rows that were not fetched are read and discarded when the next query is 
+    executed or the cursor is closed."""
     log = logging.getLogger('Cursor')
 
     def __init__(self, connection):
         self.connection = connection
         self.result = None
         self.closed = False
+        self.arraysize = 1
+        self._pending_results = False #whether the other results of a multi statement query of this cursor are pending
         self._close_result()
         
-    def _close_result(self):
+    def _close_result(self, more_results = False):
         #make sure any previous resultset is closed correctly
         
         if self.result is not None:
             #make sure any left over resultset is read from the db, otherwise
             #the connection would be in an inconsistent state
-            try:
-                while True:
-                    self.result_iter.next()
-            except StopIteration:
-                pass #done
+            if self.result.state == client.ResultSet.STATE_OPEN:
+                try:
+                    while True:
+                        self.result_iter.next()
+                except StopIteration:
+                    pass #done
             self.result.close()
 
         self.description = None
@@ -64,29 +188,17 @@ class Cursor(object):
         self.result_iter = None
         self.lastrowid = None
         self.rowcount = -1
+
+        if not more_results and self._pending_results and not self.connection.closed:
+            #discard the results of the other statements of a multi statement query, like MySQLdb the error
+            #of a failed statement is raised
+            self._pending_results = False
+            rowcount, errors = self._read_results()
+            if errors:
+                raise Error("an error occurred in a statement of the previous query: %s" % (errors[0][1], ))
         
     def _escape_string(self, s):
-        """take from mysql src code:"""
-        #TODO how fast is this?, do this in C/pyrex?
-        escaped = []
-        for ch in s:
-            if ch == '\0':
-                escaped.append('\\0')
-            elif ch == '\n':
-                escaped.append('\\n')
-            elif ch == '\r':
-                escaped.append('\\r')
-            elif ch == '\\':
-                escaped.append('\\\\')
-            elif ch == "'": #single quote
-                escaped.append("\\'")
-            elif ch == '"': #double quote
-                escaped.append('\\"')
-            elif ch == '\x1a': #EOF on windows
-                escaped.append('\\Z')
-            else:
-                escaped.append(ch)
-        return ''.join(escaped)
+        return escape_string(s)
             
     def _wrap_exception(self, e, msg):
         self.log.exception(msg)
@@ -105,44 +217,122 @@ class Cursor(object):
             #we will only communicate in 8-bits with mysql
             qry = qry.encode(self.connection.charset)
             
+        #substitute arguments
+        if args:
+            qry = format_query(qry, args, self.connection.charset)
+            
         try:
             self._close_result() #close any previous result if needed
-            #substitute arguments
-            for arg in args:
-                if type(arg) == str:
-                    qry = qry.replace('%s', "'%s'" % self._escape_string(arg), 1)
-                elif type(arg) == unicode:
-                    qry = qry.replace('%s', "'%s'" % self._escape_string(arg).encode(self.connection.charset), 1)
-                elif type(arg) == int:
-                    qry = qry.replace('%s', str(arg), 1)
-                elif type(arg) == long:
-                    qry = qry.replace('%s', str(arg), 1)
-                elif arg is None:
-                    qry = qry.replace('%s', 'null', 1)
-                elif isinstance(arg, datetime):
-                    qry = qry.replace('%s', "'%s'" % arg.strftime('%Y-%m-%d %H:%M:%S'), 1)
-                else:
-                    assert False, "unknown argument type: %s %s" % (type(arg), repr(arg))
-            
-            result = self.connection.client.query(qry)
-            
-            #process result if nescecary
-            if isinstance(result, client.ResultSet):
-                self.description = tuple(((name, type_code, None, None, None, None, None) for name, type_code in result.fields))
-                self.result = result
-                self.result_iter = iter(result)
-                self.lastrowid = None
-                self.rowcount = -1
-            else:
-                self.rowcount, self.lastrowid = result
-                self.description = None
-                self.result = None
+            self._set_result(self.connection.client.query(qry))
+        except (TaskletExit, Error):
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while executing qry %s" % (qry, ))
+        
+    def _set_result(self, result):
+        #process result if nescecary
+        if isinstance(result, client.ResultSet):
+            self.description = tuple(((name, type_code, None, None, None, None, None) for name, type_code in result.fields))
+            self.result = result
+            self.result_iter = iter(result)
+            self.lastrowid = None
+            self.rowcount = -1
+        else:
+            self.rowcount, self.lastrowid = result
+            self.description = None
+            self.result = None
+        self._pending_results = self.connection.client.has_more_results()
 
+    def nextset(self):
+        """Skips to the next result of a query with multiple statements (see the *multi_statements* argument of connect), 
+        returns None if there are no more results"""
+        try:
+            self._close_result(True)
+            if not self._pending_results:
+                return None
+            try:
+                result = self.connection.client.next_result()
+            finally:
+                self._pending_results = self.connection.client.has_more_results()
+            self._set_result(result)
+            return True
         except TaskletExit:
             raise
         except Exception, e:
-            raise self._wrap_exception(e, "an error occurred while executing qry %s" % (qry, ))
+            raise self._wrap_exception(e, "an error occurred while reading the next result")
         
+    def executemany(self, qry, seq_of_args):
+        """Executes *qry* for each of the arguments in *seq_of_args*, :attr:`rowcount` becomes the number of rows affected by 
+        the statements that succeeded.
+        
+        An insert or replace with a single row of values is rewritten into as few multi-row statements as fit in the 
+        max_allowed_packet of the server. These are executed one after the other, the first one that fails raises its error
+        and the statements after it are not executed.
+        
+        Other queries are pipelined, :data:`PIPELINE_SIZE` at a time, and are all executed, also when some of them fail. 
+        If any failed, :exc:`Error` is raised when all are done, with the indexes in *seq_of_args* of the arguments whose
+        statement failed in its *failed_rows* attribute."""
+        if self.closed:
+            raise ProgrammingError('this cursor is already closed')
+
+        if type(qry) == unicode:
+            qry = qry.encode(self.connection.charset)
+
+        try:
+            self._close_result()
+            self.rowcount = 0
+            insert = _match_insert(qry)
+            if insert is None:
+                queries = [format_query(qry, args, self.connection.charset) for args in seq_of_args]
+                failed = []
+                for i in range(0, len(queries), PIPELINE_SIZE):
+                    rowcount, errors = self._pipeline(queries[i:i + PIPELINE_SIZE])
+                    self.rowcount += rowcount
+                    failed.extend([(i + index, e) for index, e in errors])
+                if failed:
+                    error = Error("%d of %d statements failed, the first for the arguments at index %d: %s" % 
+                                  (len(failed), len(queries), failed[0][0], failed[0][1]))
+                    error.failed_rows = [index for index, e in failed]
+                    raise error
+            else:
+                prefix, values, suffix = insert
+                max_length = self.connection.max_allowed_packet
+                for statement in _batch_insert(prefix, values, suffix, seq_of_args, self.connection.charset, max_length):
+                    self.rowcount += self.connection.client.query(statement)[0]
+        except (TaskletExit, Error):
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while executing many qry %s" % (qry, ))
+    
+    def _read_results(self):
+        """reads and discards the remaining results on the connection, returns (the total number of affected rows, 
+        a list of (index of the query, error) of the queries that failed)"""
+        cnn = self.connection.client
+        rowcount = 0
+        errors = []
+        index = -1
+        while cnn.has_more_results():
+            #a query can have several results (multiple statements, or a CALL), the index only moves on with the next query
+            if index < 0 or not cnn.has_more_query_results():
+                index += 1
+            #all results are read, also when a query failed, to keep the connection usable
+            try:
+                result = cnn.next_result()
+                if isinstance(result, client.ResultSet):
+                    for _ in result: pass
+                    result.close()
+                else:
+                    rowcount += result[0]
+            except client.ClientCommandError, e:
+                errors.append((index, e))
+        return rowcount, errors
+        
+    def _pipeline(self, queries):
+        """executes *queries* in a single round trip, returns (the total number of affected rows, a list of 
+        (index in *queries*, error) of the queries that failed)"""
+        self.connection.client.pipeline(queries)
+        return self._read_results()
+
     def fetchall(self):
         try:
             return list(self.result_iter)
@@ -151,6 +341,28 @@ class Cursor(object):
         except Exception, e:
             raise self._wrap_exception(e, "an error occurred while fetching results")
             
+    def fetchmany(self, size = None):
+        """Fetches at most *size* rows, by default :attr:`arraysize` rows"""
+        try:
+            return list(itertools.islice(self.result_iter, size or self.arraysize))
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while fetching results")
+
+    def fetchcolumns(self, size, columns = None):
+        """Fetches at most *size* rows by column, see :func:`~concurrence.database.mysql.client.ResultSet.fetch_columns`.
+        This can not be combined with the other fetch methods on the same result."""
+        try:
+            return self.result.fetch_columns(size, columns)
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while fetching results")
+
+    def __iter__(self):
+        return self.result_iter
+        
     def fetchone(self):
         try:
             return self.result_iter.next()
@@ -167,12 +379,16 @@ class Cursor(object):
         
         try:
             self._close_result()
-            self.closed = True
-        except TaskletExit:
+        except (TaskletExit, Error):
             raise
         except Exception, e:
             raise self._wrap_exception(e, "an error occurred while closing cursor")
+        finally:
+            self.closed = True
         
+#the cursor does not buffer results, for compatibility with code written for MySQLdb
+SSCursor = Cursor
+
 class Connection(object):
     
     def __init__(self, *args, **kwargs):
@@ -201,6 +417,18 @@ class Connection(object):
         self.client.connect(*args, **self.kwargs)
         
         self.closed = False
+        self._max_allowed_packet = None
+
+    @property
+    def max_allowed_packet(self):
+        """the longest statement that can be sent to the server"""
+        if self._max_allowed_packet is None:
+            rs = self.client.query("select @@max_allowed_packet")
+            max_allowed_packet = int(list(rs)[0][0])
+            rs.close()
+            #the client does not split commands into multiple packets, room is left for the header and command byte
+            self._max_allowed_packet = min(max_allowed_packet, 0xffffff) - 16
+        return self._max_allowed_packet
     
     def close(self):
         #print 'dbapi Connection close'
@@ -218,10 +446,10 @@ class Connection(object):
             self.log.exception(msg)
             raise Error(msg + str(e))
             
-    def cursor(self):
+    def cursor(self, cursorclass = None):
         if self.closed: 
             raise ProgrammingError("this connection is already closed")
-        return Cursor(self)
+        return (cursorclass or Cursor)(self)
     
     def get_server_info(self):
         return self.client.server_version
@@ -38,6 +38,7 @@ class HTTPResponse(object):
         self.headers = []
         self.status = ''
         self.iter = None
+        self._body = None
 
     @property
     def status_code(self):
@@ -65,10 +66,19 @@ class HTTPResponse(object):
     @property
     def body(self):
         """Returns the body of the response as a string."""
-        return ''.join(list(self.iter))
+        if self._body is None:
+            self._body = ''.join(list(self.iter))
+            self.iter = [self._body]
+        return self._body
+
+    def close(self):
+        """Skips the part of the body that was not read yet."""
+        close = getattr(self.iter, 'close', None)
+        if close is not None:
+            close()
 
     def __iter__(self):
         return iter(self.iter)
 
 from concurrence.http.server import WSGIServer
-from concurrence.http.client import HTTPConnection
+from concurrence.http.client import HTTPConnection, HTTPConnectionPool
@@ -6,12 +6,17 @@
 #TODO timeout
 #TODO asyn dns resolve
 
+from __future__ import with_statement
+
 import time
 import logging
+import collections
 
-from concurrence import Tasklet, Channel, Message, __version__
+from concurrence import Tasklet, Channel, Message, TimeoutError, __version__
 from concurrence.timer import Timeout
 from concurrence.io import Connector, BufferedStream
+from concurrence.containers import Deque
+from concurrence.statistic import Statistic, StatisticExtra
 from concurrence.http import HTTPError, HTTPRequest, HTTPResponse
 
 AGENT = 'Concurrence-Http-Client/' + __version__
@@ -49,35 +54,58 @@ class HTTPConnection(object):
             except: 
                 pass                
         self._stream = BufferedStream(Connector.connect(endpoint))
+        self._methods = collections.deque() #methods of the requests sent, for which no response was received yet
+        self._body = None #the body of the last response received, while it is not completely read
+        self._body_done = Channel()
+        self._keep_alive = True
+        self._send_queue = [] #requests queued by :func:`request_async`, not sent yet
+        self._flush_scheduled = False
+        self._pending = collections.deque() #futures waiting for a response, in order of sending
+        self._receiving = False #whether some task is receiving responses for the pending futures
 
     def receive(self):
-        """Receive the next :class:`HTTPResponse` from the connection."""
+        """Receive the next :class:`HTTPResponse` from the connection.
+        
+        The body of the response is not read by this method, but while iterating over the response. Before the next 
+        response on this connection is received, the rest of the body of the previous response is read into memory,
+        unless some other task is still reading it, in which case this method waits for that task to finish."""
         try:
             return self._receive()
-        except TaskletExit:
+        except (TaskletExit, TimeoutError):
             raise
         except EOFError:
             raise HTTPError("EOF while reading response")
+        except HTTPError:
+            raise
         except Exception:
             self.log.exception('')
             raise HTTPError("Exception while reading response")
         
     def _receive(self):
+        
+        body = self._body
+        while body is not None:
+            if body.reading:
+                #some other task is reading the previous body, wait for it to finish
+                self._body_done.receive(Timeout.current())
+            else:
+                body.buffer()
+            body = self._body
+        
+        if not self._keep_alive:
+            raise HTTPError("connection was closed by the server")
 
-        response = HTTPResponse()
-
+        if self._methods:
+            method = self._methods.popleft()
+        else:
+            method = None
+            
         reader = self._stream.reader
         
-        lines = reader.read_lines()
-                
-        #parse status line
-        response.status = lines.next()
-        
-        #rest of response headers
-        for line in lines:
-            if not line: break
-            key, value = line.split(': ')
-            response.add_header(key, value)
+        while True:
+            response = self._read_header(reader)
+            if response.status_code != 100: break
+            #skip 100 Continue
 
         #read data
         transfer_encoding = response.get_header('Transfer-Encoding', None)
@@ -87,33 +115,93 @@ class HTTPConnection(object):
         except:
             content_length = None
 
-        #TODO better support large data        
-        chunks = []
-
-        if transfer_encoding == 'chunked':
-            while True:
-                chunk_line = reader.read_line()
-                chunk_size = int(chunk_line.split(';')[0], 16)
-                if chunk_size > 0:
-                    data = reader.read_bytes(chunk_size)
-                    reader.read_line() #chunk is always followed by a single empty line
-                    chunks.append(data)
-                else:
-                    reader.read_line() #chunk is always followed by a single empty line
-                    break 
+        connection = response.get_header('Connection', '').lower()
+        if response.status.startswith('HTTP/1.0'):
+            self._keep_alive = connection == 'keep-alive'
+        else:
+            self._keep_alive = connection != 'close'
+
+        if method == 'HEAD' or response.status_code in (204, 304) or 100 <= response.status_code < 200:
+            chunks = None
+        elif transfer_encoding == 'chunked':
+            chunks = self._read_chunked(reader)
         elif content_length is not None:
-            while content_length > 0:
-                n = min(CHUNK_SIZE, content_length)
-                data = reader.read_bytes(n)
-                chunks.append(data)
-                content_length -= len(data)
+            chunks = self._read_length(reader, content_length)
         else:
-            assert False, 'TODO'
+            #the body ends when the server closes the connection
+            self._keep_alive = False
+            chunks = self._read_until_close(reader)
 
-        response.iter = chunks
+        body = _ResponseBody(self, chunks)
+        if not body.done:
+            self._body = body 
+        response.iter = body
 
         return response
 
+    def _read_header(self, reader):
+        response = HTTPResponse()
+
+        lines = reader.read_lines()
+                
+        #parse status line
+        response.status = lines.next()
+        
+        #rest of response headers
+        for line in lines:
+            if not line: break
+            key, value = line.split(': ')
+            response.add_header(key, value)
+
+        return response
+    
+    def _read_some(self, reader, n):
+        """reads at most *n* bytes, those that are already buffered or otherwise whatever the next read returns"""
+        buffer = reader.buffer
+        if not buffer.remaining:
+            reader._read_more()
+        return buffer.read_bytes(min(n, buffer.remaining))
+        
+    def _read_chunked(self, reader):
+        while True:
+            chunk_line = reader.read_line()
+            chunk_size = int(chunk_line.split(';')[0], 16)
+            if chunk_size == 0:
+                break
+            while chunk_size > 0:
+                data = self._read_some(reader, chunk_size)
+                chunk_size -= len(data)
+                yield data
+            reader.read_line() #chunk is always followed by a single empty line
+        #skip trailers, the body ends with an empty line
+        while reader.read_line():
+            pass
+    
+    def _read_length(self, reader, content_length):
+        while content_length > 0:
+            data = self._read_some(reader, min(CHUNK_SIZE, content_length))
+            content_length -= len(data)
+            yield data
+                
+    def _read_until_close(self, reader):
+        buffer = reader.buffer
+        while True:
+            if buffer.remaining:
+                yield buffer.read_bytes(buffer.remaining)
+            try:
+                reader._read_more()
+            except EOFError:
+                return
+
+    def _read_done(self, body, complete):
+        """called when the *body* of a response was read, or could not be read if not *complete*"""
+        if not complete:
+            self._keep_alive = False
+        if body is self._body:
+            self._body = None
+        if self._body_done.has_receiver():
+            self._body_done.send(True)
+
     def get(self, path, host = None):
         """Returns a new :class:`HTTPRequest` with request.method = 'GET' and request.path = *path*.
         request.host will be set to the host used in :func:`connect`, or optionally you can specify a
@@ -125,6 +213,15 @@ class HTTPConnection(object):
         request.host = host or self._host
         return request
 
+    def head(self, path, host = None):
+        """Returns a new :class:`HTTPRequest` with request.method = 'HEAD' and request.path = *path*.
+        request.host will be set to the host used in :func:`connect`, or optionally you can specify a
+        specific *host* just for this request.
+        """
+        request = self.get(path, host)
+        request.method = 'HEAD'
+        return request
+
     def post(self, path, body = None, host = None):
         """Returns a new :class:`HTTPRequest` with request.method = 'POST' and request.path = *path*.
         request.host will be set to the host used in :func:`connect`, or optionally you can specify a
@@ -146,6 +243,13 @@ class HTTPConnection(object):
 
     def send(self, request):
         """Sends the *request* on this connection."""
+        writer = self._stream.writer        
+        writer.clear()
+        self._write_request(writer, request)
+        self._methods.append(request.method)
+        writer.flush()        
+
+    def _write_request(self, writer, request):
         if request.method is None:
             assert False, "request method must be set"
         if request.path is None:
@@ -153,8 +257,6 @@ class HTTPConnection(object):
         if request.host is None:
             assert False, "request host must be set"
 
-        writer = self._stream.writer        
-        writer.clear()
         writer.write_bytes("%s %s HTTP/1.1\r\n" % (request.method, request.path))
         writer.write_bytes("Host: %s\r\n" % request.host)
         for header_name, header_value in request.headers:
@@ -162,8 +264,376 @@ class HTTPConnection(object):
         writer.write_bytes("\r\n")
         if request.body is not None:
            writer.write_bytes(request.body)
-        writer.flush()        
+
+    def request_async(self, request):
+        """Queues the *request* for sending on this connection and returns a :class:`HTTPResponseFuture` for its response.
+        
+        Requests that are queued by any task before the connection gets to send them are written together with a single flush, 
+        so that many tasks can share a single (pipelined) connection::
+        
+            futures = [cnn.request_async(cnn.get('/%d' % i)) for i in range(10)]
+            responses = [future.get() for future in futures]
+        
+        Don't mix this with :func:`send` and :func:`receive` on the same connection."""
+        future = HTTPResponseFuture(self, request)
+        self._send_queue.append(request)
+        #the method is needed to read the response, which may be received before the request is flushed
+        self._methods.append(request.method)
+        self._pending.append(future)
+        if not self._flush_scheduled:
+            #flush later, so that requests of other tasks that are runnable now are sent along
+            self._flush_scheduled = True
+            Tasklet.new(self._flush_requests)()
+        return future
+
+    def _flush_requests(self):
+        self._flush_scheduled = False
+        requests, self._send_queue = self._send_queue, []
+        try:
+            writer = self._stream.writer        
+            writer.clear()
+            for request in requests:
+                self._write_request(writer, request)
+            writer.flush()
+        except TaskletExit:
+            raise
+        except Exception, e:
+            self.log.exception("while sending requests")
+            self._fail_pending(HTTPError("Exception while sending request: %s" % e))
+
+    def _fail_pending(self, exception):
+        """the connection is no longer usable, fails all futures that did not get a response yet"""
+        self._keep_alive = False
+        pending, self._pending = self._pending, collections.deque()
+        for future in pending:
+            future._set(None, exception)
+
+    def _wait(self, future):
+        """waits for the response of *future*, responses are received in order by one of the waiting tasks"""
+        while future._response is None and future._exception is None:
+            if self._receiving:
+                #another task is receiving, it will let us know when our response arrived or when it is our turn to receive
+                future._waiter = Channel()
+                try:
+                    future._waiter.receive(Timeout.current())
+                finally:
+                    future._waiter = None
+                continue
+            head = self._pending.popleft()
+            self._receiving = True
+            try:
+                try:
+                    head._set(self.receive(), None)
+                except TimeoutError:
+                    #we gave up in the middle of a response, it cannot be read anymore
+                    self._fail_pending(HTTPError("Timeout while receiving response"))
+                    head._set(None, HTTPError("Timeout while receiving response"))
+                    raise
+                except HTTPError, e:
+                    head._set(None, e)
+            finally:
+                self._receiving = False
+                #wake up the task of the response just received and the one that can receive next
+                head._wake()
+                if self._pending:
+                    self._pending[0]._wake()
+        if future._exception is not None:
+            raise future._exception
+        return future._response
 
     def close(self):
         """Close this connection."""
         self._stream.close()
+
+    def is_closed(self):
+        """Whether this connection was closed."""
+        return not hasattr(self._stream, 'stream')
+
+
+class HTTPResponseFuture(object):
+    """The response to a request queued using :func:`HTTPConnection.request_async`."""
+    def __init__(self, connection, request):
+        self._connection = connection
+        self.request = request
+        self._response = None
+        self._exception = None
+        self._waiter = None
+
+    def _set(self, response, exception):
+        self._response = response
+        self._exception = exception
+        
+    def _wake(self):
+        if self._waiter is not None and self._waiter.has_receiver():
+            self._waiter.send(True)
+        
+    def done(self):
+        """Returns True when the response is available (or when the request failed)."""
+        return self._response is not None or self._exception is not None
+    
+    def get(self, timeout = -1):
+        """Waits at most *timeout* seconds for the :class:`HTTPResponse` and returns it. Raises :class:`HTTPError` 
+        if the request failed."""
+        with Timeout.push(timeout):
+            return self._connection._wait(self)
+            
+
+class _ResponseBody(object):
+    """iterates over the body of a :class:`HTTPResponse` while it is read from the connection"""
+    def __init__(self, connection, chunks):
+        self._connection = connection
+        self._chunks = chunks #generator reading the body from the connection
+        self._buffered = collections.deque() #chunks read into memory by :func:`buffer`
+        self.reading = False
+        self.on_done = None #called with True when the body was read completely, or with False when that failed
+        if chunks is None:
+            self._done(True)
+
+    @property
+    def done(self):
+        return self._chunks is None
+
+    def _done(self, complete):
+        self._chunks = None
+        self._connection._read_done(self, complete)
+        if self.on_done is not None:
+            self.on_done(complete)
+        
+    def _next(self):
+        self.reading = True
+        try:
+            try:
+                return self._chunks.next()
+            finally:
+                self.reading = False
+        except StopIteration:
+            self._done(True)
+            raise
+        except EOFError:
+            self._done(False)
+            raise HTTPError("EOF while reading response body")
+        except:
+            self._done(False)
+            raise
+        
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        if self._buffered:
+            return self._buffered.popleft()
+        if self._chunks is None:
+            raise StopIteration()
+        return self._next()
+
+    def buffer(self):
+        """reads the rest of the body into memory"""
+        while self._chunks is not None:
+            try:
+                self._buffered.append(self._next())
+            except StopIteration:
+                pass
+    
+    def close(self):
+        """skips the rest of the body"""
+        self._buffered.clear()
+        while self._chunks is not None:
+            try:
+                self._next()
+            except StopIteration:
+                pass
+
+
+class _HostPool(object):
+    """the connections of a :class:`HTTPConnectionPool` to a single endpoint"""
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.connections = set() #all connections to this endpoint
+        self.connecting = 0 #connections currently being made
+        self.idle = Deque() #idle keep-alive connections, most recently used last
+
+    @property
+    def connection_count(self):
+        return len(self.connections) + self.connecting
+
+
+class HTTPConnectionPool(object):
+    """A pool of keep-alive :class:`HTTPConnection` objects, per endpoint (host, port).
+    
+    At most *max_connections* connections are made to each endpoint. A task that needs a connection while the maximum is reached
+    waits for one to be returned, for at most the current timeout (see :class:`~concurrence.timer.Timeout`). Connections that were
+    idle for more than *idle_timeout* seconds are closed. A request with an idempotent method (GET, HEAD, PUT, DELETE, OPTIONS) that
+    fails on a reused connection (it could have been closed by the server while idle) is retried once on a new connection. Other
+    requests are not retried, because the server could have processed them already.
+    
+    Usage::
+    
+        pool = HTTPConnectionPool()
+        response = pool.perform(('www.google.com', 80), HTTPRequest('/index.html', 'GET'))
+        print response.body
+    """
+    log = logging.getLogger('HTTPConnectionPool')
+    
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    
+    def __init__(self, max_connections = 10, connect_timeout = -1, idle_timeout = 60.0, idle_reaper_interval = 10.0):
+        self._max_connections = max_connections
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
+        self._hosts = {} #endpoint -> _HostPool
+        
+        #some statistics
+        self._new_connection_timer_statistic = StatisticExtra()
+        self._close_connection_timer_statistic = StatisticExtra()
+        self._failed_connect = Statistic(0)
+        self._queue_wait_timer_statistic = StatisticExtra()
+        self._queue_wait_tasks_statistic = StatisticExtra()
+        self._retry_statistic = Statistic(0)
+        
+        self._idle_reaper_task = None
+        if idle_timeout is not None:
+            self._idle_reaper_task = Tasklet.interval(idle_reaper_interval, self._idle_reaper, daemon = True)()
+
+    def __statistics__(self):
+        return {'connections': {'total': self.connection_count,
+                                'idle': self.idle_connection_count,
+                                'connection_failed': self._failed_connect,
+                                'connection_new': self._new_connection_timer_statistic,
+                                'connection_close': self._close_connection_timer_statistic,
+                                'queue_wait_time': self._queue_wait_timer_statistic,
+                                'queue_wait_task': self._queue_wait_tasks_statistic,
+                                'retry': self._retry_statistic},
+                'hosts': dict([('%s:%s' % host.endpoint, host.connection_count) for host in self._hosts.values()])}
+    
+    @property
+    def connection_count(self):
+        return sum([host.connection_count for host in self._hosts.values()])
+
+    @property
+    def idle_connection_count(self):
+        return sum([len(host.idle) for host in self._hosts.values()])
+    
+    def _host(self, endpoint):
+        host = self._hosts.get(endpoint, None)
+        if host is None:
+            host = _HostPool(endpoint)
+            self._hosts[endpoint] = host
+        return host
+    
+    def _new(self, host):
+        """creates a new connection to the endpoint of *host*"""
+        with self._new_connection_timer_statistic.time():        
+            host.connecting += 1
+            try:
+                connection = HTTPConnection()
+                connection.connect(host.endpoint)
+            except Exception:
+                self._failed_connect += 1
+                raise
+            finally:
+                host.connecting -= 1
+            connection._pool_host = host
+            connection._created_time = time.time()
+            host.connections.add(connection)
+        return connection
+
+    def _close(self, connection):
+        """closes given connection and removes it from the pool"""
+        host = connection._pool_host
+        if connection in host.idle:
+            host.idle.remove(connection)
+        host.connections.discard(connection)
+        self._close_connection_timer_statistic += 1
+        self._close_connection_timer_statistic.update_avg(time.time() - connection._created_time)
+        try:
+            if not connection.is_closed():
+                connection.close()
+        except Exception:
+            self.log.exception("error while closing connection")
+        
+    def _idle_reaper(self):
+        """closes connections that were idle for too long"""
+        expired = time.time() - self._idle_timeout
+        for host in self._hosts.values():
+            #idle connections are kept in order of last use, so the oldest ones are in front
+            while host.idle and host.idle[0]._idle_since < expired:
+                self._close(host.idle[0])
+            
+    def connect(self, endpoint):
+        """Gets a connection to *endpoint* from the pool, a new connection is made if none is idle and the maximum was not reached.
+        Otherwise waits for a connection to become available. Returns a tuple (new, connection), where *new* indicates whether
+        the connection was just made."""
+        host = self._host(endpoint)
+        with Timeout.push(self._connect_timeout):
+            if (not host.idle) and host.connection_count < self._max_connections:
+                return (True, self._new(host))
+            with self._queue_wait_timer_statistic.time():
+                #keep track off the amount of other tasks waiting for a connection
+                balance = host.idle.channel.balance
+                waiters = -balance if balance < 0 else 0
+                self._queue_wait_tasks_statistic.set_count(waiters)
+                self._queue_wait_tasks_statistic.update_avg(waiters)
+                return (False, host.idle.pop(True, Timeout.current()))
+
+    def disconnect(self, connection, close = False):
+        """Returns the *connection* to the pool, or closes it if *close* is True."""
+        if close or connection.is_closed():
+            host = connection._pool_host
+            self._close(connection)
+            if host.idle.channel.has_receiver() and host.connection_count < self._max_connections:
+                #a task is waiting for a connection, make a new one on its behalf
+                Tasklet.new(self._replace)(host)
+        else:
+            connection._idle_since = time.time()
+            connection._pool_host.idle.append(connection)
+
+    def _replace(self, host):
+        try:
+            host.idle.append(self._new(host))
+        except Exception:
+            self.log.exception("could not connect to %s", host.endpoint)
+                
+    def perform(self, endpoint, request, stream = False):
+        """Performs the *request* on a connection to *endpoint* from the pool and returns the :class:`HTTPResponse`.
+        The body of the response is read before returning, unless *stream* is True. In that case the connection is
+        returned to the pool when the body was read (or skipped using :func:`HTTPResponse.close`)."""
+        if request.host is None:
+            request.host = endpoint[0]
+        retry = request.method in self.IDEMPOTENT_METHODS
+        while True:
+            new, connection = self.connect(endpoint)
+            try:
+                response = connection.perform(request)
+            except TaskletExit:
+                self.disconnect(connection, True)
+                raise
+            except (HTTPError, EOFError, IOError):
+                self.disconnect(connection, True)
+                if new or not retry:
+                    raise
+                #probably closed by the server while idle, try once more
+                self._retry_statistic += 1
+                retry = False
+                continue
+            except:
+                self.disconnect(connection, True)
+                raise
+            def release(complete):
+                self.disconnect(connection, not (complete and connection._keep_alive))
+            body = response.iter
+            if body.done:
+                release(True)
+            else:
+                body.on_done = release
+                if not stream:
+                    response.body
+            return response
+
+    def close(self):
+        """Closes all connections of this pool."""
+        if self._idle_reaper_task is not None:
+            self._idle_reaper_task.kill()
+        for host in self._hosts.values():
+            for connection in list(host.connections):
+                self._close(connection)
+
@@ -7,17 +7,22 @@
 
 from __future__ import with_statement
 
+import os
+import stat
+import time
 import logging
-import urlparse
 import httplib
 import traceback
 import rfc822
 
+from errno import ENOSYS
+
 from concurrence import Tasklet, Message, Channel, TimeoutError, __version__
-from concurrence.io import Server, BufferedStream
-from concurrence.containers import ReorderQueue
+from concurrence.io import Server, BufferedStream, BufferUnderflowError
+from concurrence.containers import ReorderQueue, Deque
 from concurrence.timer import Timeout
 from concurrence.http import HTTPError
+from concurrence.statistic import StatisticExtra
 
 SERVER_ID = "Concurrence-Http/%s" % __version__
 
@@ -25,48 +30,181 @@ CHUNK_SIZE = 1024 * 4
 
 HTTP_READ_TIMEOUT = 300 #default read timeout, if no request was read within this time, the connection is closed by server
 
+_status_lines = {} #(version, status) -> preformatted status line
+
+def _status_line(version, status):
+    try:
+        return _status_lines[(version, status)]
+    except KeyError:
+        line = intern("%s %s\r\n" % (version, status))
+        if len(_status_lines) < 1024: #applications could make up their own status texts
+            _status_lines[(version, status)] = line
+        return line
+
+_date_server_second = None 
+_date_server_block = None #preformatted Date and Server headers, renewed every second
+
+def _date_server_headers():
+    global _date_server_second, _date_server_block
+    second = int(time.time())
+    if second != _date_server_second:
+        _date_server_block = "Date: %s\r\nServer: %s\r\n" % (rfc822.formatdate(second), SERVER_ID)
+        _date_server_second = second
+    return _date_server_block
+
 
 class WSGIInputStream(object):
+    """The wsgi.input stream of a request. The request body is read straight from the buffer of the connection, both
+    for bodies with a Content-length and for chunked (Transfer-Encoding: chunked) bodies, so that large uploads
+    can be streamed trough the application in constant memory."""
     def __init__(self, request, reader):
+        self._reader = reader
+        self._n = None #bytes left in the body, or in the current chunk for a chunked body, None at EOF
+        self._chunked = False
+        self._chunk_end = False #whether we still need to skip the CRLF following the data of the current chunk
+        self._channel = None
+
         transfer_encoding = request.get_request_header('Transfer-Encoding')
-        if transfer_encoding is not None and transfer_encoding == 'chunked':
-            assert False, 'chunked post not supported yet'
-
-        content_length = request.get_request_header('Content-length')
-        if content_length is None:
-            self._channel = None
-            self._n = None
-            self._file = None        
+        if transfer_encoding is not None and transfer_encoding.lower() == 'chunked':
+            self._chunked = True
+            self._n = 0 #size of first chunk is read on first read
         else:
-            self._n = int(content_length)
-            self._file = reader.file()
+            content_length = request.get_request_header('Content-length')
+            if content_length is not None and int(content_length) > 0:
+                self._n = int(content_length)
+
+        if self._n is not None:
             self._channel = Channel()
     
     def _read_request_data(self):
-        if self._n is not None:
+        if self._channel is not None:
             self._channel.receive() #wait till handler has read all input data
 
-    def read(self, n):  
-        if self._n > 0:
-            data = self._file.read(min(self._n, n))
-            self._n -= len(data)
-            if self._n == 0:
-                self._n = None
-                self._file = None
-                self._channel.send(True) #unblock reader
-                self._channel = None
-            return data
-        else:
-            return '' #EOF
+    def _skip(self):
+        """reads and discards any part of the body not read by the application"""
+        while self.read(CHUNK_SIZE): 
+            pass
+
+    def _eof(self):
+        self._n = None
+        self._reader = None
+        channel, self._channel = self._channel, None
+        if channel.has_receiver():
+            channel.send(True) #unblock reader
         
-    def readline(self):
-        assert False, 'TODO'
+    def _next_chunk(self):
+        reader = self._reader
+        if self._chunk_end:
+            reader.read_line() #chunk data is always followed by CRLF
+            self._chunk_end = False
+        self._n = int(reader.read_line().split(';', 1)[0], 16)
+        if self._n == 0:
+            while reader.read_line(): pass #skip any trailers up till the empty line
+            self._eof()
+
+    def _available(self):
+        """returns the number of body bytes that can be read next (at least 1), or 0 at EOF"""
+        if self._n == 0 and self._chunked:
+            self._next_chunk()
+        if self._n is None:
+            return 0
+        buffer = self._reader.buffer
+        if not buffer.remaining:
+            self._reader._read_more()
+        return min(self._n, buffer.remaining)
+
+    def _consumed(self, n):
+        self._n -= n
+        if self._n == 0:
+            if self._chunked:
+                self._chunk_end = True
+            else:
+                self._eof()
+
+    def read(self, n = -1):
+        s = []
+        while n != 0:
+            available = self._available()
+            if not available:
+                break #EOF
+            if n > 0:
+                available = min(available, n)
+                n -= available
+            s.append(self._reader.buffer.read_bytes(available))
+            self._consumed(available)
+        return ''.join(s)
+        
+    def readline(self, size = -1):
+        s = []
+        while size != 0:
+            available = self._available()
+            if not available:
+                break #EOF
+            if size > 0:
+                available = min(available, size)
+            #only look for the end of the line in the part of the buffer that belongs to the body
+            buffer = self._reader.buffer
+            limit = buffer.limit
+            buffer.limit = buffer.position + available
+            try:
+                try:
+                    line = buffer.read_line(True)
+                except BufferUnderflowError:
+                    line = buffer.read_bytes(-1)
+            finally:
+                buffer.limit = limit
+            self._consumed(len(line))
+            s.append(line)
+            if line[-1] == '\n':
+                break
+            if size > 0:
+                size -= len(line)
+        return ''.join(s)
+
+    def readlines(self, hint = -1):
+        lines = []
+        n = 0
+        for line in self:
+            lines.append(line)
+            n += len(line)
+            if hint > 0 and n >= hint:
+                break
+        return lines
 
-    def readlines(self):
-        assert False, 'TODO'
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+
+class WSGIFileWrapper(object):
+    """The wsgi.file_wrapper. When an application returns one of these for a regular file (one that has a fileno), the server 
+    sends the file with the sendfile system call instead of iterating over it."""
+    def __init__(self, filelike, blksize = CHUNK_SIZE):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def fileno(self):
+        """returns the file descriptor of the wrapped file or None if it has none"""
+        if not hasattr(self.filelike, 'fileno'):
+            return None
+        try:
+            return self.filelike.fileno()
+        except (IOError, ValueError):
+            return None
 
     def __iter__(self):
-        assert False, 'TODO'
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
 
 
 class WSGIErrorStream(object):
@@ -102,6 +240,7 @@ class WSGIRequest(object):
         self.status = httplib.NOT_FOUND #or internal server error?
         self.exc_info = None     
         self.state = self.STATE_INIT   
+        self.incomplete = False #the response body was shorter than its Content-Length, the connection must be closed
         
     def start_response(self, status, response_headers, exc_info = None):
         self.status = status
@@ -119,45 +258,111 @@ class WSGIRequest(object):
         return self.environ.get(http_key, None)
 
     def write_response(self, response, writer):
+        try:
+            self._write_response(response, writer)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        
+    def _write_response(self, response, writer):
         self.state = self.STATE_WRITING_HEADER
+
+        #Content-Length given by the application, in which case we stream the body as is
+        content_length = None 
+        for header_name, header_value in self.response_headers:
+            if header_name.lower() == 'content-length':
+                content_length = int(header_value)
+
+        length = None #Content-length that we add ourselves
         
-        if self.version == 'HTTP/1.0':
+        #for a regular file we use sendfile, starting at its current position, other files (pipes, sockets, devices)
+        #are iterated like any other response
+        sendfile = None
+        if isinstance(response, WSGIFileWrapper) and hasattr(writer.stream, 'sendfile'):
+            fileno = response.fileno()
+            if fileno is not None:
+                st = os.fstat(fileno)
+                if not stat.S_ISREG(st.st_mode):
+                    fileno = None
+            if fileno is not None:
+                offset = os.lseek(fileno, 0, os.SEEK_CUR)
+                count = st.st_size - offset
+                if content_length is None:
+                    length = count
+                else:
+                    count = min(count, content_length)
+                sendfile = (fileno, offset, count)
+
+        if content_length is not None or sendfile is not None:
+            chunked = False
+        elif self.version == 'HTTP/1.0':
             chunked = False
+            if type(response) in [list, tuple]:
+                length = sum([len(chunk) for chunk in response])
+            #otherwise the end of the body is indicated by closing the connection
         else:
             chunked = True
 
         writer.clear()
         
-        writer.write_bytes("%s %s\r\n" % (self.version, self.status))        
-        for header_name, header_value in self.response_headers:
-            if header_name in self._disallowed_application_headers: continue
-            writer.write_bytes("%s: %s\r\n" % (header_name, header_value))
-        writer.write_bytes("Date: %s\r\n" % rfc822.formatdate())
-        writer.write_bytes("Server: %s\r\n" % SERVER_ID) 
+        writer.write_bytes(_status_line(self.version, self.status))        
+        writer.write_headers(self.response_headers, self._disallowed_application_headers)
+        writer.write_bytes(_date_server_headers())
 
         if chunked:
-            writer.write_bytes("Transfer-Encoding: chunked\r\n")
+            writer.write_bytes("Transfer-Encoding: chunked\r\n\r\n")
+        elif length is not None:
+            writer.write_bytes("Content-length: %d\r\n\r\n" % length)
         else:
-            response = ''.join(response)
-            writer.write_bytes("Content-length: %d\r\n" % len(response))
-        
-        writer.write_bytes("\r\n")
+            writer.write_bytes("\r\n")
     
         self.state = self.STATE_WRITING_DATA
         
         if chunked:
             for chunk in response:
+                if not chunk: continue #a zero length chunk would end the body
                 writer.write_bytes("%x;\r\n" % len(chunk))
                 writer.write_bytes(chunk)
                 writer.write_bytes("\r\n")
                 
             writer.write_bytes("0\r\n\r\n")
+        elif sendfile is not None:
+            fileno, offset, count = sendfile
+            writer.flush()
+            try:
+                missing = count - writer.stream.sendfile(fileno, offset, count, Timeout.current())
+            except IOError, e:
+                if e.errno != ENOSYS: 
+                    raise
+                #no sendfile on this platform, just copy the file trough the buffer
+                missing = self._write_body(response, writer, count)
+            if content_length is not None:
+                missing += content_length - count #the file is shorter than the announced length
+            self._check_body(missing)
+        elif content_length is not None:
+            self._check_body(self._write_body(response, writer, content_length))
         else:
-            writer.write_bytes(response)
+            for chunk in response:
+                writer.write_bytes(chunk)
 
         writer.flush() #TODO use special header to indicate no flush needed
         
         self.state = self.STATE_FINISHED
+
+    def _write_body(self, response, writer, length):
+        """streams the body as is, but never sends more than *length* bytes, returns the number of bytes missing"""
+        for chunk in response:
+            if len(chunk) > length:
+                chunk = chunk[:length]
+            writer.write_bytes(chunk)
+            length -= len(chunk)
+        return length
+
+    def _check_body(self, missing):
+        if missing > 0:
+            #the client would wait for the rest of the body, or take the next response for it
+            self.log.warn("response body is %d bytes shorter than its Content-Length, closing the connection", missing)
+            self.incomplete = True
     
     def handle_request(self, application):
         try:
@@ -179,49 +384,37 @@ class WSGIRequest(object):
 
         self.state = self.STATE_WAIT_FOR_REQUEST
         
-        #setup readline iterator        
-        lines = reader.read_lines()
-        
-        #parse status line, this will block to read the first request line
-        line = lines.next().split()
+        #parse the request line and all headers at once (in C) as soon as the complete header is in the buffer,
+        #any partial header stays in the buffer (compacted to the front) while we read more
+        buffer = reader.buffer
+        while True:
+            try:
+                self.method, self.uri, self.version = buffer.read_http_request(self.environ)
+                break
+            except BufferUnderflowError:
+                if buffer.remaining:
+                    self.state = self.STATE_READING_HEADER
+                    if buffer.remaining == buffer.capacity:
+                        raise HTTPError('Request header too large')
+                reader._read_more()
         
         self.state = self.STATE_READING_HEADER
         
-        u = urlparse.urlparse(line[1])
-        
-        self.method = line[0]
         if self.method not in ['GET', 'POST']:
             raise HTTPError('Unsupported method: %s' % self.method)
 
         #TODO validate version
-        self.version = line[2]
-        self.uri = line[1]
 
         #build up the WSGI environment
-        self.environ['REQUEST_METHOD'] = line[0]
         self.environ['SCRIPT_NAME'] = '' #TODO
-        self.environ['PATH_INFO'] = u[2]
-        self.environ['QUERY_STRING'] = u[4]
         
         self.environ['wsgi.url_scheme'] = 'http'
         self.environ['wsgi.multiprocess'] = False
         self.environ['wsgi.multithread'] = True
         self.environ['wsgi.run_once'] = False
         self.environ['wsgi.version'] = (1, 0)
+        self.environ['wsgi.file_wrapper'] = WSGIFileWrapper
         
-        #rest of request headers
-        for line in lines:
-            if not line: break
-            key, value = line.split(': ')
-            key = key.replace('-', '_').upper()
-            value = value.strip()
-            
-            http_key = 'HTTP_' + key 
-            if http_key in self.environ:
-                self.environ[http_key] += ',' + value # comma-separate multiple headers
-            else:
-                self.environ[http_key] = value
-
         #wsgi complience 
         if 'HTTP_CONTENT_LENGTH' in self.environ:
             self.environ['CONTENT_LENGTH'] = self.environ['HTTP_CONTENT_LENGTH']
@@ -267,6 +460,8 @@ class HTTPHandler(object):
     def __init__(self, server):
         self._server = server     
         self._reque = ReorderQueue()
+        self._in_flight = 0 #requests read, but whose response has not been written yet
+        self._reader_resume = None #channel the reader waits on while there are too many requests in flight
 
     def write_responses(self, control, stream):        
         try:
@@ -278,31 +473,112 @@ class HTTPHandler(object):
             self.MSG_WRITE_ERROR.send(control)(None, None)
 
     def read_requests(self, control, stream):
+        max_in_flight = self._server.max_pipelined_requests
+        request = None
         try:
             while True:
+                if self._in_flight >= max_in_flight:
+                    #backpressure; stop reading (and let tcp push back on the client) untill a response is written
+                    self._server._pipeline_stall_statistic += 1
+                    self._reader_resume = Channel()
+                    self._reader_resume.receive()
                 request = WSGIRequest(self._server)
                 request.read_request(stream.reader)                
+                self._in_flight += 1
                 self.MSG_REQUEST_READ.send(control)(request, None)
                 request.read_request_data()
-        except EOFError, e:
+        except Exception, e:
+            self._read_error(request, e)
+
+        self.MSG_READ_ERROR.send(control)(None, None)
+
+    def _read_error(self, request, e):
+        if isinstance(e, EOFError):
             if request.state == request.STATE_WAIT_FOR_REQUEST:
                 pass #this is normal at the end of the http KA connection (client closes) 
-        except IOError, e:
+        elif isinstance(e, IOError):
             if e.errno == 104 and request.state == request.STATE_WAIT_FOR_REQUEST:
                 pass #connection reset by peer while waiting for request
-        except TimeoutError, e:
+        elif isinstance(e, TimeoutError):
             self.log.warn("Timeout in reader")
-        except Exception, e:
+        else:
             self.log.exception("Exception in reader")
 
-        self.MSG_READ_ERROR.send(control)(None, None)
+    def _keep_alive(self, request):
+        if request.incomplete:
+            return False #the body of the response was cut short
+        elif request.version == 'HTTP/1.0':
+            return False #no keep-alive support in http 1.0
+        elif request.get_response_header('Connection') == 'close':
+            return False #response indicated to close after response
+        elif request.get_request_header('Connection') == 'close':
+            return False #request indicated to close after response
+        else:
+            return True
 
     def handle_request(self, control, request, application):
-        response = self._server.handle_request(request, application)
+        server = self._server
+        server._acquire_handler()
+        try:
+            response = server.handle_request(request, application)
+        finally:
+            server._release_handler()
         self.MSG_REQUEST_HANDLED.send(control)(request, response)       
 
     def handle(self, socket, application):
         stream = BufferedStream(socket)
+        try:
+            if self._server.single_tasklet:
+                self.handle_inline(stream, application)
+            else:
+                self.handle_pipelined(stream, application)
+        finally:
+            #close our side of the socket
+            stream.close()
+
+    def handle_inline(self, stream, application):
+        """Reads, handles and writes requests one after the other in the current task. As soon as the client turns out to 
+        pipeline its requests (a second request is already in the buffer while the first is not answered yet),
+        the rest of the connection is handled by :func:`handle_pipelined`."""
+        server = self._server
+        while True:
+            request = WSGIRequest(server)
+            try:
+                request.read_request(stream.reader)
+            except Exception, e:
+                self._read_error(request, e)
+                return
+            
+            wsgi_input = request.environ['wsgi.input']
+            if wsgi_input._channel is None and stream.reader.buffer.remaining:
+                #no request body, but more data in the buffer, the client is pipelining
+                self.handle_pipelined(stream, application, request)
+                return
+            
+            server._acquire_handler()
+            try:
+                response = server.handle_request(request, application)
+            finally:
+                server._release_handler()
+            
+            try:
+                request.write_response(response, stream.writer)
+            except Exception:
+                self.log.exception("Exception in writer")
+                return
+                
+            if not self._keep_alive(request):
+                return
+            
+            try:
+                wsgi_input._skip()
+            except Exception, e:
+                self._read_error(request, e)
+                return
+
+    def handle_pipelined(self, stream, application, request = None):
+        """Handles the requests of the connection with separate tasks for reading requests, writing responses and 
+        for each request. Optionally the first *request* may already have been read."""
         #implements http1.1 keep alive handler
         #there are several concurrent tasks for each connection; 
         #1 for reading requests, 1 or more for handling requests and 1 for writing responses
@@ -310,6 +586,10 @@ class HTTPHandler(object):
         #e.g. it coordinates the actions of it's children by message passing
         control = Tasklet.current()
 
+        if request is not None:
+            self._in_flight += 1
+            self.MSG_REQUEST_READ.send(control)(request, None)
+
         #writes responses back to the client when they are ready:
         response_writer = Tasklet.new(self.write_responses, name = 'response_writer')(control, stream)
         #reads requests from clients:
@@ -335,12 +615,13 @@ class HTTPHandler(object):
                     self.MSG_WRITE_RESPONSE.send(response_writer)(request, response)
                     
             elif msg.match(self.MSG_RESPONSE_WRITTEN):
-                if request.version == 'HTTP/1.0':
-                    break #no keep-alive support in http 1.0
-                elif request.get_response_header('Connection') == 'close':
-                    break #response indicated to close after response
-                elif request.get_request_header('Connection') == 'close':
-                    break #request indicated to close after response
+                self._in_flight -= 1
+                if self._reader_resume is not None:
+                    #reader was waiting for a free slot
+                    reader_resume, self._reader_resume = self._reader_resume, None
+                    reader_resume.send(True)
+                if not self._keep_alive(request):
+                    break
             elif msg.match(self.MSG_READ_ERROR):
                 break #stop and close the connection
             elif msg.match(self.MSG_WRITE_ERROR):
@@ -352,9 +633,6 @@ class HTTPHandler(object):
         #any outstanding request will continue, but will exit by themselves
         response_writer.kill()
         request_reader.kill()
-   
-        #close our side of the socket
-        stream.close()
         
 class WSGIServer(object):
     """A HTTP/1.1 Web server with WSGI application interface.
@@ -372,11 +650,57 @@ class WSGIServer(object):
     
     read_timeout = HTTP_READ_TIMEOUT
 
+    #max number of pipelined requests per connection that are read but not yet answered, 
+    #when reached, the server stops reading from the connection until a response was written
+    max_pipelined_requests = 16 
+
+    #handle connections in a single task as long as the client does not pipeline its requests, 
+    #otherwise every connection uses the control/reader/writer tasks of HTTPHandler.handle_pipelined
+    single_tasklet = True
+
+    #max number of requests handled concurrently by the whole server (None is unlimited),
+    #requests beyond this wait for a running one to finish
+    max_concurrent_handlers = None
+
     def __init__(self, application, request_log_level = logging.DEBUG):
         """Create a new WSGIServer serving the given *application*. Optionally
         the *request_log_level* can be given. This loglevel is used for logging the requests."""
         self._application = application
         self._request_log_level = request_log_level
+        self._handlers = 0 #requests currently being handled
+        self._handler_waiters = Deque() #channels of requests waiting for a free handler slot
+
+        #some statistics
+        self._request_statistic = StatisticExtra()
+        self._handler_wait_statistic = StatisticExtra()
+        self._pipeline_stall_statistic = StatisticExtra()
+
+    def __statistics__(self):
+        return {'requests': self._request_statistic,
+                'handlers': {'active': self._handlers,
+                             'waiting': len(self._handler_waiters),
+                             'wait_time': self._handler_wait_statistic},
+                'pipeline_stall': self._pipeline_stall_statistic}
+
+    def _acquire_handler(self):
+        if self.max_concurrent_handlers is not None and self._handlers >= self.max_concurrent_handlers:
+            with self._handler_wait_statistic.time():
+                channel = Channel()
+                self._handler_waiters.append(channel)
+                try:
+                    channel.receive() #the slot is handed over to us by _release_handler
+                except:
+                    if channel in self._handler_waiters:
+                        self._handler_waiters.remove(channel)
+                    raise
+        else:
+            self._handlers += 1
+
+    def _release_handler(self):
+        if self._handler_waiters:
+            self._handler_waiters.popleft().send(True)
+        else:
+            self._handlers -= 1
 
     def internal_server_error(self, environ, start_response):
         """Default WSGI application for creating a default `500 Internal Server Error` response on any
@@ -389,6 +713,7 @@ class WSGIServer(object):
     def handle_request(self, request, application):
         """All HTTP requests pass trough this method. 
         This method provides a hook for logging, statistics and or further processing w.r.t. the *request*."""
+        self._request_statistic += 1
         response = request.handle_request(application)
         self.log.log(self._request_log_level, "%s %s", request.status, request.uri)
         return response
@@ -399,7 +724,9 @@ class WSGIServer(object):
         HTTPHandler(self).handle(socket, self._application)
 
     def serve(self, endpoint):
-        """Serves the application at the given *endpoint*. The *endpoint* must be a tuple (<host>, <port>)."""
+        """Serves the application at the given *endpoint*. The *endpoint* must be a tuple (<host>, <port>), or
+        an already listening :class:`~concurrence.io.socket.Socket`, e.g. the one passed to the workers of a 
+        :class:`~concurrence.io.socket.PreforkServer`."""
         return Server.serve(endpoint, self.handle_connection)
                         
 
@@ -19,7 +19,7 @@ class IOStream(object):
         or raise error, or timeout"""
         pass
     
-from concurrence.io.socket import Socket, SocketServer
+from concurrence.io.socket import Socket, SocketServer, PreforkServer
 from concurrence.io.buffered import BufferedReader, BufferedWriter, BufferedStream
 
 #TODO what if more arguments are needed for connect?, eg. passwords etc?
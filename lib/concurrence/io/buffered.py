@@ -62,19 +62,35 @@ class BufferedReader(object):
                 self._read_more()
                 
 class BufferedWriter(object):
+    #strings of at least this size are not copied into the buffer, but are kept by reference and handed to the kernel
+    #directly on flush, together with the contents of the buffer (scatter-gather write, if the stream supports writev)
+    writev_threshold = 1024 * 4
+    #flush when this many strings are pending 
+    writev_max_parts = 64
+
     def __init__(self, stream, buffer):
         assert isinstance(stream, IOStream)
         self.stream = stream
         self.buffer = buffer 
+        self._parts = [] #pending strings, to be written after the contents of the buffer
+        self._writev = hasattr(stream, 'writev')
     
     def file(self):
         return CompatibleFile(None, self)
 
     def clear(self):
         self.buffer.clear()
+        self._parts = []
 
     def write_bytes(self, s):
         assert type(s) == str, "arg must be a str"
+        if self._parts or (self._writev and len(s) >= self.writev_threshold):
+            #once a string is pending, everything after it must be pending as well to keep the order
+            if s:
+                self._parts.append(s)
+            if len(self._parts) >= self.writev_max_parts:
+                self.flush()
+            return
         try:
             self.buffer.write_bytes(s)
         except BufferOverflowError:
@@ -85,8 +101,23 @@ class BufferedWriter(object):
                 self.buffer.write_bytes(part)
                 self.flush()    
  
+    def write_headers(self, headers, exclude = None):
+        """writes (name, value) tuples as http header lines, see :func:`Buffer.write_headers`"""
+        if self._parts: 
+            self.flush()
+        try:
+            self.buffer.write_headers(headers, exclude)
+        except BufferOverflowError:
+            #does not fit in what is left of the buffer, write the lines one by one, flushing as we go
+            for name, value in headers:
+                if exclude is not None and name in exclude: 
+                    continue
+                self.write_bytes("%s: %s\r\n" % (name, value))
+
     def write_byte(self, ch):
         assert type(ch) == int, "ch arg must be int"
+        if self._parts: 
+            self.flush()
         while True:
             try:
                 self.buffer.write_byte(ch)
@@ -95,6 +126,8 @@ class BufferedWriter(object):
                 self.flush()
        
     def write_short(self, i):
+        if self._parts: 
+            self.flush()
         while True:
             try:
                 self.buffer.write_short(i)
@@ -104,11 +137,35 @@ class BufferedWriter(object):
             
     def flush(self):
         self.buffer.flip()
+        if self._parts:
+            self._flush_parts()
         while self.buffer.remaining:
             if not self.stream.write(self.buffer, Timeout.current()):
                 raise EOFError("while writing")
         self.buffer.clear()
         
+    def _flush_parts(self):
+        """writes the contents of the buffer followed by the pending strings with as few writev calls as possible"""
+        buffer = self.buffer
+        parts = self._parts
+        self._parts = []
+        offset = 0 #bytes of parts[0] already written
+        while parts:
+            remaining = buffer.remaining
+            n = self.stream.writev(buffer, parts, offset, Timeout.current())
+            if not n:
+                raise EOFError("while writing")
+            n -= remaining
+            if n > 0:
+                #skip the parts that were written completely
+                n += offset
+                i = 0
+                while i < len(parts) and n >= len(parts[i]):
+                    n -= len(parts[i])
+                    i += 1
+                del parts[:i]
+                offset = n
+        
 class BufferedStream(object):
     def __init__(self, stream, buffer_size = 1024 * 8, read_buffer_size = 0, write_buffer_size = 0):        
         self.stream = stream
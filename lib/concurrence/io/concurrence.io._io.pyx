@@ -9,6 +9,15 @@ cdef extern from "sys/socket.h":
     int recv(int, void *, int, int)
     int send(int, void *, int, int)
 
+cdef extern from "sys/uio.h":
+    struct iovec:
+        void *iov_base
+        int iov_len
+    int writev(int, iovec *, int)
+
+cdef enum:
+    MAX_IOV = 64 #max number of parts passed to writev at once, well below IOV_MAX on any platform
+
 cdef extern from "string.h":
     cdef void *memmove(void *, void *, int)
     cdef void *memcpy(void *, void *, int)
@@ -25,14 +34,22 @@ cdef extern from "Python.h":
 
 cdef extern from "pyerrors.h":    
     object PyErr_SetFromErrno(object)
+
+cdef extern from "errno.h":
+    int errno
     
 cdef extern from "io_base.h":
     int sendfd(int, int)
     int recvfd(int)
+    long long sendfile_fd(int, int, long long, long long)
     
 def error_from_errno(object exc):
     return PyErr_SetFromErrno(exc)
 
+def get_errno():
+    """Returns the current value of the C errno, e.g. to check for EAGAIN after a failed recv or send."""
+    return errno
+
 class BufferError(Exception):
     pass
 
@@ -201,13 +218,46 @@ cdef class Buffer:
         if b > 0: self._position = self._position + b
         return b, self._limit - self._position
 
-    def send(self, int fd):
+    def send(self, int fd, parts = None, int offset = 0):
         """Sends as many bytes as possible up till the :attr:`limit` of the buffer to the filedescriptor *fd*.
         Returns a tuple (bytes_written, bytes_remaining). If *bytes_written* is negative, an IO Error was encountered.
+        Optionally a list of python strings *parts* can be given that will be sent right after the bytes of the buffer 
+        (starting at *offset* in the first part) in a single writev system call, without copying them into the buffer first.
+        In that case *bytes_written* includes the bytes written from the parts, while *bytes_remaining* only
+        counts the bytes left in the buffer.
         """
-        cdef int b
-        b = send(fd, self._buff + self._position, self._limit - self._position, 0)
-        if b > 0: self._position = self._position + b
+        cdef int b, i, n
+        cdef iovec iov[MAX_IOV]
+        cdef char *s
+        cdef Py_ssize_t m
+        if not parts:
+            b = send(fd, self._buff + self._position, self._limit - self._position, 0)
+            if b > 0: self._position = self._position + b
+            return b, self._limit - self._position
+        n = 0
+        if self._limit > self._position:
+            iov[0].iov_base = self._buff + self._position
+            iov[0].iov_len = self._limit - self._position
+            n = 1
+        i = 0
+        for part in parts:
+            if n == MAX_IOV:
+                break
+            PyString_AsStringAndSize(part, &s, &m)
+            if i == 0:
+                if offset < 0 or offset > m:
+                    raise BufferInvalidArgumentError("offset out of range")
+                s = s + offset
+                m = m - offset
+            iov[n].iov_base = s
+            iov[n].iov_len = m
+            n = n + 1
+            i = i + 1
+        b = writev(fd, iov, n)
+        if b > self._limit - self._position:
+            self._position = self._limit
+        elif b > 0:
+            self._position = self._position + b
         return b, self._limit - self._position
         
     def compact(self):
@@ -333,6 +383,128 @@ cdef class Buffer:
                     self._position = self._position + n + 1                                    
             return s
     
+    def read_http_request(self, environ):
+        """Parses a complete HTTP request header (the request line followed by header lines and an empty line) from the buffer
+        in a single pass and updates position. Fills REQUEST_METHOD, PATH_INFO, QUERY_STRING and a HTTP_XXX key for each header 
+        in the given WSGI *environ* dict. Returns a tuple (method, uri, version). Lines may end with either 'LF' or 'CRLF', 
+        the space after the colon of a header is optional and continuation lines are appended to the previous header.
+        If the buffer does not yet contain the whole request header :exc:`BufferUnderflowError` is raised and position 
+        is not changed. Raises :exc:`ValueError` on a malformed request line or header line."""
+        cdef char *p, *q, *end, *eol, *line_end, *header_end, *colon, *value_start, *value_end
+        cdef char *uri_start, *uri_end, *path_start, *path_end, *query_start, *query_end, *version_start
+        cdef char keybuf[256]
+        cdef int i, n
+        p = <char *>(self._buff + self._position)
+        end = <char *>(self._buff + self._limit)
+        #ignore any empty lines in front of the request line (rfc 2616 4.1)
+        while p < end and (p[0] == 13 or p[0] == 10):
+            p = p + 1
+        #first find the end of the header block, we only start parsing when it is complete
+        q = p
+        while True:
+            eol = <char *>(memchr(q, 10, end - q))
+            if eol == NULL:
+                raise BufferUnderflowError()
+            if eol + 1 < end and eol[1] == 10:
+                header_end = eol + 2
+                break
+            if eol + 2 < end and eol[1] == 13 and eol[2] == 10:
+                header_end = eol + 3
+                break
+            q = eol + 1
+        #request line: <method> SP <uri> SP <version>
+        eol = <char *>(memchr(p, 10, header_end - p))
+        line_end = eol
+        if line_end > p and line_end[-1] == 13:
+            line_end = line_end - 1
+        uri_start = <char *>(memchr(p, 32, line_end - p))
+        if uri_start == NULL:
+            raise ValueError("invalid request line")
+        version_start = line_end
+        while version_start > uri_start and version_start[-1] != 32:
+            version_start = version_start - 1
+        if version_start == uri_start + 1:
+            raise ValueError("invalid request line")
+        uri_end = version_start - 1
+        method = PyString_FromStringAndSize(p, uri_start - p)
+        uri_start = uri_start + 1
+        uri = PyString_FromStringAndSize(uri_start, uri_end - uri_start)
+        version = PyString_FromStringAndSize(version_start, line_end - version_start)
+        #split uri into path and query, skipping scheme and authority of an absolute uri
+        path_start = uri_start
+        q = <char *>(memchr(uri_start, 47, uri_end - uri_start)) # '/'
+        if q != NULL and q > uri_start and q[-1] == 58 and q + 1 < uri_end and q[1] == 47: # '://'
+            path_start = <char *>(memchr(q + 2, 47, uri_end - (q + 2)))
+            if path_start == NULL:
+                path_start = uri_end
+        path_end = path_start
+        while path_end < uri_end and path_end[0] != 63 and path_end[0] != 35: # '?' '#'
+            path_end = path_end + 1
+        query_start = path_end
+        query_end = path_end
+        if path_end < uri_end and path_end[0] == 63:
+            query_start = path_end + 1
+            query_end = query_start
+            while query_end < uri_end and query_end[0] != 35:
+                query_end = query_end + 1
+        environ['REQUEST_METHOD'] = method
+        environ['PATH_INFO'] = PyString_FromStringAndSize(path_start, path_end - path_start)
+        environ['QUERY_STRING'] = PyString_FromStringAndSize(query_start, query_end - query_start)
+        #header lines
+        memcpy(keybuf, "HTTP_", 5)
+        key = None
+        p = eol + 1
+        while p < header_end:
+            eol = <char *>(memchr(p, 10, header_end - p))
+            line_end = eol
+            if line_end > p and line_end[-1] == 13:
+                line_end = line_end - 1
+            if line_end == p:
+                break #empty line ends header
+            if p[0] == 32 or p[0] == 9: 
+                colon = NULL #continuation of previous header
+                value_start = p
+            else:
+                colon = <char *>(memchr(p, 58, line_end - p)) # ':'
+                if colon == NULL:
+                    raise ValueError("invalid header line")
+                value_start = colon + 1
+            while value_start < line_end and (value_start[0] == 32 or value_start[0] == 9):
+                value_start = value_start + 1
+            value_end = line_end
+            while value_end > value_start and (value_end[-1] == 32 or value_end[-1] == 9):
+                value_end = value_end - 1
+            value = PyString_FromStringAndSize(value_start, value_end - value_start)
+            if colon == NULL:
+                if key is None:
+                    raise ValueError("invalid header line")
+                environ[key] = environ[key] + ' ' + value
+            else:
+                q = colon
+                while q > p and (q[-1] == 32 or q[-1] == 9):
+                    q = q - 1
+                n = q - p
+                if n > 250:
+                    key = 'HTTP_' + PyString_FromStringAndSize(p, n).replace('-', '_').upper()
+                else:
+                    i = 0
+                    while i < n:
+                        if p[i] >= 97 and p[i] <= 122: # a-z
+                            keybuf[5 + i] = p[i] - 32
+                        elif p[i] == 45: # '-'
+                            keybuf[5 + i] = 95 # '_'
+                        else:
+                            keybuf[5 + i] = p[i]
+                        i = i + 1
+                    key = PyString_FromStringAndSize(keybuf, 5 + n)
+                if key in environ:
+                    environ[key] = environ[key] + ',' + value # comma-separate multiple headers
+                else:
+                    environ[key] = value
+            p = eol + 1
+        self._position = header_end - <char *>self._buff
+        return method, uri, version
+
     def scan_until_xmltoken(self):
         # < == 60, > == 62, ? == 63, / == 47
         # retval '<' = 0, '>' = 1, '</' = 2, '/>' = 3, '<?' = 4, '?>' = 5
@@ -385,6 +557,38 @@ cdef class Buffer:
             self._position = self._position + n
             return n
 
+    def write_headers(self, headers, exclude = None):
+        """Writes the (name, value) tuples in *headers* as 'name: value\\r\\n' lines to the buffer and updates position, 
+        skipping any header whose name is in *exclude*. The header lines are copied directly into the buffer.
+        If the headers do not fit, nothing is written and :exc:`BufferOverflowError` is raised."""
+        cdef char *b 
+        cdef Py_ssize_t n
+        cdef char *v
+        cdef Py_ssize_t m
+        cdef int start
+        start = self._position
+        for name, value in headers:
+            if exclude is not None and name in exclude: 
+                continue
+            if type(value) is not str:
+                value = str(value)
+            PyString_AsStringAndSize(name, &b, &n)
+            PyString_AsStringAndSize(value, &v, &m)
+            if n + m + 4 > (self._limit - self._position):
+                self._position = start
+                raise BufferOverflowError()
+            memcpy(self._buff + self._position, b, n)
+            self._position = self._position + n
+            self._buff[self._position] = 58 # ':'
+            self._buff[self._position + 1] = 32 # ' '
+            self._position = self._position + 2
+            memcpy(self._buff + self._position, v, m)
+            self._position = self._position + m
+            self._buff[self._position] = 13 # '\r'
+            self._buff[self._position + 1] = 10 # '\n'
+            self._position = self._position + 2
+        return self._position - start
+
     def write_buffer(self, Buffer other):
         """writes available bytes from other buffer to this buffer"""
         self.write_bytes(other.read_bytes(-1)) #TODO use copy
@@ -434,6 +638,12 @@ cdef class Buffer:
     def __str__(self):
         return repr(self)
     
+def sendfile(int out_fd, int in_fd, long long offset, long long count):
+    """Sends up to *count* bytes from file descriptor *in_fd*, starting at *offset*, to the socket *out_fd* without copying them
+    trough userspace. Returns the number of bytes sent, or -1 on error (check :func:`get_errno`, which is ENOSYS if sendfile is not
+    available on this platform)."""
+    return sendfile_fd(out_fd, in_fd, offset, count)
+
 def msgsendfd(dst_fd, fd):
     return sendfd(dst_fd, fd)
 
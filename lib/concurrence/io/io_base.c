@@ -4,10 +4,16 @@
 #include <stdlib.h>
 #include <unistd.h>
 #include <string.h>
+#include <errno.h>
 
 #include <sys/types.h>
 #include <sys/socket.h>
 #include <sys/un.h>
+#include <sys/uio.h>
+
+#if defined(__linux__)
+#include <sys/sendfile.h>
+#endif
 
 int sendfd(int dst_fd, int fd)
 {
@@ -53,13 +59,51 @@ int recvfd(int src_fd)
 	  .msg_iovlen = 1,
 	};
 
-	//TODO check return val
-	recvmsg(src_fd, &message, 0);
+	ssize_t n = recvmsg(src_fd, &message, 0);
+	if (n < 0) {
+		return -1;
+	}
+	if (n == 0) {
+		errno = ECONNRESET; /* eof, peer closed */
+		return -1;
+	}
 
 	struct cmsghdr *cmessage = CMSG_FIRSTHDR(&message);
+	if (cmessage == NULL) {
+		return -1;
+	}
 	memcpy(file_descriptors, CMSG_DATA(cmessage), sizeof file_descriptors);
 
 	return file_descriptors[0];
 }
 
+/*
+ * sends up to count bytes starting at offset of file in_fd to socket out_fd, without copying
+ * them trough userspace. returns the number of bytes sent or -1 with errno set (EAGAIN when the
+ * socket is not writable, ENOSYS if sendfile is not available on this platform)
+ */
+long long sendfile_fd(int out_fd, int in_fd, long long offset, long long count)
+{
+#if defined(__linux__)
+	off_t off = offset;
+	return sendfile(out_fd, in_fd, &off, count);
+#elif defined(__APPLE__)
+	off_t len = count;
+	if (sendfile(in_fd, out_fd, offset, &len, NULL, 0) == -1) {
+		if (errno == EAGAIN && len > 0) return len; /* partial write */
+		return -1;
+	}
+	return len;
+#elif defined(__FreeBSD__)
+	off_t sbytes = 0;
+	if (sendfile(in_fd, out_fd, offset, count, NULL, &sbytes, 0) == -1) {
+		if (errno == EAGAIN && sbytes > 0) return sbytes; /* partial write */
+		return -1;
+	}
+	return sbytes;
+#else
+	errno = ENOSYS;
+	return -1;
+#endif
+}
 
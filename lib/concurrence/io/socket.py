@@ -5,21 +5,39 @@
 
 #TODO try wait read/write optimzation, e.g. don't wait, but try, if EAGAIN, then wait. 
 #if ok, then next time expect no wait, otherwise next time expect wait
+#(this is what happens for edge triggered sockets, see Socket.edge_triggered)
 
 import logging
 import _socket
 import types
 import os
+import sys
+import time
+import signal
+import weakref
 
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, ENOTCONN, ESHUTDOWN, EINTR, EISCONN, ENOENT, EAGAIN
 
 import _io
 
-from concurrence import Tasklet, FileDescriptorEvent
+from concurrence import Tasklet, FileDescriptorEvent, dispatch, _event
+from concurrence.core import EdgeTriggeredFileDescriptorEvent, EDGE_TRIGGERED
 from concurrence.io import IOStream
 
 DEFAULT_BACKLOG = 255    
 
+#edge triggered events stay registered with libevent for the lifetime of the socket. when the socket is not closed
+#explicitly, they are closed by a weakref callback when the socket is garbage collected, otherwise libevent would keep
+#the registration for the fd and miss the events of any new socket that reuses the same fd. a __del__ method would
+#make any reference cycle through a socket uncollectable. this holds the weakrefs, so that their callback is also 
+#called when the socket is part of a cycle: id of weakref to socket -> (weakref, edge triggered events of the socket)
+_edge_triggered_events = {}
+
+def _close_edge_triggered_events(ref):
+    ref, events = _edge_triggered_events.pop(id(ref))
+    for event in events:
+        event.close()
+
 class Socket(IOStream):
     log = logging.getLogger('Socket')
     
@@ -30,6 +48,11 @@ class Socket(IOStream):
     STATE_CLOSING = 4
     STATE_CLOSED = 5
     
+    #when edge triggered, the readable and writable events of the socket are registered only once for the
+    #lifetime of the socket and reads and writes are tried first, only waiting for the next edge on EAGAIN.
+    #this is turned on by the -Xedgetriggered cmdline argument
+    edge_triggered = EDGE_TRIGGERED
+    
     def __init__(self, socket, state = STATE_INIT):
         """don't call directly pls use one of the provided classmethod to create a socket"""
         self.socket = socket
@@ -49,6 +72,7 @@ class Socket(IOStream):
         self.fd = self.socket.fileno()
         self._readable = None #will be created lazily
         self._writable = None #will be created lazily
+        self._ref = None #weakref that closes the edge triggered events when the socket is garbage collected
         self.state = state
 
     @classmethod
@@ -78,7 +102,10 @@ class Socket(IOStream):
     
     def _get_readable(self):
         if self._readable is None:
-            self._readable = FileDescriptorEvent(self.fd, 'r')
+            if self.edge_triggered:
+                self._readable = self._edge_triggered_event('r')
+            else:
+                self._readable = FileDescriptorEvent(self.fd, 'r')
         return self._readable
   
     def _set_readable(self, readable):
@@ -88,13 +115,24 @@ class Socket(IOStream):
 
     def _get_writable(self):
         if self._writable is None:
-            self._writable = FileDescriptorEvent(self.fd, 'w')
+            if self.edge_triggered:
+                self._writable = self._edge_triggered_event('w')
+            else:
+                self._writable = FileDescriptorEvent(self.fd, 'w')
         return self._writable
   
     def _set_writable(self, writable):
         self._writable = writable
     
     writable = property(_get_writable, _set_writable)
+
+    def _edge_triggered_event(self, rw):
+        event = EdgeTriggeredFileDescriptorEvent(self.fd, rw)
+        if self._ref is None:
+            self._ref = weakref.ref(self, _close_edge_triggered_events)
+            _edge_triggered_events[id(self._ref)] = (self._ref, [])
+        _edge_triggered_events[id(self._ref)][1].append(event)
+        return event
     
     def fileno(self):
         return self.fd
@@ -116,7 +154,8 @@ class Socket(IOStream):
         while True:
             #we need a loop because sometimes we become readable and still not a valid 
             #connection was accepted, in which case we return here and wait some more.
-            self.readable.wait()
+            if not self.edge_triggered:
+                self.readable.wait()
             try:        
                 s, _ = self.socket.accept()
             except _socket.error, (errno, _):
@@ -124,6 +163,8 @@ class Socket(IOStream):
                     #this can happen when more than one process received readability on the same socket (forked/cloned/dupped)
                     #in that case 1 process will do the accept, the others receive this error, and should continue waiting for
                     #readability 
+                    if self.edge_triggered:
+                        self.readable.wait()
                     continue 
                 else:
                     raise 
@@ -160,6 +201,15 @@ class Socket(IOStream):
         buffer to the socket. The buffer position is updated according to the number of bytes read from it.
         This method could possible write 0 bytes. The method returns the total number of bytes written"""
         assert self.state == self.STATE_CONNECTED, "socket must be connected in order to write to it"        
+        if self.edge_triggered:
+            while True:
+                bytes_written, _ = buffer.send(self.fd) #write to fd from buffer
+                if bytes_written >= 0:
+                    return bytes_written
+                elif _io.get_errno() in [EAGAIN, EWOULDBLOCK]:
+                    self.writable.wait(timeout = timeout)
+                else:
+                    raise _io.error_from_errno(IOError)
         self.writable.wait(timeout = timeout)
         bytes_written, _ = buffer.send(self.fd) #write to fd from buffer
         if bytes_written < 0:
@@ -167,11 +217,63 @@ class Socket(IOStream):
         else:
             return bytes_written
 
+    def writev(self, buffer, parts, offset = 0, timeout = -1.0):
+        """Like :func:`write`, but writes the bytes of the buffer followed by the python strings in *parts* (starting at
+        *offset* in the first part) in a single writev system call. Returns the total number of bytes written."""
+        assert self.state == self.STATE_CONNECTED, "socket must be connected in order to write to it"        
+        if self.edge_triggered:
+            while True:
+                bytes_written, _ = buffer.send(self.fd, parts, offset)
+                if bytes_written >= 0:
+                    return bytes_written
+                elif _io.get_errno() in [EAGAIN, EWOULDBLOCK]:
+                    self.writable.wait(timeout = timeout)
+                else:
+                    raise _io.error_from_errno(IOError)
+        self.writable.wait(timeout = timeout)
+        bytes_written, _ = buffer.send(self.fd, parts, offset)
+        if bytes_written < 0:
+            raise _io.error_from_errno(IOError)
+        else:
+            return bytes_written
+
+    def sendfile(self, fileno, offset, count, timeout = -1.0):
+        """Sends *count* bytes starting at *offset* of the file with descriptor *fileno* to the socket using the sendfile 
+        system call, so that the data does not need to be copied trough userspace. Blocks till all bytes are sent or the end of the
+        file is reached. Returns the number of bytes sent. Raises IOError (ENOSYS) if sendfile is not available on this platform."""
+        assert self.state == self.STATE_CONNECTED, "socket must be connected in order to write to it"        
+        total = 0
+        while count > 0:
+            if not self.edge_triggered:
+                self.writable.wait(timeout = timeout)
+            bytes_written = _io.sendfile(self.fd, fileno, offset, count)
+            if bytes_written < 0:
+                if _io.get_errno() in [EAGAIN, EWOULDBLOCK]:
+                    if self.edge_triggered:
+                        self.writable.wait(timeout = timeout)
+                    continue
+                raise _io.error_from_errno(IOError)
+            elif bytes_written == 0:
+                break #end of file
+            total += bytes_written
+            offset += bytes_written
+            count -= bytes_written
+        return total
+
     def read(self, buffer, timeout = -1.0):
         """Blocks till socket becomes readable and then reads as many bytes as possible the socket into the given
         buffer. The buffer position is updated according to the number of bytes read from the socket.
         This method could possible read 0 bytes. The method returns the total number of bytes read"""
         assert self.state == self.STATE_CONNECTED, "socket must be connected in order to read from it"
+        if self.edge_triggered:
+            while True:
+                bytes_read, _ = buffer.recv(self.fd) #read from fd to 
+                if bytes_read >= 0:
+                    return bytes_read
+                elif _io.get_errno() in [EAGAIN, EWOULDBLOCK]:
+                    self.readable.wait(timeout = timeout)
+                else:
+                    raise _io.error_from_errno(IOError)
         self.readable.wait(timeout = timeout)
         bytes_read, _ = buffer.recv(self.fd) #read from fd to 
         if bytes_read < 0:
@@ -181,13 +283,30 @@ class Socket(IOStream):
 
     def write_socket(self, socket, timeout = -1):
         """writes a socket trough this socket"""
+        if self.edge_triggered:
+            while _io.msgsendfd(self.fd, socket.fd) < 0:
+                if _io.get_errno() in [EAGAIN, EWOULDBLOCK]:
+                    self.writable.wait(timeout = timeout)
+                else:
+                    raise _io.error_from_errno(IOError)
+            return
         self.writable.wait(timeout = timeout)
         _io.msgsendfd(self.fd, socket.fd)
         
     def read_socket(self, socket_class = None, socket_family =  _socket.AF_INET, socket_type = _socket.SOCK_STREAM, socket_state = STATE_INIT, timeout = -1):
         """reads a socket from this socket"""
-        self.readable.wait(timeout = timeout)
-        fd = _io.msgrecvfd(self.fd)
+        if self.edge_triggered:
+            while True:
+                fd = _io.msgrecvfd(self.fd)
+                if fd >= 0:
+                    break
+                elif _io.get_errno() in [EAGAIN, EWOULDBLOCK]:
+                    self.readable.wait(timeout = timeout)
+                else:
+                    raise _io.error_from_errno(IOError)
+        else:
+            self.readable.wait(timeout = timeout)
+            fd = _io.msgrecvfd(self.fd)
         return (socket_class or self.__class__).from_file_descriptor(fd, socket_family, socket_type, socket_state)        
                    
     def is_closed(self):
@@ -200,6 +319,9 @@ class Socket(IOStream):
             self._readable.close()
         if self._writable is not None:
             self._writable.close()
+        if self._ref is not None:
+            del _edge_triggered_events[id(self._ref)]
+            self._ref = None
         self.socket.close()          
         del self.socket
         del self._readable
@@ -279,7 +401,149 @@ class SocketServer(object):
     def close(self):
         self._accept_task.kill()
         self._socket.close()
+
+#SO_REUSEPORT is not exported by the _socket module of older pythons
+if hasattr(_socket, 'SO_REUSEPORT'):
+    SO_REUSEPORT = _socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15 #needs linux 3.9 or newer
+else:
+    SO_REUSEPORT = None
+
+class PreforkServer(object):
+    """Runs a concurrence server in several processes that all accept on the same address.
+    
+    The supervisor (the process calling :func:`serve`) binds the listening socket once and then forks *workers* 
+    (default: one per cpu) processes. Each worker re-initializes libevent and runs a dispatcher calling 
+    *f* with the listening :class:`Socket`. Workers that exit are restarted. The supervisor itself never dispatches;
+    SIGINT or SIGTERM stops the workers and makes :func:`serve` return.
+    
+    If *reuse_port* is set and the OS supports SO_REUSEPORT, every worker listens on a socket of its own bound
+    to the same address, so that the kernel spreads new connections evenly over the workers. Otherwise all workers
+    accept from the single shared listening socket (see the EAGAIN handling in :func:`Socket.accept`).
+    
+    Usage::
+    
+        def main(socket):
+            WSGIServer(application).serve(socket)
+            
+        PreforkServer(('0.0.0.0', 8080)).serve(main)
+    """
+    log = logging.getLogger('PreforkServer')
+
+    restart_delay = 1.0 #seconds to wait before restarting a worker that died right after being started
+    
+    def __init__(self, endpoint, workers = None, reuse_port = True, backlog = DEFAULT_BACKLOG):
+        self._endpoint = endpoint
+        self._workers = workers or self.cpu_count()
+        self._reuse_port = reuse_port and SO_REUSEPORT is not None and type(endpoint) != types.StringType
+        self._backlog = backlog
+        self._socket = None
+        self._pids = {} #pid -> start time
+        self._running = False
         
+    @classmethod
+    def cpu_count(cls):
+        try:
+            return os.sysconf('SC_NPROCESSORS_ONLN')
+        except (ValueError, OSError, AttributeError):
+            return 1
         
+    @property
+    def pids(self):
+        """the process ids of the currently running workers"""
+        return self._pids.keys()
+    
+    def _create_socket(self):
+        socket = Socket.from_address(self._endpoint)
+        socket.set_reuse_address(True)
+        if self._reuse_port:
+            socket.socket.setsockopt(_socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        socket.bind(self._endpoint)
+        return socket
+    
+    def _worker(self, f):
+        _event.reinit()
+        if self._reuse_port:
+            #the supervisors socket is only bound, it never listens and thus never gets any connections
+            self._socket.socket.close()
+            socket = self._create_socket()
+        else:
+            socket = self._socket
+        socket.listen(self._backlog)
+        dispatch(lambda: f(socket))
         
+    def _spawn(self, f):
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self._worker(f)
+                exitcode = 0
+            except SystemExit, e:
+                #like the interpreter does, any exit code that is not an integer (e.g. sys.exit("message")) becomes 1
+                if e.code is None:
+                    exitcode = 0
+                elif isinstance(e.code, (int, long)):
+                    exitcode = e.code
+                else:
+                    self.log.error("prefork worker exited: %s", e.code)
+            except:
+                self.log.exception("unhandled exception in prefork worker")
+            os._exit(exitcode)
+        self._pids[pid] = time.time()
+        self.log.info("started worker %d", pid)
+        return pid
+
+    def _stop(self, signum, frame):
+        self._running = False
         
+    def serve(self, f):
+        """binds the socket and runs *f* in each of the workers, blocks until the supervisor receives SIGINT or SIGTERM"""
+        self._socket = self._create_socket()
+        if not self._reuse_port:
+            self._socket.listen(self._backlog)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self._running = True
+        try:
+            for _ in range(self._workers):
+                self._spawn(f)
+            while self._running:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError, e:
+                    if e.errno == EINTR:
+                        continue
+                    raise
+                started = self._pids.pop(pid, None)
+                if started is None:
+                    continue
+                self.log.warn("worker %d exited with status %d", pid, status)
+                if self._running:
+                    if time.time() - started < self.restart_delay:
+                        time.sleep(self.restart_delay) #don't restart crashing workers in a tight loop
+                    self._spawn(f)
+        finally:
+            self.close()
+
+    def close(self):
+        """stops all workers and closes the listening socket"""
+        self._running = False
+        for pid in self._pids.keys():
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+        for pid in self._pids.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._pids.clear()
+        if self._socket is not None:
+            self._socket.socket.close()
+            self._socket = None
+
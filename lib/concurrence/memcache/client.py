@@ -3,24 +3,24 @@
 # This module is part of the Concurrence Framework and is released under
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
 
-from concurrence import Tasklet, Channel, TaskletError
+from __future__ import with_statement
+
+from concurrence import Tasklet, Channel, TaskletError, JoinError, TimeoutError
 from concurrence.timer import Timeout
 from concurrence.io.socket import Socket
+from concurrence.io import Buffer, BufferUnderflowError
 from concurrence.io.buffered import BufferedStream
 from concurrence.containers.deque import Deque
+from concurrence.memcache.ketama import Ketama
+from concurrence.memcache.codec import DefaultCodec
+from concurrence.memcache._memcache import pack_request, pack_getkq, packet_length, read_response
 
-import cPickle as pickle
+import time
+import struct
+import logging
 
-#TODO async set
-#proper buffer sizes
-#bundling of multiple requests in 1 flush
+#TODO proper buffer sizes
 #statistics
-#not use pickle for string and unicode types (use flags to indicate this)
-#timeout on commands (for clients, support Timeout.current)
-#plugable serialization support (and/or provide choise, default (py-serialized, utf-8 encoded json, etc)?
-#todo detect timeouts on write/read, and mark host as dead
-#keep some time before retrying host
-#global consistent hashing algorithm for accessing set of memcached servers
 
 #rename MemcacheNode to MemcacheConnection.
 #first, there will be max 1 connection to each host in the system
@@ -28,71 +28,217 @@ import cPickle as pickle
 class MemcacheError(Exception):
     pass
 
+#results of storage and delete commands
+_RESULTS = {'STORED': True, 'NOT_STORED': False, 'EXISTS': False, 'NOT_FOUND': False, 'DELETED': True}
+
+def _send(channel, value):
+    """sends *value* to the task waiting on *channel*, unless it stopped waiting because its command timed out"""
+    if channel.has_receiver():
+        channel.send(value)
+
+def _send_exception(channel, exception):
+    if channel.has_receiver():
+        channel.send_exception(TaskletError, exception, Tasklet.current())
+
+class _CoalescedGet(object):
+    """a single multi-key get command on behalf of one or more waiting tasks"""
+    def __init__(self):
+        self.keys = []
+        self._keyset = set()
+        self._waiters = []
+        
+    def add_key(self, key):
+        if key not in self._keyset:
+            self._keyset.add(key)
+            self.keys.append(key)
+
+    def add_waiter(self, keys, block_channel):
+        self._waiters.append((keys, block_channel))
+
+    def send(self, result):
+        for keys, block_channel in self._waiters:
+            _send(block_channel, dict([(key, result[key]) for key in keys if key in result]))
+
+    def send_exception(self, exception):
+        for keys, block_channel in self._waiters:
+            _send_exception(block_channel, exception)
+
 class MemcacheNode(object):
     """this represents the connection/protocol to 1 memcached host
     this class supports concurrent usage of get/set methods by multiple
     tasks, the cmds are queued and performed in order agains the memcached host.    
+    all cmds queued at the same time are written with a single flush, consecutive gets are coalesced into
+    a single multi-key get, and a get of keys that are already being fetched waits for the result of that fetch.
+
+    Every command waits at most *timeout* seconds for its result (or less, if the current :class:`~concurrence.timer.Timeout`
+    is shorter), after which :class:`~concurrence.core.TimeoutError` is raised. The answer of the server to a command that
+    timed out is discarded. After *max_timeouts* consecutive timeouts, or when the connection fails, the connection is closed 
+    and the commands waiting on it fail. The node then reconnects on the next command, but not before a backoff time that 
+    starts at *backoff* seconds and doubles on every consecutive failure up to *max_backoff* seconds. Until then commands fail 
+    immediately with :class:`MemcacheError`, so that a dead or slow server does not hold up the tasks that use it.
     """
-    def __init__(self):
+    log = logging.getLogger('MemcacheNode')
+
+    def __init__(self, codec = None, timeout = -1, connect_timeout = 1.0, max_timeouts = 3, backoff = 0.1, max_backoff = 30.0):
+        """*codec* is the :class:`~concurrence.memcache.codec.MemcacheCodec` used to encode and decode values, by default
+        a :class:`~concurrence.memcache.codec.DefaultCodec`. The default *timeout* of -1 leaves it to the current 
+        :class:`~concurrence.timer.Timeout`."""
         self._stream = None
+        self._codec = codec or DefaultCodec()
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._max_timeouts = max_timeouts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._addr = None
+        self._timeouts = 0 #consecutive commands that timed out
+        self._failures = 0 #consecutive connection failures
+        self._retry_time = 0 #no reconnect before this time
 
     def connect(self, addr):
         assert self._stream is None, "must not be disconneted before connecting"
-        self._stream = BufferedStream(Socket.connect(addr, Timeout.current()))
+        self._addr = addr
+        try:
+            self._stream = BufferedStream(Socket.connect(addr, Timeout.current()))
+        except TaskletExit:
+            raise
+        except Exception, e:
+            self._failed(e)
+            raise
+        self._timeouts = 0
         self._command_queue = Deque()
         self._response_queue = Deque()
+        self._inflight = {} #key -> the get in flight for key, only for gets written after the last modification
         self._command_writer_task = Tasklet.new(self._command_writer)()
         self._response_reader_task = Tasklet.new(self._response_reader)()
 
     def _read_response(self, reader):
-        cmd, block_channel = self._response_queue.popleft(True)
+        cmd, waiter = self._response_queue.popleft(True)
         try:
-            if cmd == 'get':
+            response_line = reader.read_line()
+            if cmd == 'get' or cmd == 'gets':
                 result = {} #we will gather 'get' results here
-            else:
-                result = True
-            while True:
-                response_line = reader.read_line()
-                if cmd == 'get' and response_line.startswith('VALUE'):
+                while response_line.startswith('VALUE'):
                     response_fields = response_line.split(' ')
                     key = response_fields[1]
                     flags = int(response_fields[2])
                     n = int(response_fields[3])
                     encoded_value = reader.read_bytes(n)
                     reader.read_line() #\r\n
-                    result[key] = pickle.loads(encoded_value)
-                elif cmd == 'get' and response_line == 'END':
-                    block_channel.send(result)
-                    break                            
-                elif cmd == 'set' and response_line == 'STORED':
-                    block_channel.send(result)
-                    break        
+                    value = self._codec.decode(encoded_value, flags)
+                    if cmd == 'gets':
+                        value = (value, int(response_fields[4]))
+                    result[key] = value
+                    response_line = reader.read_line()
+                if response_line == 'END':
+                    if cmd == 'get':
+                        self._end_get(waiter)
+                        waiter.send(result)
+                    else:
+                        _send(waiter, result)
+                    return
+            elif cmd == 'incr' or cmd == 'decr':
+                if response_line.isdigit():
+                    _send(waiter, int(response_line))
+                    return
+                elif response_line == 'NOT_FOUND':
+                    _send(waiter, None)
+                    return
+            elif response_line in _RESULTS:
+                _send(waiter, _RESULTS[response_line])
+                return
+            if response_line == 'ERROR' or response_line.startswith('CLIENT_ERROR') or response_line.startswith('SERVER_ERROR'):
+                #the command failed, but the connection is fine
+                if cmd == 'get':
+                    self._end_get(waiter)
+                    waiter.send_exception(MemcacheError(response_line))
                 else:
-                    assert False, "unknown protocol state, cmd: %s, response_line: %s" % (cmd, response_line)
-        except Exception, e:
-            block_channel.send_exception(TaskletError, e, Tasklet.current())
+                    _send_exception(waiter, MemcacheError(response_line))
+                return
+            assert False, "unknown protocol state, cmd: %s, response_line: %s" % (cmd, response_line)
+        except:
+            #the command fails with the other waiting commands when the connection is closed,
+            #also when this task is killed by the disconnect
+            self._response_queue.appendleft((cmd, waiter))
             raise 
 
+    def _end_get(self, get):
+        """*get* is no longer in flight"""
+        for key in get.keys:
+            if self._inflight.get(key, None) is get:
+                del self._inflight[key]
+
+    def _inflight_get(self, keys):
+        """returns the get that is in flight for all of *keys*, if any"""
+        inflight = self._inflight.get(keys[0], None)
+        if inflight is not None:
+            for key in keys:
+                if self._inflight.get(key, None) is not inflight:
+                    return None
+        return inflight
+        
+    def _coalesce_get(self, gets, keys, block_channel):
+        """adds a get of *keys* to the get that is being written, *gets*, which is returned"""
+        if gets is None:
+            gets = _CoalescedGet()
+        gets.add_waiter(keys, block_channel)
+        for key in keys:
+            gets.add_key(key)
+            if key not in self._inflight:
+                self._inflight[key] = gets
+        return gets
+
+    def _write_get(self, writer, get):
+        writer.write_bytes("get %s\r\n" % ' '.join(get.keys))
+
     def _write_command(self, writer):
+        #all commands that are queued now are written together with a single flush
+        commands = [self._command_queue.popleft(True)]
+        responses = []
+        attached = [] #waiters added to a get that was already written
         try:
-            cmd, args, block_channel = self._command_queue.popleft(True)
+            #let the other tasks that are runnable queue their commands first
+            Tasklet.yield_()
+            while self._command_queue:
+                commands.append(self._command_queue.popleft())
+            gets = None #consecutive gets are coalesced into a single multi-key get
+            for cmd, args, block_channel in commands:
+                if block_channel is not None and not block_channel.has_receiver():
+                    continue #timed out while queued, the command is not sent
+                if cmd == 'get':
+                    inflight = self._inflight_get(args)
+                    if inflight is not None:
+                        #the same keys are being fetched already, the waiter gets the result of that
+                        inflight.add_waiter(args, block_channel)
+                        attached.append(block_channel)
+                        continue
+                    previous = gets
+                    gets = self._coalesce_get(gets, args, block_channel)
+                    if gets is not previous:
+                        responses.append(('get', gets, None))
+                    continue
+                gets = None
+                if cmd != 'gets':
+                    #a get written after a modification must not be answered by a get that was written before it
+                    self._inflight.clear()
+                responses.append((cmd, block_channel, args))
             writer.clear()
-            if cmd == 'get':
-                writer.write_bytes("get")
-                for key in args[0]:
-                    writer.write_bytes(" " + key)
-            elif cmd in ['set']:
-                key, value, flags = args           
-                encoded_value = pickle.dumps(value, -1)
-                writer.write_bytes("%s %s %d 0 %d\r\n" % (cmd, key, flags, len(encoded_value)))
-                writer.write_bytes(encoded_value)
-            else:
-                assert False, "unknown command %s" % cmd
-            writer.write_bytes('\r\n')
+            for cmd, waiter, data in responses:
+                if cmd == 'get':
+                    self._write_get(writer, waiter)
+                else:
+                    for part in data:
+                        writer.write_bytes(part)
             writer.flush()
-            self._response_queue.append((cmd, block_channel))
-        except Exception, e:
-            block_channel.send_exception(TaskletError, e, Tasklet.current())
+            for cmd, waiter, _ in responses:
+                if waiter is not None: #None for noreply commands
+                    self._response_queue.append((cmd, waiter))
+        except:
+            #the commands fail with the other waiting commands when the connection is closed,
+            #also when this task is killed by the disconnect
+            for command in reversed(commands):
+                if command[2] not in attached:
+                    self._command_queue.appendleft(command)
             raise
 
     def _response_reader(self):
@@ -101,7 +247,7 @@ class MemcacheNode(object):
             try:
                 self._read_response(reader)
             except Exception, e:
-                self.close(e, False, True)
+                self._fail(e, False, True)
                 return #this ends reader
             
     def _command_writer(self):
@@ -110,37 +256,140 @@ class MemcacheNode(object):
             try:
                 self._write_command(writer)
             except Exception, e:
-                self.close(e, True, False)
+                self._fail(e, True, False)
                 return #this ends writer
 
-    def _do_command(self, cmd, *args):
+    def _reconnect(self):
+        if self._addr is None:
+            raise MemcacheError("not connected")
+        if time.time() < self._retry_time:
+            raise MemcacheError("memcache server %s:%d is down, not retrying for %.1f seconds" % 
+                                (self._addr[0], self._addr[1], self._retry_time - time.time()))
+        try:
+            with Timeout.push(self._connect_timeout):
+                self.connect(self._addr)
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise MemcacheError("could not reconnect to memcache server %s:%d: %s" % (self._addr[0], self._addr[1], e))
+
+    def _failed(self, exception):
+        """opens the circuit, no reconnect is tried until the backoff time has passed"""
+        self._failures += 1
+        backoff = min(self._backoff * (2 ** (self._failures - 1)), self._max_backoff)
+        self._retry_time = time.time() + backoff
+        self.log.warning("memcache server %s:%d failed, not retrying for %.1f seconds: %s", self._addr[0], self._addr[1], 
+                         backoff, exception)
+
+    def _timed_out(self):
+        self._timeouts += 1
+        if self._timeouts >= self._max_timeouts and self._stream is not None:
+            self._fail(TimeoutError("%d consecutive commands timed out" % self._timeouts))
+
+    def _do_command(self, cmd, args, noreply = False):
+        if self._stream is None:
+            self._reconnect()
+        if noreply:
+            self._command_queue.append((cmd, args, None))
+            return None
         block_channel = Channel()
         self._command_queue.append((cmd, args, block_channel))
         try:
-            return block_channel.receive()
+            with Timeout.push(self._timeout):
+                result = block_channel.receive(Timeout.current())
         except TaskletError, e:
             raise MemcacheError(str(e.cause))
+        except TimeoutError:
+            self._timed_out()
+            raise
+        self._timeouts = 0
+        self._failures = 0
+        return result
+
+    def is_connected(self):
+        return self._stream is not None
 
-    def close(self, exception = None, kill_reader = True, kill_writer = True):
-        #assert False, reason
+    def _fail(self, exception, kill_reader = True, kill_writer = True):
+        self._failed(exception)
+        self._disconnect(exception, kill_reader, kill_writer)
+
+    def _disconnect(self, exception, kill_reader = True, kill_writer = True):
         if kill_reader:     
             self._response_reader_task.kill()
         if kill_writer:
             self._command_writer_task.kill()
         self._response_reader_task = None
         self._command_writer_task = None
-        #raise exception on all waiting tasks still in the queues
-        for cmd, args, block_channel in self._command_queue:
-            block_channel.send_exception(TaskletError, e, Tasklet.current())
-        for cmd, block_channel in self._response_queue:
-            block_channel.send_exception(TaskletError, e, Tasklet.current())
+        command_queue, response_queue = self._command_queue, self._response_queue
         self._command_queue = None
         self._response_queue = None
+        self._inflight = {}
         self._stream.close()
         self._stream = None
+        #raise exception on all waiting tasks still in the queues
+        for cmd, args, block_channel in command_queue:
+            if block_channel is not None:
+                _send_exception(block_channel, exception)
+        for cmd, block_channel in response_queue:
+            if cmd == 'get':
+                block_channel.send_exception(exception)
+            else:
+                _send_exception(block_channel, exception)
+
+    def close(self):
+        """Closes the connection, commands that are still waiting fail and the node does not reconnect."""
+        if self._stream is not None:
+            self._disconnect(MemcacheError("connection closed"))
+        self._addr = None
         
-    def set(self, key, data, flags = 0):
-        self._do_command("set", key, data, flags)
+    def _store(self, cmd, key, value, expiration, noreply, cas_unique = None):
+        encoded_value, flags = self._codec.encode(value)
+        if cas_unique is None:
+            line = "%s %s %d %d %d" % (cmd, key, flags, expiration, len(encoded_value))
+        else:
+            line = "%s %s %d %d %d %d" % (cmd, key, flags, expiration, len(encoded_value), cas_unique)
+        if noreply:
+            line += " noreply"
+        return self._do_command(cmd, (line + "\r\n", encoded_value, "\r\n"), noreply)
+
+    def set(self, key, value, expiration = 0, noreply = False):
+        """Stores *value* under *key*. *expiration* is the time to live in seconds (or an absolute unix time, 0 means never). 
+        Returns True, or None if *noreply* is True, in which case this method does not wait for the server to answer."""
+        return self._store("set", key, value, expiration, noreply)
+
+    def add(self, key, value, expiration = 0, noreply = False):
+        """Stores *value* only if *key* does not exist yet. Returns True if stored, False otherwise."""
+        return self._store("add", key, value, expiration, noreply)
+
+    def replace(self, key, value, expiration = 0, noreply = False):
+        """Stores *value* only if *key* already exists. Returns True if stored, False otherwise."""
+        return self._store("replace", key, value, expiration, noreply)
+
+    def append(self, key, value, noreply = False):
+        """Appends *value* to the value of an existing *key*. Returns True if stored, False otherwise."""
+        return self._store("append", key, value, 0, noreply)
+
+    def prepend(self, key, value, noreply = False):
+        """Prepends *value* to the value of an existing *key*. Returns True if stored, False otherwise."""
+        return self._store("prepend", key, value, 0, noreply)
+
+    def cas(self, key, value, cas_unique, expiration = 0, noreply = False):
+        """Stores *value* only if *key* was not changed since :func:`gets` returned *cas_unique* for it. Returns True if stored, 
+        False otherwise."""
+        return self._store("cas", key, value, expiration, noreply, cas_unique)
+
+    def delete(self, key, noreply = False):
+        """Deletes *key*. Returns True if it existed, False otherwise."""
+        return self._do_command("delete", ("delete %s%s\r\n" % (key, noreply and " noreply" or ""),), noreply)
+
+    def incr(self, key, value = 1, noreply = False):
+        """Increments the integer value of *key* by *value*. Returns the new value, or None if *key* does not exist."""
+        return self._do_command("incr", ("incr %s %d%s\r\n" % (key, value, noreply and " noreply" or ""),), noreply)
+
+    def decr(self, key, value = 1, noreply = False):
+        """Decrements the integer value of *key* by *value* (but not below 0). Returns the new value, or None if *key* does not 
+        exist."""
+        return self._do_command("decr", ("decr %s %d%s\r\n" % (key, value, noreply and " noreply" or ""),), noreply)
 
     def _get_one(self, key):
         result = self._do_command("get", [key])
@@ -150,9 +399,308 @@ class MemcacheNode(object):
             return None
 
     def get(self, keys):
+        """Gets the value of a single key, or None if it does not exist. If *keys* is a list, a dictionary with the values 
+        of the keys that exist is returned."""
         if type(keys) == str:
             return self._get_one(keys)
+        elif not keys:
+            return {}
         else:
             return self._do_command("get", keys)
-            
+
+    def gets(self, keys):
+        """As :func:`get`, but returns tuples (value, cas_unique), for use with :func:`cas`."""
+        if type(keys) == str:
+            return self._do_command("gets", ("gets %s\r\n" % keys,)).get(keys, None)
+        elif not keys:
+            return {}
+        else:
+            return self._do_command("gets", ("gets %s\r\n" % ' '.join(keys),))
+
+#binary protocol opcodes
+OPCODE_GET = 0x00
+OPCODE_SET = 0x01
+OPCODE_ADD = 0x02
+OPCODE_REPLACE = 0x03
+OPCODE_DELETE = 0x04
+OPCODE_INCREMENT = 0x05
+OPCODE_DECREMENT = 0x06
+OPCODE_NOOP = 0x0a
+OPCODE_GETKQ = 0x0d
+OPCODE_APPEND = 0x0e
+OPCODE_PREPEND = 0x0f
+
+_OPCODES = {'set': OPCODE_SET, 'cas': OPCODE_SET, 'add': OPCODE_ADD, 'replace': OPCODE_REPLACE, 'append': OPCODE_APPEND, 
+            'prepend': OPCODE_PREPEND, 'delete': OPCODE_DELETE, 'incr': OPCODE_INCREMENT, 'decr': OPCODE_DECREMENT}
+
+#the quiet version of a command, only answered on failure
+_QUIET_OPCODES = {OPCODE_SET: 0x11, OPCODE_ADD: 0x12, OPCODE_REPLACE: 0x13, OPCODE_DELETE: 0x14, OPCODE_INCREMENT: 0x15,
+                  OPCODE_DECREMENT: 0x16, OPCODE_APPEND: 0x19, OPCODE_PREPEND: 0x1a}
+_QUIET = set(_QUIET_OPCODES.values())
+
+#binary protocol status codes
+STATUS_OK = 0x00
+STATUS_KEY_NOT_FOUND = 0x01
+STATUS_KEY_EXISTS = 0x02
+STATUS_ITEM_NOT_STORED = 0x05
+
+class MemcacheBinaryNode(MemcacheNode):
+    """A :class:`MemcacheNode` that speaks the binary memcached protocol. Packets are packed and parsed by the
+    :mod:`concurrence.memcache._memcache` extension, and a multi-key get is sent as a pipeline of quiet gets (getkq) 
+    followed by a noop, so that the server only sends back the keys it has."""
+
+    def _store(self, cmd, key, value, expiration, noreply, cas_unique = None):
+        encoded_value, flags = self._codec.encode(value)
+        if cmd == 'append' or cmd == 'prepend':
+            extras = ''
+        else:
+            extras = struct.pack('!II', flags, expiration)
+        return self._do_command(cmd, (self._pack(cmd, noreply, key, extras, encoded_value, cas_unique or 0),), noreply)
+
+    def _pack(self, cmd, noreply, key, extras = '', value = '', cas_unique = 0):
+        opcode = _OPCODES[cmd]
+        if noreply:
+            opcode = _QUIET_OPCODES[opcode]
+        return pack_request(opcode, key, extras, value, 0, cas_unique)
+        
+    def delete(self, key, noreply = False):
+        return self._do_command("delete", (self._pack("delete", noreply, key),), noreply)
+
+    def incr(self, key, value = 1, noreply = False):
+        #an expiration of 0xffffffff means that a missing key is not created
+        return self._do_command("incr", (self._pack("incr", noreply, key, struct.pack('!QQI', value, 0, 0xffffffff)),), noreply)
+
+    def decr(self, key, value = 1, noreply = False):
+        return self._do_command("decr", (self._pack("decr", noreply, key, struct.pack('!QQI', value, 0, 0xffffffff)),), noreply)
+
+    def gets(self, keys):
+        if type(keys) == str:
+            return self._do_command("gets", (pack_getkq([keys]),)).get(keys, None)
+        elif not keys:
+            return {}
+        else:
+            return self._do_command("gets", (pack_getkq(keys),))
+
+    def _write_get(self, writer, get):
+        writer.write_bytes(pack_getkq(get.keys))
+
+    def _read_packet(self, reader):
+        buffer = reader.buffer
+        while True:
+            try:
+                return read_response(buffer)
+            except BufferUnderflowError:
+                n = packet_length(buffer)
+                if n > buffer.capacity:
+                    #the packet does not fit in the read buffer
+                    packet = Buffer(n)
+                    packet.write_bytes(reader.read_bytes(n))
+                    packet.flip()
+                    return read_response(packet)
+                reader._read_more()
+
+    def _failed_quietly(self, opcode, status, message):
+        self.log.warning("memcache noreply command (opcode: 0x%02x) failed: %d, %s", opcode, status, message)
+        
+    def _read_response(self, reader):
+        cmd, waiter = self._response_queue.popleft(True)
+        try:
+            if cmd == 'get' or cmd == 'gets':
+                result = {}
+                while True:
+                    opcode, status, cas, flags, key, value = self._read_packet(reader)
+                    if opcode == OPCODE_NOOP:
+                        break
+                    elif opcode == OPCODE_GETKQ and status == STATUS_OK:
+                        value = self._codec.decode(value, flags)
+                        if cmd == 'gets':
+                            value = (value, cas)
+                        result[key] = value
+                    else:
+                        self._failed_quietly(opcode, status, value)
+                if cmd == 'get':
+                    self._end_get(waiter)
+                    waiter.send(result)
+                else:
+                    _send(waiter, result)
+                return
+            while True:
+                opcode, status, cas, flags, key, value = self._read_packet(reader)
+                if opcode not in _QUIET:
+                    break
+                self._failed_quietly(opcode, status, value)
+            if status == STATUS_OK:
+                if cmd == 'incr' or cmd == 'decr':
+                    _send(waiter, int(struct.unpack('!Q', value)[0]))
+                else:
+                    _send(waiter, True)
+            elif status in (STATUS_KEY_NOT_FOUND, STATUS_KEY_EXISTS, STATUS_ITEM_NOT_STORED):
+                if cmd == 'incr' or cmd == 'decr':
+                    _send(waiter, None)
+                else:
+                    _send(waiter, False)
+            else:
+                #the command failed, but the connection is fine
+                _send_exception(waiter, MemcacheError("%d, %s" % (status, value)))
+        except:
+            #the command fails with the other waiting commands when the connection is closed,
+            #also when this task is killed by the disconnect
+            self._response_queue.appendleft((cmd, waiter))
+            raise 
+
+class MemcacheClient(object):
+    """A client for a cluster of memcached servers. Keys are distributed over the servers using ketama consistent hashing, with
+    a single :class:`MemcacheNode` connection to each server.
+    
+    A server whose connection fails, or that does not answer *timeout* seconds after a command for a number of consecutive 
+    commands, is ejected from the continuum, its keys move to the other servers until it is retried after *retry_interval* 
+    seconds. A get of keys on a failed or slow server returns them as missing, other commands raise :class:`MemcacheError`.
+    The node of a failed server is kept, when the server is retried it reconnects with the backoff of :class:`MemcacheNode`,
+    so that a server that is down is not dialled on every command.
+    The commands are those of :class:`MemcacheNode`.
+    
+    Usage::
+    
+        client = MemcacheClient([('10.0.0.1', 11211), ('10.0.0.2', 11211)])
+        client.set('foo', 'bar')
+        print client.get(['foo', 'baz'])
+    """
+    log = logging.getLogger('MemcacheClient')
+    
+    def __init__(self, servers, connect_timeout = 1.0, retry_interval = 30.0, codec = None, protocol = 'text', timeout = 1.0):
+        """*servers* is a list of addresses (host, port), or of tuples (address, weight) to give servers different weights. 
+        *codec* is passed on to the :class:`MemcacheNode` connections. *protocol* is either 'text' or 'binary'."""
+        self._servers = []
+        for server in servers:
+            if type(server[0]) == tuple:
+                self._servers.append(server)
+            else:
+                self._servers.append((server, 1))
+        self._connect_timeout = connect_timeout
+        self._retry_interval = retry_interval
+        self._timeout = timeout
+        self._codec = codec
+        self._node_class = {'text': MemcacheNode, 'binary': MemcacheBinaryNode}[protocol]
+        self._nodes = {} #address -> MemcacheNode
+        self._dead = {} #address -> time after which the server is retried
+        self._retry_time = None #earliest retry time of the dead servers
+        self._continuum = Ketama()
+        self._update_continuum()
+        
+    def _update_continuum(self):
+        self._continuum.update([(addr, weight) for addr, weight in self._servers if addr not in self._dead])
+        if self._dead:
+            self._retry_time = min(self._dead.values())
+        else:
+            self._retry_time = None
+
+    def _server(self, key):
+        if self._retry_time is not None and time.time() >= self._retry_time:
+            now = time.time()
+            for addr, retry_time in self._dead.items():
+                if now >= retry_time:
+                    self.log.info("retrying memcache server %s:%d", *addr)
+                    del self._dead[addr]
+            self._update_continuum()
+        addr = self._continuum.get_server(key)
+        if addr is None:
+            raise MemcacheError("no memcache servers available")
+        return addr
+    
+    def _node(self, addr):
+        node = self._nodes.get(addr, None)
+        if node is None:
+            #the node is kept when its connection fails, it reconnects by itself with a backoff
+            node = self._node_class(self._codec, self._timeout, self._connect_timeout)
+            self._nodes[addr] = node
+            with Timeout.push(self._connect_timeout):
+                node.connect(addr)
+        return node
+    
+    def _eject(self, addr, exception):
+        self.log.warning("ejecting memcache server %s:%d for %.1f seconds: %s", addr[0], addr[1], self._retry_interval, exception)
+        self._dead[addr] = time.time() + self._retry_interval
+        self._update_continuum()
+    
+    def _command(self, addr, cmd, *args, **kwargs):
+        node = None
+        try:
+            node = self._node(addr)
+            return getattr(node, cmd)(*args, **kwargs)
+        except TaskletExit:
+            raise
+        except Exception, e:
+            #an error answer or a single timeout does not eject the server, a failed connection does
+            if (node is None or not node.is_connected()) and addr not in self._dead:
+                self._eject(addr, e)
+            if isinstance(e, MemcacheError):
+                raise
+            raise MemcacheError(str(e))
+        
+    def set(self, key, value, expiration = 0, noreply = False):
+        return self._command(self._server(key), 'set', key, value, expiration, noreply)
+
+    def add(self, key, value, expiration = 0, noreply = False):
+        return self._command(self._server(key), 'add', key, value, expiration, noreply)
+
+    def replace(self, key, value, expiration = 0, noreply = False):
+        return self._command(self._server(key), 'replace', key, value, expiration, noreply)
+
+    def append(self, key, value, noreply = False):
+        return self._command(self._server(key), 'append', key, value, noreply)
+
+    def prepend(self, key, value, noreply = False):
+        return self._command(self._server(key), 'prepend', key, value, noreply)
+
+    def cas(self, key, value, cas_unique, expiration = 0, noreply = False):
+        return self._command(self._server(key), 'cas', key, value, cas_unique, expiration, noreply)
+
+    def delete(self, key, noreply = False):
+        return self._command(self._server(key), 'delete', key, noreply)
+
+    def incr(self, key, value = 1, noreply = False):
+        return self._command(self._server(key), 'incr', key, value, noreply)
+
+    def decr(self, key, value = 1, noreply = False):
+        return self._command(self._server(key), 'decr', key, value, noreply)
+
+    def gets(self, key):
+        """Gets (value, cas_unique) of a single *key*, see :func:`MemcacheNode.gets`."""
+        return self._command(self._server(key), 'gets', key)
+
+    def _get_server(self, addr, keys):
+        try:
+            return self._command(addr, 'get', keys)
+        except MemcacheError:
+            return {}
+        
+    def get(self, keys):
+        """Gets a single key, or a list of *keys* in which case a dictionary with the values found is returned. The keys are 
+        fetched in parallel from the servers they map to."""
+        if type(keys) == str:
+            addr = self._server(keys)
+            return self._get_server(addr, [keys]).get(keys, None)
+        
+        per_server = {}
+        for key in keys:
+            per_server.setdefault(self._server(key), []).append(key)
+        
+        if len(per_server) == 1:
+            addr, keys = per_server.popitem()
+            return self._get_server(addr, keys)
+        
+        tasks = [Tasklet.new(self._get_server)(addr, keys) for addr, keys in per_server.items()]
+        result = {}
+        for values in Tasklet.join_all(tasks):
+            if isinstance(values, JoinError):
+                self.log.error("while getting from memcache: %s", values)
+            else:
+                result.update(values)
+        return result
+    
+    def close(self):
+        for node in self._nodes.values():
+            if node.is_connected():
+                node.close()
+        self._nodes = {}
 
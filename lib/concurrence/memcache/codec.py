@@ -0,0 +1,77 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+import zlib
+import cPickle as pickle
+
+#how a value was encoded is stored in the flags of the memcached item, these are the same flags as used by python-memcached
+FLAG_PICKLE = 1
+FLAG_INTEGER = 2
+FLAG_LONG = 4
+FLAG_COMPRESSED = 8
+
+class MemcacheCodec(object):
+    """Encodes values into strings to be stored in memcached, and decodes them again."""
+    def encode(self, value):
+        """Returns a tuple (encoded, flags), where *encoded* is the string to store for *value* and *flags* tells :func:`decode`
+        how to decode it."""
+        raise NotImplementedError()
+
+    def decode(self, encoded, flags):
+        """Returns the value of the *encoded* string stored with *flags*."""
+        raise NotImplementedError()
+
+class DefaultCodec(MemcacheCodec):
+    """Stores strings as is, integers as decimal strings (so that they can be used with incr and decr) and
+    pickles all other values. Optionally values larger than *compress_threshold* bytes are compressed with zlib."""
+    def __init__(self, compress_threshold = 0, compress_level = 1):
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+
+    def encode(self, value):
+        t = type(value)
+        if t is str:
+            encoded, flags = value, 0
+        elif t is int:
+            encoded, flags = str(value), FLAG_INTEGER
+        elif t is long:
+            encoded, flags = str(value), FLAG_LONG
+        else:
+            encoded, flags = pickle.dumps(value, -1), FLAG_PICKLE
+        if self._compress_threshold and len(encoded) > self._compress_threshold:
+            compressed = zlib.compress(encoded, self._compress_level)
+            if len(compressed) < len(encoded):
+                encoded, flags = compressed, flags | FLAG_COMPRESSED
+        return encoded, flags
+
+    def decode(self, encoded, flags):
+        if flags & FLAG_COMPRESSED:
+            encoded = zlib.decompress(encoded)
+        if flags & FLAG_PICKLE:
+            return pickle.loads(encoded)
+        elif flags & FLAG_INTEGER:
+            return int(encoded)
+        elif flags & FLAG_LONG:
+            return long(encoded)
+        else:
+            return encoded
+
+class RawCodec(MemcacheCodec):
+    """Stores strings only, as is."""
+    def encode(self, value):
+        if type(value) is not str:
+            raise TypeError("RawCodec can only store strings, not %s" % type(value))
+        return value, 0
+
+    def decode(self, encoded, flags):
+        return encoded
+
+class PickleCodec(MemcacheCodec):
+    """Pickles all values regardless of their type, which is how earlier versions of :class:`MemcacheNode` stored values."""
+    def encode(self, value):
+        return pickle.dumps(value, -1), 0
+
+    def decode(self, encoded, flags):
+        return pickle.loads(encoded)
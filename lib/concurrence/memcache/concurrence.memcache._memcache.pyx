@@ -0,0 +1,126 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+"""
+packing and parsing of memcached binary protocol packets
+"""
+
+from concurrence.io._io cimport Buffer
+from concurrence.io._io import BufferUnderflowError
+
+cdef extern from "Python.h":
+    object PyString_FromStringAndSize(char *, int)
+    char *PyString_AsString(object obj) except NULL
+    int PyString_Size(object obj) except -1
+
+cdef extern from "string.h":
+    void *memcpy(void *dest, void *src, int n)
+
+cdef enum:
+    HEADER_SIZE = 24
+    MAGIC_REQUEST = 0x80
+    MAGIC_RESPONSE = 0x81
+    OPCODE_NOOP = 0x0a
+    OPCODE_GETKQ = 0x0d
+
+cdef unsigned long _read_uint32(unsigned char *p):
+    return (<unsigned long>p[0] << 24) | (<unsigned long>p[1] << 16) | (<unsigned long>p[2] << 8) | <unsigned long>p[3]
+
+cdef void _write_uint32(unsigned char *p, unsigned long v):
+    p[0] = (v >> 24) & 0xff
+    p[1] = (v >> 16) & 0xff
+    p[2] = (v >> 8) & 0xff
+    p[3] = v & 0xff
+
+cdef void _write_header(unsigned char *p, int opcode, int keylen, int extlen, unsigned long bodylen, unsigned long opaque, unsigned long long cas):
+    p[0] = MAGIC_REQUEST
+    p[1] = opcode
+    p[2] = (keylen >> 8) & 0xff
+    p[3] = keylen & 0xff
+    p[4] = extlen
+    p[5] = 0 #data type
+    p[6] = 0 #vbucket
+    p[7] = 0
+    _write_uint32(p + 8, bodylen)
+    _write_uint32(p + 12, opaque)
+    _write_uint32(p + 16, <unsigned long>(cas >> 32))
+    _write_uint32(p + 20, <unsigned long>(cas & 0xffffffffUL))
+
+def pack_request(int opcode, key, extras = '', value = '', unsigned long opaque = 0, unsigned long long cas = 0):
+    """Returns the request packet for *opcode* with given *key*, *extras* and *value* strings."""
+    cdef int keylen, extlen, valuelen
+    cdef unsigned char *p
+    keylen = PyString_Size(key)
+    extlen = PyString_Size(extras)
+    valuelen = PyString_Size(value)
+    packet = PyString_FromStringAndSize(NULL, HEADER_SIZE + extlen + keylen + valuelen)
+    p = <unsigned char *>PyString_AsString(packet)
+    _write_header(p, opcode, keylen, extlen, extlen + keylen + valuelen, opaque, cas)
+    p = p + HEADER_SIZE
+    memcpy(p, PyString_AsString(extras), extlen)
+    p = p + extlen
+    memcpy(p, PyString_AsString(key), keylen)
+    p = p + keylen
+    memcpy(p, PyString_AsString(value), valuelen)
+    return packet
+
+def pack_getkq(keys, unsigned long opaque = 0):
+    """Returns the request packets of a quiet get (getkq) of each of the *keys* followed by a noop. The server only
+    answers the keys it has, the response to the noop marks the end of the results."""
+    cdef int n, keylen
+    cdef unsigned char *p
+    n = HEADER_SIZE
+    for key in keys:
+        n = n + HEADER_SIZE + PyString_Size(key)
+    packet = PyString_FromStringAndSize(NULL, n)
+    p = <unsigned char *>PyString_AsString(packet)
+    for key in keys:
+        keylen = PyString_Size(key)
+        _write_header(p, OPCODE_GETKQ, keylen, 0, keylen, opaque, 0)
+        memcpy(p + HEADER_SIZE, PyString_AsString(key), keylen)
+        p = p + HEADER_SIZE + keylen
+    _write_header(p, OPCODE_NOOP, 0, 0, 0, opaque, 0)
+    return packet
+
+def packet_length(Buffer buffer):
+    """Returns the total length of the response packet at the position of *buffer*, or -1 if the buffer does not contain
+    the whole packet header yet."""
+    cdef unsigned char *p
+    if buffer._limit - buffer._position < HEADER_SIZE:
+        return -1
+    p = buffer._buff + buffer._position
+    if p[0] != MAGIC_RESPONSE:
+        raise ValueError("invalid magic in response: %d" % p[0])
+    return HEADER_SIZE + _read_uint32(p + 8)
+
+def read_response(Buffer buffer):
+    """Reads a complete response packet from *buffer* and returns a tuple (opcode, status, cas, flags, key, value), *flags*
+    is taken from the extras of get responses and is 0 otherwise. If the buffer does not contain the whole packet,
+    :exc:`BufferUnderflowError` is raised and position is not changed."""
+    cdef unsigned char *p
+    cdef int keylen, extlen, status
+    cdef unsigned long bodylen, flags
+    cdef unsigned long long cas
+    if buffer._limit - buffer._position < HEADER_SIZE:
+        raise BufferUnderflowError()
+    p = buffer._buff + buffer._position
+    if p[0] != MAGIC_RESPONSE:
+        raise ValueError("invalid magic in response: %d" % p[0])
+    keylen = (p[2] << 8) | p[3]
+    extlen = p[4]
+    status = (p[6] << 8) | p[7]
+    bodylen = _read_uint32(p + 8)
+    if <unsigned long>(buffer._limit - buffer._position) < HEADER_SIZE + bodylen:
+        raise BufferUnderflowError()
+    if keylen + extlen > bodylen:
+        raise ValueError("invalid key and extras length in response")
+    cas = (<unsigned long long>_read_uint32(p + 16) << 32) | _read_uint32(p + 20)
+    flags = 0
+    if extlen == 4:
+        flags = _read_uint32(p + HEADER_SIZE)
+    key = PyString_FromStringAndSize(<char *>(p + HEADER_SIZE + extlen), keylen)
+    value = PyString_FromStringAndSize(<char *>(p + HEADER_SIZE + extlen + keylen), bodylen - extlen - keylen)
+    buffer._position = buffer._position + HEADER_SIZE + bodylen
+    return (p[1], status, cas, flags, key, value)
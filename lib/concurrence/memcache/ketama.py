@@ -0,0 +1,64 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+import bisect
+import struct
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+#number of md5 hashes per server (of equal weight), each md5 gives 4 points on the continuum
+POINTS_PER_SERVER = 40
+
+class Ketama(object):
+    """The ketama consistent hashing continuum, as used by libketama and libmemcached. Each server is mapped
+    to a number of points on a circle of 32 bit integers, proportional to its weight. A key maps to the first server point
+    following the hash of the key. Adding or removing a server only moves the keys of that server."""
+
+    def __init__(self, servers = None):
+        """*servers* is a list of (server, weight) tuples, the server must be a (host, port) tuple or a string 'host:port'."""
+        self._points = []
+        self._servers = []
+        self.update(servers or [])
+
+    @staticmethod
+    def hash(key):
+        """returns the position of *key* on the continuum"""
+        return struct.unpack('<I', md5(key).digest()[:4])[0]
+
+    @staticmethod
+    def _server_name(server):
+        if type(server) == tuple:
+            return '%s:%d' % server
+        else:
+            return server
+
+    def update(self, servers):
+        """Rebuilds the continuum for the given list of (server, weight) tuples."""
+        continuum = []
+        total_weight = float(sum([weight for _, weight in servers]))
+        for server, weight in servers:
+            name = self._server_name(server)
+            for i in range(int((weight / total_weight) * POINTS_PER_SERVER * len(servers))):
+                digest = md5('%s-%d' % (name, i)).digest()
+                for point in struct.unpack('<IIII', digest):
+                    continuum.append((point, server))
+        continuum.sort()
+        self._points = [point for point, _ in continuum]
+        self._servers = [server for _, server in continuum]
+
+    def __len__(self):
+        return len(self._points)
+
+    def get_server(self, key):
+        """Returns the server for *key*, or None if there are no servers."""
+        if not self._points:
+            return None
+        i = bisect.bisect_left(self._points, self.hash(key))
+        if i == len(self._points):
+            i = 0 #wrap around the circle
+        return self._servers[i]
@@ -0,0 +1,235 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+import time
+import cPickle as pickle
+
+from concurrence import Tasklet, Channel, TaskletError
+from concurrence.timer import Timeout
+from concurrence.statistic import Statistic
+from concurrence.containers.dequedict import DequeDict
+
+def _sizeof(value):
+    """estimates the memory used by *value*"""
+    if type(value) is str or type(value) is unicode:
+        return len(value)
+    else:
+        return len(pickle.dumps(value, -1))
+
+class _Fetch(object):
+    """a get of a key from memcache that is in progress, other tasks that want the same key wait for it"""
+    def __init__(self):
+        self.waiters = []
+        self.valid = True #becomes False if the key is invalidated while fetching, the result is then not cached
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def finish(self, value, error = None):
+        self.done = True
+        self.value = value
+        self.error = error
+        for channel in self.waiters[:]: #copied, waiters remove themselves when woken up
+            if channel.has_receiver():
+                if error is None:
+                    channel.send(value)
+                else:
+                    channel.send_exception(TaskletError, error, Tasklet.current())
+
+class NearCache(object):
+    """An in-process LRU cache in front of a memcache client (a :class:`~concurrence.memcache.client.MemcacheNode` or
+    :class:`~concurrence.memcache.client.MemcacheClient`), for keys that are read very often but rarely change.
+
+    Values are kept for at most *ttl* seconds, and the cache holds at most *max_entries* values and *max_bytes* bytes,
+    the least recently used values are evicted first. Concurrent gets of a key that is not cached result in a single get
+    from memcache. Modifications done through this class invalidate the local value, modifications by other processes
+    become visible when the local value expires.
+
+    Usage::
+
+        cache = NearCache(MemcacheClient(servers), ttl = 2.0)
+        print cache.get('config')
+    """
+    def __init__(self, memcache, max_entries = 10000, max_bytes = 16 * 1024 * 1024, ttl = 1.0, sizeof = _sizeof):
+        self._memcache = memcache
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._sizeof = sizeof
+        self._entries = DequeDict() #key -> (value, expiration time, size), most recently used first
+        self._bytes = 0
+        self._fetches = {} #key -> _Fetch
+        self._writes = {} #key -> number of modifications in progress
+
+        self._hit_statistic = Statistic(0)
+        self._miss_statistic = Statistic(0)
+        self._wait_statistic = Statistic(0)
+        self._eviction_statistic = Statistic(0)
+
+    def __statistics__(self):
+        return {'hit': self._hit_statistic,
+                'miss': self._miss_statistic,
+                'wait': self._wait_statistic,
+                'eviction': self._eviction_statistic,
+                'entries': len(self._entries),
+                'bytes': self._bytes}
+
+    def _remove(self, key):
+        value, expires, size = self._entries[key]
+        del self._entries[key]
+        self._bytes -= size
+
+    def _add(self, key, value):
+        size = self._sizeof(value)
+        if size > self._max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries.appendleft(key, (value, time.time() + self._ttl, size))
+        self._bytes += size
+        while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+            key, (_, _, size) = self._entries.pop()
+            self._bytes -= size
+            self._eviction_statistic += 1
+
+    def _lookup(self, key, now):
+        """returns the cached value of *key* or None"""
+        if key in self._entries:
+            value, expires, size = self._entries[key]
+            if expires > now:
+                self._entries.movehead(key)
+                self._hit_statistic += 1
+                return value
+            self._remove(key)
+        return None
+
+    def _fetch(self, keys):
+        """gets *keys* from memcache on behalf of all tasks that want them"""
+        fetches = []
+        for key in keys:
+            fetch = _Fetch()
+            self._fetches[key] = fetch
+            fetches.append(fetch)
+        try:
+            values = self._memcache.get(keys)
+        except Exception, e:
+            for key, fetch in zip(keys, fetches):
+                if self._fetches.get(key) is fetch:
+                    del self._fetches[key]
+                fetch.finish(None, e)
+            raise
+        for key, fetch in zip(keys, fetches):
+            if self._fetches.get(key) is fetch:
+                del self._fetches[key]
+            value = values.get(key, None)
+            if value is not None and fetch.valid and key not in self._writes:
+                self._add(key, value)
+            fetch.finish(value)
+        return values
+
+    def _wait(self, fetch):
+        """waits for the value of a key that is being fetched by another task"""
+        self._wait_statistic += 1
+        if not fetch.done:
+            channel = Channel()
+            fetch.waiters.append(channel)
+            try:
+                return channel.receive(Timeout.current())
+            except TaskletError, e:
+                raise e.cause
+            finally:
+                fetch.waiters.remove(channel)
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.value
+
+    def get(self, keys):
+        """Gets the value of a single key, or None if it does not exist. If *keys* is a list, a dictionary with the values
+        of the keys that exist is returned."""
+        now = time.time()
+        if type(keys) == str:
+            value = self._lookup(keys, now)
+            if value is not None:
+                return value
+            self._miss_statistic += 1
+            if keys in self._fetches:
+                return self._wait(self._fetches[keys])
+            return self._fetch([keys]).get(keys, None)
+        result = {}
+        fetch = []
+        wait = []
+        for key in set(keys):
+            value = self._lookup(key, now)
+            if value is not None:
+                result[key] = value
+                continue
+            self._miss_statistic += 1
+            if key in self._fetches:
+                wait.append((key, self._fetches[key]))
+            else:
+                fetch.append(key)
+        if fetch:
+            result.update(self._fetch(fetch))
+        for key, fetch in wait: #the fetch may have finished while fetching the other keys
+            value = self._wait(fetch)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def invalidate(self, key):
+        """Removes *key* from the local cache. A get of *key* that is in progress is not cached, and later gets do not
+        wait for it but fetch the key again."""
+        if key in self._entries:
+            self._remove(key)
+        if key in self._fetches:
+            self._fetches.pop(key).valid = False
+
+    def clear(self):
+        """Removes all keys from the local cache."""
+        for fetch in self._fetches.values():
+            fetch.valid = False
+        self._fetches = {}
+        self._entries = DequeDict()
+        self._bytes = 0
+
+    def _write(self, key, method, *args, **kwargs):
+        """modifies *key* in memcache, gets of *key* that run while the modification is in progress may see the old
+        value, so their result is not cached and the key is invalidated again when the modification is done"""
+        self.invalidate(key)
+        self._writes[key] = self._writes.get(key, 0) + 1
+        try:
+            return method(key, *args, **kwargs)
+        finally:
+            self._writes[key] -= 1
+            if not self._writes[key]:
+                del self._writes[key]
+            self.invalidate(key)
+
+    def set(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.set, *args, **kwargs)
+
+    def add(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.add, *args, **kwargs)
+
+    def replace(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.replace, *args, **kwargs)
+
+    def append(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.append, *args, **kwargs)
+
+    def prepend(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.prepend, *args, **kwargs)
+
+    def cas(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.cas, *args, **kwargs)
+
+    def delete(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.delete, *args, **kwargs)
+
+    def incr(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.incr, *args, **kwargs)
+
+    def decr(self, key, *args, **kwargs):
+        return self._write(key, self._memcache.decr, *args, **kwargs)
@@ -29,11 +29,14 @@ setup(
   package_dir = {'':'lib'},
   packages = find_packages('lib'),
   ext_modules=[
-    Extension("concurrence._event", ["lib/concurrence/concurrence._event.pyx"], include_dirs = libevent_include_dirs, library_dirs = libevent_library_dirs, libraries = ["event"]),
+    Extension("concurrence._event", ["lib/concurrence/concurrence._event.pyx"], include_dirs = libevent_include_dirs + ['lib/concurrence'], library_dirs = libevent_library_dirs, libraries = ["event"]),
     Extension("concurrence.io._io", ["lib/concurrence/io/concurrence.io._io.pyx", "lib/concurrence/io/io_base.c"]),
     Extension("concurrence.database.mysql._mysql", ["lib/concurrence/database/mysql/concurrence.database.mysql._mysql.pyx"], 
               include_dirs=['lib/concurrence/io']
               ),
+    Extension("concurrence.memcache._memcache", ["lib/concurrence/memcache/concurrence.memcache._memcache.pyx"], 
+              include_dirs=['lib/concurrence/io']
+              ),
     ],
   cmdclass = {'build_ext': build_ext},
     classifiers = [
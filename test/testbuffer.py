@@ -1,5 +1,5 @@
 from concurrence import unittest
-from concurrence.io.buffered import Buffer, BufferUnderflowError, BufferInvalidArgumentError
+from concurrence.io.buffered import Buffer, BufferUnderflowError, BufferOverflowError, BufferInvalidArgumentError
 
 class TestBuffer(unittest.TestCase):
     def testDuplicate(self):
@@ -28,6 +28,65 @@ class TestBuffer(unittest.TestCase):
         self.assertEquals('test', c.read_bytes(4))
         del c #this releases buffer b as well, we cannot test this, but this should not crash :-)
 
+    def testWriteHeaders(self):
+        b = Buffer(64)
+        n = b.write_headers([('Content-type', 'text/plain'), ('Date', 'never'), ('Content-length', 10)], set(['Date']))
+        b.flip()
+        self.assertEquals('Content-type: text/plain\r\nContent-length: 10\r\n', b.read_bytes(-1))
+        self.assertEquals(46, n)
+        
+        #all or nothing
+        b.clear()
+        b.write_bytes('x' * 10)
+        try:
+            b.write_headers([('a', 'b'), ('X-Long', 'y' * 60)])
+            self.fail('expected overflow')
+        except BufferOverflowError:
+            pass
+        self.assertEquals(10, b.position)
+
+    def testReadHttpRequest(self):
+        request = "GET /a/b?x=1&y=2#frag HTTP/1.1\r\nHost: localhost:8080\r\nContent-Type:text/plain\r\nX-Multi: 1\r\nx-multi: 2  \r\nX-Folded: a\r\n  b\r\n\r\nbody"
+        b = Buffer(1024)
+        #partial header, nothing is consumed
+        for n in [0, 10, len(request) - 7, len(request) - 6]:
+            b.clear()
+            b.write_bytes(request[:n])
+            b.flip()
+            try:
+                b.read_http_request({})
+                self.fail('expected underflow')
+            except BufferUnderflowError:
+                pass
+            self.assertEquals(0, b.position)
+        
+        b.clear()
+        b.write_bytes(request)
+        b.flip()
+        environ = {}
+        self.assertEquals(('GET', '/a/b?x=1&y=2#frag', 'HTTP/1.1'), b.read_http_request(environ))
+        self.assertEquals('body', b.read_bytes(-1))
+        self.assertEquals({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/a/b', 'QUERY_STRING': 'x=1&y=2',
+                           'HTTP_HOST': 'localhost:8080', 'HTTP_CONTENT_TYPE': 'text/plain',
+                           'HTTP_X_MULTI': '1,2', 'HTTP_X_FOLDED': 'a b'}, environ)
+        
+        #LF line endings, leading empty line, absolute uri
+        b.clear()
+        b.write_bytes("\r\nPOST http://example.com:80/x HTTP/1.0\nContent-Length: 3\n\n")
+        b.flip()
+        environ = {}
+        self.assertEquals(('POST', 'http://example.com:80/x', 'HTTP/1.0'), b.read_http_request(environ))
+        self.assertEquals(0, b.remaining)
+        self.assertEquals('/x', environ['PATH_INFO'])
+        self.assertEquals('', environ['QUERY_STRING'])
+        self.assertEquals('3', environ['HTTP_CONTENT_LENGTH'])
+        
+        for invalid in ["GET\r\n\r\n", "GET / HTTP/1.1\r\nno colon\r\n\r\n"]:
+            b.clear()
+            b.write_bytes(invalid)
+            b.flip()
+            self.assertRaises(ValueError, b.read_http_request, {})
+
     def testGetSetItem(self):
         b = Buffer(1024)
         
@@ -1,6 +1,6 @@
 from concurrence import unittest
 from concurrence.io import IOStream
-from concurrence.io.buffered import Buffer, BufferedReader
+from concurrence.io.buffered import Buffer, BufferedReader, BufferedWriter
 
 class TestStream(IOStream):
     def __init__(self, s, chunk_size = 4):
@@ -81,7 +81,63 @@ class TestBuffered(unittest.TestCase):
                     i, f = test_stream('piet klaas aap' * x)
                     self.assertEquals(i.read(), f.read())
 
-    
+    def testWritev(self):
+        class TestWritevStream(IOStream):
+            """accepts at most max_write bytes per call, to simulate a full socket"""
+            def __init__(self, max_write):
+                self.max_write = max_write
+                self.written = []
+                self.calls = 0
+            def write(self, buffer, timeout = -1.0):
+                s = buffer.read_bytes(min(self.max_write, buffer.remaining))
+                self.written.append(s)
+                self.calls += 1
+                return len(s)
+            def writev(self, buffer, parts, offset = 0, timeout = -1.0):
+                head = buffer.read_bytes(-1)
+                s = (head + parts[0][offset:] + ''.join(parts[1:]))[:self.max_write]
+                buffer.position = buffer.limit - len(head) + min(len(head), len(s))
+                self.written.append(s)
+                self.calls += 1
+                return len(s)
+        
+        for max_write in [1, 7, 1000, 10000, 1000000]:
+            stream = TestWritevStream(max_write)
+            writer = BufferedWriter(stream, Buffer(1024))
+            expected = []
+            for i in range(20):
+                for s in ['header %d\r\n' % i, chr(65 + i) * (i * 1000), '', '\r\n']:
+                    writer.write_bytes(s)
+                    expected.append(s)
+            writer.write_byte(33)
+            expected.append('!')
+            writer.flush()
+            self.assertEquals(''.join(expected), ''.join(stream.written))
+
+        #big strings are passed by reference, buffer and strings go out in a single call
+        stream = TestWritevStream(1000000)
+        writer = BufferedWriter(stream, Buffer(1024))
+        writer.write_bytes('head')
+        for i in range(10):
+            writer.write_bytes('x' * 10000)
+            writer.write_bytes('\r\n')
+        writer.flush()
+        self.assertEquals(1, stream.calls)
+        self.assertEquals('head' + ('x' * 10000 + '\r\n') * 10, stream.written[0])
+
+    def testWritevSocket(self):
+        import os
+        r, w = os.pipe()
+        try:
+            b = Buffer(16)
+            b.write_bytes('head')
+            b.flip()
+            self.assertEquals((4 + 3 + 5, 0), b.send(w, ['xxbody', 'parts'], 3))
+            self.assertEquals('headodyparts', os.read(r, 100))
+        finally:
+            os.close(r)
+            os.close(w)
+
 if __name__ == '__main__':
     unittest.main(timeout = 10)
 
@@ -4,6 +4,7 @@ import time
 import sys
 
 from concurrence import unittest, Tasklet, Channel, TimeoutError, TaskletError, JoinError, Message
+from concurrence import _event
 
 class TestTasklet(unittest.TestCase):
     def testSleep(self):
@@ -13,6 +14,16 @@ class TestTasklet(unittest.TestCase):
         
         self.assertAlmostEqual(1.0, end - start, places = 1)
         
+        #a timeout of -1 sleeps forever
+        slept = []
+        def sleeper():
+            Tasklet.sleep(-1)
+            slept.append(True)
+        sleeper_task = Tasklet.new(sleeper)()
+        Tasklet.sleep(0.2)
+        self.assertEquals([], slept)
+        sleeper_task.kill()
+        
     def testJoinResult(self):
         """test normal join and checks that parent will get child result"""
         def child(i):
@@ -404,6 +415,105 @@ class TestChannel(unittest.TestCase):
         Tasklet.sleep(1.0)
         
         self.assertEquals(False, test_channel.has_receiver())
-        
+
+class TestDispatch(unittest.TestCase):
+    def _dispatch_events(self, native, events = 1000, n = 200000):
+        """lets *events* timeouts of 0 seconds fire and re-add themselves until *n* events have passed trough the 
+        dispatcher, so that every loop triggers many events, returns the number of events per second"""
+        count = [0]
+        end = []
+        def timeout():
+            def callback(evtype):
+                count[0] += 1
+                if count[0] < n:
+                    ev.add(0.0)
+                elif count[0] == n:
+                    end.append(time.time())
+            ev = _event.event(callback, 0)
+            ev.add(0.0)
+            return ev
+
+        _event.set_native(native)
+        try:
+            start = time.time()
+            timeouts = [timeout() for _ in range(events)]
+            while not end:
+                Tasklet.sleep(0.05)
+        finally:
+            _event.set_native(0)
+
+        return n / (end[0] - start)
+
+    def testNativeDispatch(self):
+        python_rate, native_rate = 0, 0
+        for i in range(3): #best of 3, alternating
+            python_rate = max(python_rate, self._dispatch_events(0))
+            native_rate = max(native_rate, self._dispatch_events(1))
+        logging.info("dispatch benchmark, python: %d events/s, native: %d events/s", python_rate, native_rate)
+
+    def testNativeDispatchException(self):
+        """an exception in a callback must not prevent the other triggered events from being dispatched"""
+        from concurrence.core import TimeoutEvent
+        _event.set_native(1)
+        try:
+            fired = []
+            def bad():
+                raise Exception("test_exc")
+            events = [TimeoutEvent(0.0, bad), TimeoutEvent(0.0, lambda: fired.append(True))]
+            Tasklet.sleep(0.5)
+            self.assertEquals([True], fired)
+            for event in events:
+                event.close()
+        finally:
+            _event.set_native(0)
+
+class TestTimerWheel(unittest.TestCase):
+    def testTimers(self):
+        """timers on different levels of the wheel fire in order and not before their timeout"""
+        from concurrence.core import _timer_wheel
+        start = time.time()
+        fired = []
+        def on_timer(timeout):
+            fired.append((timeout, time.time() - start))
+        timeouts = [0.3, 0.01, 0.0, 1.1, 0.2, 0.05]
+        for timeout in timeouts:
+            _timer_wheel.add(timeout, on_timer, timeout)
+        Tasklet.sleep(1.3)
+        self.assertEquals(sorted(timeouts), [timeout for timeout, _ in fired])
+        for timeout, elapsed in fired:
+            self.assertTrue(elapsed >= timeout)
+            self.assertAlmostEqual(timeout, elapsed, places = 1)
+
+    def testCancel(self):
+        from concurrence.core import _timer_wheel
+        fired = []
+        n = len(_timer_wheel)
+        timers = [_timer_wheel.add(0.001 * (i % 500), fired.append, i) for i in range(10000)]
+        self.assertEquals(n + 10000, len(_timer_wheel))
+        for timer in timers[1:]:
+            timer.cancel()
+        self.assertEquals(n + 1, len(_timer_wheel))
+        Tasklet.sleep(0.1)
+        self.assertEquals([0], fired)
+        self.assertEquals(n, len(_timer_wheel))
+        timers[0].cancel() #cancelling an expired timer is harmless
+
+    def testTimeouts(self):
+        """many tasks waiting with timeouts, only some of which expire"""
+        results = {}
+        def waiter(i, ch, timeout):
+            try:
+                results[i] = ch.receive(timeout)
+            except TimeoutError:
+                results[i] = TimeoutError
+        channels = [Channel() for i in range(20)]
+        for i, ch in enumerate(channels):
+            Tasklet.new(waiter)(i, ch, 0.2 if i % 2 else 5.0)
+        Tasklet.sleep(0.05)
+        for i in range(0, 20, 2):
+            channels[i].send(i)
+        Tasklet.sleep(0.3)
+        self.assertEquals(dict([(i, i if i % 2 == 0 else TimeoutError) for i in range(20)]), results)
+
 if __name__ == '__main__':
     unittest.main(timeout = 100.0)
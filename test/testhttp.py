@@ -1,11 +1,14 @@
+from __future__ import with_statement
 
+import os
 import logging
 import time
 
 from concurrence import Tasklet, TimeoutError, unittest
-from concurrence.http import HTTPError, WSGIServer, HTTPConnection
+from concurrence.timer import Timeout
+from concurrence.http import HTTPError, WSGIServer, HTTPConnection, HTTPConnectionPool, HTTPRequest
 from concurrence.wsgi import WSGISimpleRouter, WSGISimpleMessage
-from concurrence.io import Buffer, Socket
+from concurrence.io import Buffer, Socket, BufferedStream, Server
 
 SERVER_PORT = 8080
 
@@ -29,7 +32,53 @@ class TestHTTP(unittest.TestCase):
                 self.body = f.read(int(environ['HTTP_CONTENT_LENGTH']))
                 return WSGISimpleMessage.__call__(self, environ, start_response)                
             
+        class WSGILineCounter(WSGISimpleMessage):
+            def __call__(self, environ, start_response):
+                f = environ['wsgi.input']
+                first = f.readline()
+                rest = [len(line) for line in f]
+                self.response = '%s|%d|%d' % (first.strip(), len(rest), sum(rest))
+                return WSGISimpleMessage.__call__(self, environ, start_response)                
+
+        def sized(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '12')])
+            return (part for part in ['Hello ', 'World!', 'too much'])
+
+        def static(environ, start_response):
+            f = open(self.static_path, 'rb')
+            f.seek(int(environ['QUERY_STRING'] or 0))
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            return environ['wsgi.file_wrapper'](f)
+
+        def short(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '20')])
+            return ['Hello']
+
+        def static_sized(environ, start_response):
+            f = open(self.static_path, 'rb')
+            start_response('200 OK', [('Content-Type', 'application/octet-stream'), ('Content-Length', environ['QUERY_STRING'])])
+            return environ['wsgi.file_wrapper'](f)
+
+        def pipe(environ, start_response):
+            r, w = os.pipe()
+            os.write(w, 'piped ' * 1000)
+            os.close(w)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return environ['wsgi.file_wrapper'](os.fdopen(r, 'rb'))
+
+        def big(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ('%05d' % i * 2000 for i in range(100))
+
+        application.map('/big', big)
+        application.map('/sized', sized)
+        application.map('/static', static)
+        application.map('/short', short)
+        application.map('/file', static_sized)
+        application.map('/pipe', pipe)
+        
         self.saver = WSGIPOSTSaver('ok')
+        application.map('/lines', WSGILineCounter(''))
         application.map('/sleep', WSGISleeper('zzz...'))
         application.map('/post', self.saver)
 
@@ -85,6 +134,8 @@ class TestHTTP(unittest.TestCase):
 
     def testInterleaved3(self):
         """tests that http client and server really support pipelining"""
+        #the requests are sent one by one, so start out with the pipelining tasks already
+        self.server.single_tasklet = False
         cnn = HTTPConnection()
         cnn.connect(('localhost', SERVER_PORT))
 
@@ -109,6 +160,8 @@ class TestHTTP(unittest.TestCase):
 
     def testInterleaved4(self):
         """tests that http server returns responses in correct order"""
+        #the requests are sent one by one, so start out with the pipelining tasks already
+        self.server.single_tasklet = False
         cnn = HTTPConnection()
         cnn.connect(('localhost', SERVER_PORT))
 
@@ -135,6 +188,73 @@ class TestHTTP(unittest.TestCase):
         
         cnn.close()
 
+    def testPipelineBackpressure(self):
+        """with at most 2 requests in flight per connection, 4 pipelined requests of 1 second take 2 seconds"""
+        self.server.single_tasklet = False
+        self.server.max_pipelined_requests = 2
+        cnn = HTTPConnection()
+        try:
+            cnn.connect(('localhost', SERVER_PORT))
+            start = time.time()
+            for i in range(4):
+                cnn.send(cnn.get('/sleep?1'))
+            for i in range(4):
+                self.assertEquals('slept 1', cnn.receive().body)
+            self.assertAlmostEqual(2, time.time() - start, places = 1)
+            self.assertTrue(self.server.__statistics__()['pipeline_stall'].count > 0)
+        finally:
+            cnn.close()
+
+    def testSingleTaskletSwitch(self):
+        """a connection handled in a single task switches to pipelining when a second request is waiting"""
+        self.assertTrue(self.server.single_tasklet)
+        socket = Socket.connect(('localhost', SERVER_PORT))
+        try:
+            stream = BufferedStream(socket)
+            start = time.time()
+            stream.writer.write_bytes("GET /sleep?1 HTTP/1.1\r\nHost: localhost\r\n\r\n" * 2)
+            stream.writer.flush()
+            lines = stream.reader.read_lines()
+            for i in range(2):
+                self.assertEquals('HTTP/1.1 200 OK', lines.next())
+                while lines.next(): pass #headers
+                self.assertEquals('7;', lines.next())
+                self.assertEquals('slept 1', lines.next())
+                self.assertEquals('0', lines.next())
+                self.assertEquals('', lines.next())
+            self.assertAlmostEqual(1, time.time() - start, places = 1)
+        finally:
+            socket.close()
+
+    def testUnreadBody(self):
+        """the part of a request body not read by the application is skipped"""
+        cnn = HTTPConnection()
+        try:
+            cnn.connect(('localhost', SERVER_PORT))
+            for i in range(2):
+                response = cnn.perform(cnn.post('/hello/1', 'x' * 100000))
+                self.assertEquals('Hello World 1', response.body)
+        finally:
+            cnn.close()
+
+    def testMaxConcurrentHandlers(self):
+        self.server.max_concurrent_handlers = 1
+        def fetch():
+            cnn = HTTPConnection()
+            try:
+                cnn.connect(('localhost', SERVER_PORT))
+                return cnn.perform(cnn.get('/sleep?1')).body
+            finally:
+                cnn.close()
+        start = time.time()
+        tasks = [Tasklet.new(fetch)() for i in range(3)]
+        self.assertEquals(['slept 1'] * 3, Tasklet.join_all(tasks))
+        self.assertAlmostEqual(3, time.time() - start, places = 1)
+        statistics = self.server.__statistics__()
+        self.assertEquals(0, statistics['handlers']['active'])
+        self.assertEquals(2, statistics['handlers']['wait_time'].count)
+        self.assertTrue(statistics['requests'].count >= 3)
+
     def fetch10(self, s, uri):
 
         b = Buffer(1024)
@@ -182,6 +302,133 @@ class TestHTTP(unittest.TestCase):
         finally:
             cnn.close()
 
+    def testHeaderAcrossReads(self):
+        """request header trickling in, so that lines span several reads of the server"""
+        socket = Socket.connect(('localhost', SERVER_PORT))
+        try:
+            stream = BufferedStream(socket)
+            request = "GET /hello/3 HTTP/1.1\r\nHost: localhost\r\nX-Padding:%s\r\nConnection: close\r\n\r\n" % ('p' * 3000) 
+            for i in range(0, len(request), 700):
+                stream.writer.write_bytes(request[i:i + 700])
+                stream.writer.flush()
+                Tasklet.sleep(0.05)
+            self.assertEquals('HTTP/1.1 200 OK', stream.reader.read_line())
+        finally:
+            socket.close()
+
+    def post_raw(self, request):
+        socket = Socket.connect(('localhost', SERVER_PORT))
+        try:
+            stream = BufferedStream(socket)
+            stream.writer.write_bytes(request)
+            stream.writer.flush()
+            return stream.file().read()
+        finally:
+            socket.close()
+
+    def testChunkedPost(self):
+        body = 'first line\n' + ('x' * 99 + '\n') * 1000
+        chunks = [body[i:i + 3000] for i in range(0, len(body), 3000)]
+        request = "POST /lines HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        request += ''.join(["%x;ext=1\r\n%s\r\n" % (len(chunk), chunk) for chunk in chunks]) + "0\r\nX-Trailer: 1\r\n\r\n"
+        response = self.post_raw(request)
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+        self.assertTrue('first line|1000|100000' in response)
+        
+    def testPostReadline(self):
+        body = 'first line\r\nsecond\r\nno newline at end'
+        request = "POST /lines HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body)
+        response = self.post_raw(request)
+        self.assertTrue('first line|2|25' in response)
+
+    def testContentLength(self):
+        """an application supplied Content-Length is honoured, the body is not chunked, nor cut off too late"""
+        cnn = HTTPConnection()
+        try:
+            cnn.connect(('localhost', SERVER_PORT))
+            for i in range(2): #connection is kept alive
+                response = cnn.perform(cnn.get('/sized'))
+                self.assertEquals('HTTP/1.1 200 OK', response.status)
+                self.assertEquals(None, response.get_header('Transfer-Encoding'))
+                self.assertEquals('Hello World!', response.body)
+        finally:
+            cnn.close()
+    
+    def testFileWrapper(self):
+        import os
+        import tempfile
+        fd, self.static_path = tempfile.mkstemp()
+        try:
+            data = ''.join([chr(i % 256) for i in range(200000)])
+            os.write(fd, data)
+            os.close(fd)
+            cnn = HTTPConnection()
+            try:
+                cnn.connect(('localhost', SERVER_PORT))
+                response = cnn.perform(cnn.get('/static'))
+                self.assertEquals(str(len(data)), response.get_header('Content-length'))
+                self.assertEquals(data, response.body)
+                response = cnn.perform(cnn.get('/static?1000'))
+                self.assertEquals(data[1000:], response.body)
+                #a pipe is not sent with sendfile
+                response = cnn.perform(cnn.get('/pipe'))
+                self.assertEquals('piped ' * 1000, response.body)
+            finally:
+                cnn.close()
+        finally:
+            os.unlink(self.static_path)
+        
+    def fetch11(self, s, uri):
+        """fetches *uri* over http 1.1 and returns everything the server sends until it closes the connection"""
+        b = Buffer(16384)
+        b.clear()
+        b.write_bytes("GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % uri)
+        b.flip()
+        s.write(b)
+        data = []
+        while True:
+            b.clear()
+            if not s.read(b, 2.0):
+                break #closed
+            b.flip()
+            data.append(b.read_bytes(b.remaining))
+        s.close()
+        return ''.join(data)
+
+    def testShortBody(self):
+        """a body shorter than the Content-Length of the application closes the connection"""
+        response = self.fetch11(Socket.connect(('localhost', SERVER_PORT)), '/short')
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(response.endswith('\r\n\r\nHello'))
+
+    def testFileWrapperNoSendfile(self):
+        """without sendfile the file is copied, but never more than the Content-Length of the application"""
+        import os
+        import errno
+        import tempfile
+        fd, self.static_path = tempfile.mkstemp()
+        def sendfile(*args):
+            raise IOError(errno.ENOSYS, "no sendfile")
+        socket_sendfile, Socket.sendfile = Socket.sendfile, sendfile
+        try:
+            data = 'x' * 100000
+            os.write(fd, data)
+            os.close(fd)
+            cnn = HTTPConnection()
+            try:
+                cnn.connect(('localhost', SERVER_PORT))
+                for i in range(2): #connection is kept alive
+                    response = cnn.perform(cnn.get('/file?1000'))
+                    self.assertEquals(data[:1000], response.body)
+            finally:
+                cnn.close()
+            #a file shorter than the Content-Length closes the connection
+            response = self.fetch11(Socket.connect(('localhost', SERVER_PORT)), '/file?100010')
+            self.assertTrue(response.endswith('\r\n\r\n' + data))
+        finally:
+            Socket.sendfile = socket_sendfile
+            os.unlink(self.static_path)
+
     def testHTTPPost(self):
         cnn = HTTPConnection()
 
@@ -198,6 +445,214 @@ class TestHTTP(unittest.TestCase):
                 self.assertEquals('testhost.nl', self.saver.environ['HTTP_HOST'])
         finally:
             cnn.close()        
+
+    def testStreamingResponse(self):
+        cnn = HTTPConnection()
+        try:
+            cnn.connect(('localhost', SERVER_PORT))
+            response = cnn.perform(cnn.get('/big'))
+            chunks = list(response)
+            self.assertTrue(len(chunks) > 1)
+            self.assertEquals(''.join(['%05d' % i * 2000 for i in range(100)]), ''.join(chunks))
+            #body of a response that was not read yet is buffered when the next response is received
+            cnn.send(cnn.get('/big'))
+            cnn.send(cnn.get('/hello/2'))
+            response1 = cnn.receive()
+            response2 = cnn.receive()
+            self.assertEquals('Hello World 2', response2.body)
+            self.assertEquals(1000000, len(response1.body))
+            #skip the rest of the body
+            response = cnn.perform(cnn.get('/big'))
+            response.iter.next()
+            response.close()
+            self.assertEquals('Hello World 3', cnn.perform(cnn.get('/hello/3')).body)
+        finally:
+            cnn.close()
+
+    def testRequestAsync(self):
+        self.server.single_tasklet = False
+        cnn = HTTPConnection()
+        try:
+            cnn.connect(('localhost', SERVER_PORT))
+            flushes = []
+            writer = cnn._stream.writer
+            def flush(_flush = writer.flush):
+                flushes.append(True)
+                _flush()
+            writer.flush = flush
+            #requests of concurrent tasks are sent with a single flush and the responses matched in order
+            def fetch(i):
+                return cnn.request_async(cnn.get('/sleep?%d' % (i % 2))).get()
+            start = time.time()
+            tasks = [Tasklet.new(fetch)(i) for i in range(6)]
+            responses = Tasklet.join_all(tasks)
+            self.assertEquals(['slept %d' % (i % 2) for i in range(6)], [response.body for response in responses])
+            self.assertEquals(1, len(flushes))
+            self.assertAlmostEqual(1, time.time() - start, places = 1)
+            #futures from a single task
+            futures = [cnn.request_async(cnn.get('/hello/%d' % i)) for i in range(5)]
+            self.assertEquals(['Hello World %d' % i for i in reversed(range(5))], [future.get().body for future in reversed(futures)])
+            self.assertTrue(futures[0].done())
+            self.assertEquals(2, len(flushes))
+            #timeout
+            future = cnn.request_async(cnn.get('/sleep?1'))
+            self.assertRaises(TimeoutError, future.get, 0.5)
+        finally:
+            cnn.close()
+
+    def testReadUntilClose(self):
+        def handler(socket):
+            stream = BufferedStream(socket)
+            stream.reader.read_line()
+            stream.writer.write_bytes("HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n" + "x" * 100000)
+            stream.writer.flush()
+            stream.close()
+        server = Server.serve(('0.0.0.0', SERVER_PORT + 1), handler)
+        try:
+            cnn = HTTPConnection()
+            cnn.connect(('localhost', SERVER_PORT + 1))
+            try:
+                self.assertEquals('x' * 100000, cnn.perform(cnn.get('/')).body)
+                self.assertRaises(HTTPError, cnn.perform, cnn.get('/'))
+            finally:
+                cnn.close()
+        finally:
+            server.close()
+
+    def testHeadAsync(self):
+        def handler(socket):
+            stream = BufferedStream(socket)
+            try:
+                while True:
+                    method = stream.reader.read_line().split()[0]
+                    while stream.reader.read_line(): pass
+                    stream.writer.write_bytes("HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n")
+                    if method != 'HEAD':
+                        stream.writer.write_bytes("hello")
+                    stream.writer.flush()
+            except EOFError:
+                pass
+            stream.close()
+        server = Server.serve(('0.0.0.0', SERVER_PORT + 2), handler)
+        try:
+            cnn = HTTPConnection()
+            cnn.connect(('localhost', SERVER_PORT + 2))
+            try:
+                #the response of a queued HEAD request has no body, even when it is received before the request is flushed
+                self.assertEquals('', cnn.request_async(cnn.head('/')).get(2).body)
+                futures = [cnn.request_async(cnn.head('/')), cnn.request_async(cnn.get('/')), cnn.request_async(cnn.head('/'))]
+                self.assertEquals(['', 'hello', ''], [future.get(2).body for future in futures])
+                self.assertEquals('hello', cnn.perform(cnn.get('/')).body)
+            finally:
+                cnn.close()
+        finally:
+            server.close()
+
+    def testConnectionPool(self):
+        pool = HTTPConnectionPool(max_connections = 2)
+        endpoint = ('localhost', SERVER_PORT)
+        try:
+            for i in range(3):
+                response = pool.perform(endpoint, HTTPRequest('/hello/%d' % i, 'GET'))
+                self.assertEquals('Hello World %d' % i, response.body)
+            #keep-alive connection was reused
+            self.assertEquals(1, pool.connection_count)
+            self.assertEquals(1, pool.idle_connection_count)
+
+            #no more than 2 connections, the third request waits
+            start = time.time()
+            tasks = [Tasklet.new(pool.perform)(endpoint, HTTPRequest('/sleep?1', 'GET')) for i in range(3)]
+            self.assertEquals(['slept 1'] * 3, [response.body for response in Tasklet.join_all(tasks)])
+            self.assertAlmostEqual(2, time.time() - start, places = 1)
+            self.assertEquals(2, pool.connection_count)
+            #connection is returned when the streamed body was read
+            response = pool.perform(endpoint, HTTPRequest('/big', 'GET'), stream = True)
+            self.assertEquals(1, pool.idle_connection_count)
+            self.assertEquals(1000000, len(response.body))
+            self.assertEquals(2, pool.idle_connection_count)
+            statistics = pool.__statistics__()
+            self.assertEquals(2, statistics['connections']['connection_new'].count)
+
+            #waiting for a connection times out
+            def busy():
+                pool.perform(endpoint, HTTPRequest('/sleep?1', 'GET'))
+            tasks = [Tasklet.new(busy)() for i in range(2)]
+            Tasklet.sleep(0.1)
+            try:
+                with Timeout.push(0.5):
+                    pool.perform(endpoint, HTTPRequest('/hello/1', 'GET'))
+                self.fail('expected timeout')
+            except TimeoutError:
+                pass
+            Tasklet.join_all(tasks)
+        finally:
+            pool.close()
+        self.assertEquals(0, pool.connection_count)
+
+    def testConnectionPoolStale(self):
+        """the server closes idle connections, the pool retries on a new one"""
+        self.server.read_timeout = 1
+        pool = HTTPConnectionPool()
+        endpoint = ('localhost', SERVER_PORT)
+        try:
+            self.assertEquals('Hello World 1', pool.perform(endpoint, HTTPRequest('/hello/1', 'GET')).body)
+            Tasklet.sleep(1.5)
+            self.assertEquals('Hello World 2', pool.perform(endpoint, HTTPRequest('/hello/2', 'GET')).body)
+            self.assertEquals(1, pool.__statistics__()['connections']['retry'].count)
+            self.assertEquals(1, pool.connection_count)
+            #a request that is not idempotent is not retried
+            Tasklet.sleep(1.5)
+            request = HTTPRequest('/post', 'POST')
+            request.body = 'data'
+            self.assertRaises(HTTPError, pool.perform, endpoint, request)
+            self.assertEquals(1, pool.__statistics__()['connections']['retry'].count)
+            self.assertEquals(0, pool.connection_count)
+        finally:
+            pool.close()
+
+    def testConnectionPoolIdle(self):
+        pool = HTTPConnectionPool(idle_timeout = 0.5, idle_reaper_interval = 0.25)
+        try:
+            pool.perform(('localhost', SERVER_PORT), HTTPRequest('/hello/1', 'GET'))
+            self.assertEquals(1, pool.idle_connection_count)
+            Tasklet.sleep(1.0)
+            self.assertEquals(0, pool.connection_count)
+        finally:
+            pool.close()
+
+class TestWSGIRequest(unittest.TestCase):
+    def testWriteResponseBenchmark(self):
+        from concurrence.io import IOStream, BufferedWriter
+        from concurrence.http.server import WSGIRequest
+        
+        class NullStream(IOStream):
+            written = ''
+            def write(self, buffer, timeout = -1.0):
+                self.written = buffer.read_bytes(-1)
+                return len(self.written)
+            
+        stream = NullStream()
+        writer = BufferedWriter(stream, Buffer(1024 * 8))
+        request = WSGIRequest(None)
+        request.version = 'HTTP/1.0'
+        request.start_response('200 OK', [('Content-type', 'application/json'), ('Server', 'not me'), ('X-Count', 1)])
+        
+        request.write_response(['{"a": 1}'], writer)
+        head, body = stream.written.split('\r\n\r\n')
+        lines = head.split('\r\n')
+        self.assertEquals('HTTP/1.0 200 OK', lines[0])
+        self.assertEquals(['Content-type: application/json', 'X-Count: 1'], lines[1:3])
+        self.assertTrue(lines[3].startswith('Date: '))
+        self.assertTrue(lines[4].startswith('Server: Concurrence-Http/'))
+        self.assertEquals(['Content-length: 8'], lines[5:])
+        self.assertEquals('{"a": 1}', body)
+        
+        N = 20000
+        start = time.time()
+        for i in xrange(N):
+            request.write_response(['{"a": 1}'], writer)
+        end = time.time()
+        logging.info("write_response: %d responses/s", N / (end - start))
         
 if __name__ == '__main__':
     unittest.main(timeout = 100.0)
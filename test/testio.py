@@ -1,7 +1,8 @@
 
-from concurrence import unittest, dispatch, TimeoutError, Tasklet
-from concurrence.core import FileDescriptorEvent
-from concurrence.io import Socket
+from concurrence import unittest, dispatch, TimeoutError, Tasklet, _event
+from concurrence.core import FileDescriptorEvent, EdgeTriggeredFileDescriptorEvent
+from concurrence.io import Socket, SocketServer, BufferedStream, Buffer
+from concurrence.io.socket import SO_REUSEPORT
 
 
 class TestIO(unittest.TestCase):
@@ -17,5 +18,140 @@ class TestIO(unittest.TestCase):
 
         #TODO test why is socket.readable event not deallocated immediatly?
 
+    def testEdgeTriggered(self):
+        if not _event.has_edge_triggered():
+            return #not supported by libevent method
+        
+        class EdgeTriggeredSocket(Socket):
+            edge_triggered = True
+            
+        def echo(socket):
+            buffer = Buffer(1024)
+            while True:
+                buffer.clear()
+                if not socket.read(buffer):
+                    break #eof
+                buffer.flip()
+                while buffer.remaining:
+                    socket.write(buffer)
+
+        server = SocketServer(EdgeTriggeredSocket.from_address(('127.0.0.1', 9082)), echo)
+        server._socket.set_reuse_address(True)
+        server._socket.bind(('127.0.0.1', 9082))
+        server.listen()
+        server.serve()
+        
+        try:
+            client = EdgeTriggeredSocket.connect(('127.0.0.1', 9082))
+            self.assertTrue(isinstance(client.readable, EdgeTriggeredFileDescriptorEvent))
+            stream = BufferedStream(client)
+            #some big lines, so that we will get EAGAIN on writes and multiple edges on reads
+            for n in [1, 10, 1000, 100000]:
+                stream.writer.write_bytes('x' * n)
+                stream.writer.flush()
+                self.assertEquals('x' * n, stream.reader.read_bytes(n))
+            
+            try:
+                client.read(stream.reader.buffer, timeout = 0.5)
+                self.fail('expected timeout')
+            except TimeoutError:
+                pass #expected
+            
+            stream.close()
+        finally:
+            server.close()
+
+        #a socket that is not closed explicitly is collected, also when part of a cycle, and its events are closed
+        import gc
+        socket = EdgeTriggeredSocket.new()
+        readable = socket.readable
+        socket.cycle = socket
+        del socket
+        gc.collect()
+        self.assertEquals([], gc.garbage)
+        self.assertEquals(None, readable._event)
+
+    def testPrefork(self):
+        import os
+        import sys
+        import signal
+        import subprocess
+        
+        script = """
+import os
+from concurrence.io import PreforkServer, BufferedStream
+def main(socket):
+    def handler(client):
+        stream = BufferedStream(client)
+        stream.writer.write_bytes('%d\\n' % os.getpid())
+        stream.writer.flush()
+        stream.close()
+    from concurrence.io import SocketServer
+    SocketServer(socket, handler).serve()
+PreforkServer(('127.0.0.1', 9083), workers = 2).serve(main)
+"""
+        supervisor = subprocess.Popen([sys.executable, '-c', script], env = dict(os.environ, PYTHONPATH = ':'.join(sys.path)))
+        try:
+            Tasklet.sleep(1.0)
+            pids = set()
+            for i in range(40):
+                stream = BufferedStream(Socket.connect(('127.0.0.1', 9083)))
+                pids.add(int(stream.reader.read_line()))
+                stream.close()
+            self.assertTrue(supervisor.pid not in pids)
+            if SO_REUSEPORT is not None:
+                #connections are spread over the workers by the kernel, without it the workers just race for accept 
+                self.assertEquals(2, len(pids))
+            
+            #a worker that dies is restarted
+            os.kill(pids.pop(), signal.SIGKILL)
+            Tasklet.sleep(1.5)
+            for i in range(10):
+                stream = BufferedStream(Socket.connect(('127.0.0.1', 9083)))
+                self.assertTrue(int(stream.reader.read_line()) > 0)
+                stream.close()
+        finally:
+            os.kill(supervisor.pid, signal.SIGTERM)
+            while supervisor.poll() is None:
+                Tasklet.sleep(0.1)
+        self.assertEquals(0, supervisor.returncode)
+
+    def testPreforkExit(self):
+        import os
+        import sys
+        import signal
+        import tempfile
+        import subprocess
+        
+        script = """
+import sys
+import logging
+logging.basicConfig()
+from concurrence.io import PreforkServer
+def main(socket):
+    sys.exit('worker stops')
+server = PreforkServer(('127.0.0.1', 9084), workers = 1)
+server.restart_delay = 10.0
+server.serve(main)
+"""
+        errors = tempfile.TemporaryFile()
+        supervisor = subprocess.Popen([sys.executable, '-c', script], env = dict(os.environ, PYTHONPATH = ':'.join(sys.path)), 
+                                      stderr = errors)
+        try:
+            for i in range(100):
+                Tasklet.sleep(0.1)
+                errors.seek(0)
+                if 'exited with status' in errors.read():
+                    break
+        finally:
+            os.kill(supervisor.pid, signal.SIGTERM)
+            while supervisor.poll() is None:
+                Tasklet.sleep(0.1)
+        #the message is logged and the worker exits with status 1
+        errors.seek(0)
+        errors = errors.read()
+        self.assertTrue('prefork worker exited: worker stops' in errors, errors)
+        self.assertTrue('exited with status 256' in errors, errors)
+
 if __name__ == '__main__':
     unittest.main(timeout = 10.0)
@@ -1,7 +1,15 @@
 import os
+import time
 
-from concurrence import unittest, Tasklet
-from concurrence.memcache.client import MemcacheNode, MemcacheError
+from concurrence import unittest, Tasklet, TimeoutError
+from concurrence.memcache.client import MemcacheNode, MemcacheBinaryNode, MemcacheClient, MemcacheError
+from concurrence.memcache import _memcache
+from concurrence.memcache.nearcache import NearCache
+from concurrence.io import Buffer, BufferUnderflowError, BufferedStream, Server
+from concurrence.memcache.ketama import Ketama
+from concurrence.memcache.codec import DefaultCodec, RawCodec, PickleCodec, FLAG_PICKLE, FLAG_INTEGER, FLAG_COMPRESSED
+
+MEMCACHE_SERVERS = [('127.0.0.1', 11211), ('127.0.0.1', 11212), ('127.0.0.1', 11213)]
 
 class MemcacheTest(unittest.TestCase):
     def testNodeBasic(self):
@@ -31,5 +39,397 @@ class MemcacheTest(unittest.TestCase):
 
         node.close()
         
+    def testCommands(self):
+        self.sharedTestCommands(MemcacheNode())
+
+    def testCommandsBinary(self):
+        self.sharedTestCommands(MemcacheBinaryNode())
+
+    def sharedTestCommands(self, node):
+        node.connect(MEMCACHE_SERVERS[0])
+        node.delete('cmd1')
+        node.delete('cmd2')
+        
+        self.assertEquals(True, node.add('cmd1', 'a'))
+        self.assertEquals(False, node.add('cmd1', 'b'))
+        self.assertEquals(False, node.replace('cmd2', 'b'))
+        self.assertEquals(True, node.replace('cmd1', 'b'))
+        self.assertEquals(True, node.append('cmd1', 'c'))
+        self.assertEquals(True, node.prepend('cmd1', 'a'))
+        self.assertEquals(False, node.append('cmd2', 'c'))
+        self.assertEquals('abc', node.get('cmd1'))
+
+        value, cas_unique = node.gets('cmd1')
+        self.assertEquals('abc', value)
+        self.assertEquals(True, node.cas('cmd1', 'def', cas_unique))
+        self.assertEquals(False, node.cas('cmd1', 'ghi', cas_unique))
+        self.assertEquals({'cmd1': 'def'}, dict([(key, value) for key, (value, _) in node.gets(['cmd1', 'cmd2']).items()]))
+
+        self.assertEquals(True, node.delete('cmd1'))
+        self.assertEquals(False, node.delete('cmd1'))
+
+        #counters
+        self.assertEquals(None, node.incr('cmd1'))
+        node.set('cmd1', 10)
+        self.assertEquals(11, node.incr('cmd1'))
+        self.assertEquals(21, node.incr('cmd1', 10))
+        self.assertEquals(20, node.decr('cmd1'))
+        self.assertEquals(20, node.get('cmd1'))
+
+        #noreply commands do not wait for the server
+        self.assertEquals(None, node.set('cmd2', 'x', noreply = True))
+        self.assertEquals(None, node.incr('cmd1', noreply = True))
+        self.assertEquals('x', node.get('cmd2'))
+        self.assertEquals(21, node.get('cmd1'))
+
+        #expiration
+        node.set('cmd2', 'x', 1)
+        self.assertEquals('x', node.get('cmd2'))
+        Tasklet.sleep(2.1)
+        self.assertEquals(None, node.get('cmd2'))
+        
+        #errors of a single command do not break the connection
+        node.set('cmd2', 'x')
+        self.assertRaises(MemcacheError, node.incr, 'cmd2')
+        self.assertEquals(21, node.get('cmd1'))
+        node.close()
+
+    def testBinaryPackets(self):
+        self.assertEquals('\x80\x01\x00\x03\x02\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00\x09' + '\x00' * 7 + '\x05' + 'xykeyab',
+                          _memcache.pack_request(0x01, 'key', 'xy', 'ab', 9, 5))
+        packet = _memcache.pack_getkq(['a', 'bc'])
+        self.assertEquals(24 * 3 + 3, len(packet))
+        self.assertEquals(['\x0d', '\x0d', '\x0a'], [packet[1], packet[26], packet[52]])
+
+        response = '\x81\x0d\x00\x03\x04\x00\x00\x00\x00\x00\x00\x0a\x00\x00\x00\x00' + '\x00' * 7 + '\x2a' + '\x00\x00\x00\x02' + 'key' + 'abc'
+        buffer = Buffer(1024)
+        buffer.write_bytes(response[:30])
+        buffer.flip()
+        self.assertEquals(34, _memcache.packet_length(buffer))
+        self.assertRaises(BufferUnderflowError, _memcache.read_response, buffer)
+        self.assertEquals(0, buffer.position)
+        buffer.clear()
+        buffer.write_bytes(response + response[:10])
+        buffer.flip()
+        self.assertEquals((0x0d, 0, 42, 2, 'key', 'abc'), _memcache.read_response(buffer))
+        self.assertEquals(10, buffer.remaining)
+        self.assertEquals(-1, _memcache.packet_length(buffer))
+
+    def testBinaryGet(self):
+        node = MemcacheBinaryNode()
+        node.connect(MEMCACHE_SERVERS[0])
+        keys = ['binary%d' % i for i in range(100)]
+        for i, key in enumerate(keys):
+            node.set(key, i, noreply = True)
+        node.set('binarybig', 'x' * 100000) #does not fit in the read buffer
+        values = node.get(keys + ['binarybig', 'missing'])
+        self.assertEquals(dict([(key, i) for i, key in enumerate(keys)] + [('binarybig', 'x' * 100000)]), values)
+        self.assertEquals(None, node.get('missing'))
+        #a failing noreply command does not disturb the responses of other commands
+        node.add('binary0', 'x', noreply = True)
+        self.assertEquals(0, node.get('binary0'))
+        node.close()
+
+        client = MemcacheClient(MEMCACHE_SERVERS, protocol = 'binary')
+        client.set('binary0', 'y')
+        self.assertEquals({'binary0': 'y'}, client.get(['binary0', 'missing']))
+        client.close()
+
+    def testCodec(self):
+        codec = DefaultCodec()
+        self.assertEquals(('abc', 0), codec.encode('abc'))
+        self.assertEquals(('10', FLAG_INTEGER), codec.encode(10))
+        self.assertEquals(FLAG_PICKLE, codec.encode(u'C\xe9line')[1])
+        for value in ['abc', 10, 10L, u'C\xe9line', {'a': [1, 2]}, None]:
+            self.assertEquals(value, codec.decode(*codec.encode(value)))
+            self.assertEquals(type(value), type(codec.decode(*codec.encode(value))))
+        codec = DefaultCodec(compress_threshold = 100)
+        encoded, flags = codec.encode('x' * 1000)
+        self.assertTrue(flags & FLAG_COMPRESSED)
+        self.assertTrue(len(encoded) < 100)
+        self.assertEquals('x' * 1000, codec.decode(encoded, flags))
+        self.assertEquals((['x' * 1000], FLAG_PICKLE | FLAG_COMPRESSED), (codec.decode(*codec.encode(['x' * 1000])), codec.encode(['x' * 1000])[1]))
+        self.assertRaises(TypeError, RawCodec().encode, 10)
+        self.assertEquals(10, PickleCodec().decode(*PickleCodec().encode(10)))
+
+    def testGetCoalescing(self):
+        node = MemcacheNode()
+        node.connect(MEMCACHE_SERVERS[0])
+        for i in range(10):
+            node.set('coalesce%d' % i, i)
+        node.set('hot', 'hot')
+        
+        written = []
+        writer = node._stream.writer
+        def write_bytes(s, _write_bytes = writer.write_bytes):
+            written.append(s)
+            _write_bytes(s)
+        writer.write_bytes = write_bytes
+
+        def get(i):
+            return node.get('hot'), node.get(['coalesce%d' % i, 'coalesce%d' % ((i + 1) % 10)])
+        tasks = [Tasklet.new(get)(i) for i in range(10)]
+        results = Tasklet.join_all(tasks)
+        for i, (hot, values) in enumerate(results):
+            self.assertEquals('hot', hot)
+            self.assertEquals({'coalesce%d' % i: i, 'coalesce%d' % ((i + 1) % 10): (i + 1) % 10}, values)
+        #hot key fetched once, then all other keys with a single get
+        gets = [s.strip() for s in written if s.startswith('get')]
+        self.assertEquals(['get hot', 'get %s' % ' '.join(['coalesce%d' % i for i in range(10)])], gets)
+
+        #a get queued after a set sees the new value
+        def set():
+            node.set('hot', 'cold')
+        tasks = [Tasklet.new(node.get)('hot'), Tasklet.new(set)(), Tasklet.new(node.get)('hot')]
+        self.assertEquals(['hot', None, 'cold'], Tasklet.join_all(tasks))
+        node.close()
+
+    def testNearCache(self):
+        class Memcache(object):
+            """counts the gets, which take a little while"""
+            def __init__(self):
+                self.values = {}
+                self.gets = []
+            def get(self, keys):
+                self.gets.append(keys)
+                Tasklet.sleep(0.1)
+                return dict([(key, self.values[key]) for key in keys if key in self.values])
+            def set(self, key, value):
+                self.values[key] = value
+                
+        memcache = Memcache()
+        cache = NearCache(memcache, max_entries = 3, max_bytes = 100, ttl = 0.5)
+        for i in range(4):
+            cache.set('near%d' % i, 'x' * 10)
+        #concurrent misses are fetched once
+        tasks = [Tasklet.new(cache.get)('near0') for i in range(5)] + [Tasklet.new(cache.get)(['near0', 'near1', 'near9'])]
+        results = Tasklet.join_all(tasks)
+        self.assertEquals(['x' * 10] * 5 + [{'near0': 'x' * 10, 'near1': 'x' * 10}], results)
+        self.assertEquals([['near0'], ['near1', 'near9']], [sorted(keys) for keys in memcache.gets])
+        statistics = cache.__statistics__()
+        self.assertEquals(8, statistics['miss'].count)
+        self.assertEquals(5, statistics['wait'].count)
+        self.assertEquals(2, statistics['entries'])
+        #hits
+        self.assertEquals({'near0': 'x' * 10, 'near1': 'x' * 10}, cache.get(['near0', 'near1']))
+        self.assertEquals(2, len(memcache.gets))
+        self.assertEquals(2, statistics['hit'].count)
+        #bounded by number of entries, the least recently used is evicted
+        cache.get('near1')
+        cache.get(['near2', 'near3'])
+        self.assertEquals(3, cache.__statistics__()['entries'])
+        self.assertEquals(1, statistics['eviction'].count)
+        self.assertEquals('x' * 10, cache.get('near1'))
+        self.assertEquals(3, len(memcache.gets))
+        #bounded by bytes
+        cache.set('near4', 'y' * 95)
+        self.assertEquals('y' * 95, cache.get('near4'))
+        self.assertEquals(1, cache.__statistics__()['entries'])
+        self.assertEquals(95, cache.__statistics__()['bytes'])
+        #modifications invalidate
+        cache.set('near4', 'z')
+        self.assertEquals('z', cache.get('near4'))
+        #expiration
+        n = len(memcache.gets)
+        cache.get('near4')
+        self.assertEquals(n, len(memcache.gets))
+        Tasklet.sleep(0.6)
+        cache.get('near4')
+        self.assertEquals(n + 1, len(memcache.gets))
+
+        #in front of a real memcache node
+        node = MemcacheNode()
+        node.connect(MEMCACHE_SERVERS[0])
+        cache = NearCache(node)
+        cache.set('near5', 'a')
+        self.assertEquals('a', cache.get('near5'))
+        self.assertEquals({'near5': 'a'}, cache.get(['near5', 'near6']))
+        self.assertEquals(1, cache.__statistics__()['hit'].count)
+        node.close()
+
+    def testNearCacheWrite(self):
+        class Memcache(object):
+            """a get reads the value before it takes a while, a set stores it after a while"""
+            def __init__(self):
+                self.values = {'near': 'old'}
+                self.gets = 0
+            def get(self, keys):
+                self.gets += 1
+                values = dict([(key, self.values[key]) for key in keys if key in self.values])
+                Tasklet.sleep(0.2)
+                return values
+            def set(self, key, value):
+                Tasklet.sleep(0.1)
+                self.values[key] = value
+                return True
+
+        memcache = Memcache()
+        cache = NearCache(memcache, ttl = 10.0)
+        def reader():
+            Tasklet.sleep(0.05)
+            return cache.get('near')
+        reader = Tasklet.new(reader)()
+        #the reader gets the old value while the set is in progress, but that is not cached
+        self.assertEquals(True, cache.set('near', 'new'))
+        self.assertEquals('new', cache.get('near'))
+        self.assertEquals(['old'], Tasklet.join_all([reader]))
+        self.assertEquals('new', cache.get('near'))
+        self.assertEquals('new', cache.get(['near'])['near'])
+        self.assertEquals(2, memcache.gets)
+
+    def testKetama(self):
+        servers = [('10.0.0.%d' % i, 11211) for i in range(4)]
+        continuum = Ketama([(server, 1) for server in servers])
+        self.assertEquals(4 * 160, len(continuum))
+        keys = ['key%d' % i for i in range(10000)]
+        mapping = dict([(key, continuum.get_server(key)) for key in keys])
+        #keys are spread evenly
+        for server in servers:
+            self.assertTrue(1500 < mapping.values().count(server) < 3500)
+        #removing a server only moves its own keys
+        continuum.update([(server, 1) for server in servers[:3]])
+        for key in keys:
+            if mapping[key] != servers[3]:
+                self.assertEquals(mapping[key], continuum.get_server(key))
+        #weights
+        continuum.update([(servers[0], 1), (servers[1], 3)])
+        count = [continuum.get_server(key) for key in keys].count(servers[1])
+        self.assertTrue(6500 < count < 8500)
+        self.assertEquals(None, Ketama().get_server('key'))
+
+    def testClient(self):
+        client = MemcacheClient(MEMCACHE_SERVERS)
+        keys = ['client%d' % i for i in range(100)]
+        for i, key in enumerate(keys):
+            client.set(key, i)
+        self.assertEquals(dict([(key, i) for i, key in enumerate(keys)]), client.get(keys + ['missing']))
+        self.assertEquals(10, client.get('client10'))
+        self.assertEquals(None, client.get('missing'))
+        #every server has its own part of the keys
+        for server in MEMCACHE_SERVERS:
+            node = MemcacheNode()
+            node.connect(server)
+            self.assertTrue(10 < len(node.get(keys)) < 60)
+            node.close()
+        client.close()
+
+    def testClientEject(self):
+        dead = ('127.0.0.1', 11299) #nothing listening here
+        client = MemcacheClient([MEMCACHE_SERVERS[0], dead], retry_interval = 1.0)
+        keys = ['eject%d' % i for i in range(20)]
+        #the first command on the dead server fails, its keys move to the other server
+        errors = 0
+        for key in keys:
+            try:
+                client.set(key, key)
+            except MemcacheError:
+                errors += 1
+        self.assertEquals(1, errors)
+        self.assertEquals(19, len(client.get(keys)))
+        #after retry_interval the server is tried again, a get of its keys returns them as missing
+        Tasklet.sleep(1.0)
+        continuum = Ketama([(MEMCACHE_SERVERS[0], 1), (dead, 1)])
+        alive = [key for key in keys if continuum.get_server(key) != dead]
+        self.assertEquals(sorted(alive), sorted(client.get(keys).keys()))
+        client.close()
+
+    def testClientBackoff(self):
+        #a server that closes every connection it accepts
+        connections = []
+        def handler(socket):
+            connections.append(socket)
+            socket.close()
+        server = Server.serve(('127.0.0.1', 11296), handler)
+        try:
+            #the server is retried immediately after being ejected, but the node does not reconnect within its backoff
+            client = MemcacheClient([('127.0.0.1', 11296)], retry_interval = 0.0)
+            for i in range(10):
+                self.assertRaises(MemcacheError, client.set, 'backoff', 'a')
+            self.assertEquals(1, len(connections))
+            Tasklet.sleep(0.2)
+            self.assertRaises(MemcacheError, client.set, 'backoff', 'a')
+            self.assertEquals(2, len(connections))
+            client.close()
+        finally:
+            server.close()
+
+    def testNodeFailWhileWriting(self):
+        #a memcached that never answers
+        def handler(socket):
+            stream = BufferedStream(socket)
+            try:
+                while True:
+                    stream.reader.read_line()
+            except EOFError:
+                pass
+        server = Server.serve(('127.0.0.1', 11298), handler)
+        try:
+            node = MemcacheNode()
+            node.connect(('127.0.0.1', 11298))
+            #the writer blocks after it took the command from the queue
+            writer = node._stream.writer
+            writer.flush = lambda: Tasklet.sleep(10)
+            errors = []
+            def get():
+                try:
+                    node.get('blocked')
+                except MemcacheError, e:
+                    errors.append(e)
+            Tasklet.new(get)()
+            Tasklet.sleep(0.1)
+            #the command is failed when the writer is killed by the disconnect
+            node._fail(IOError("connection failed"))
+            Tasklet.sleep(0.1)
+            self.assertEquals(1, len(errors))
+            node.close()
+        finally:
+            server.close()
+
+    def testNodeTimeout(self):
+        #a memcached that answers every get with END after a delay, or closes the connection
+        delay = [0.2]
+        def handler(socket):
+            stream = BufferedStream(socket)
+            while True:
+                line = stream.reader.read_line()
+                if line == 'get close':
+                    stream.close()
+                    return
+                Tasklet.sleep(delay[0])
+                stream.writer.write_bytes('END\r\n')
+                stream.writer.flush()
+        server = Server.serve(('127.0.0.1', 11297), handler)
+        try:
+            node = MemcacheNode(timeout = 0.1, max_timeouts = 2, backoff = 0.5)
+            node.connect(('127.0.0.1', 11297))
+            #the late answer to a command that timed out is discarded
+            self.assertRaises(TimeoutError, node.get, 'slow1')
+            delay[0] = 0.0
+            Tasklet.sleep(0.2)
+            self.assertEquals(None, node.get('slow2'))
+            #consecutive timeouts close the connection, after which commands fail immediately until the backoff has passed
+            delay[0] = 0.2
+            self.assertRaises(TimeoutError, node.get, 'slow3')
+            self.assertRaises(TimeoutError, node.get, 'slow4')
+            self.assertFalse(node.is_connected())
+            start = time.time()
+            self.assertRaises(MemcacheError, node.get, 'slow5')
+            self.assertTrue(time.time() - start < 0.05)
+            delay[0] = 0.0
+            Tasklet.sleep(0.5)
+            self.assertEquals(None, node.get('slow6'))
+            self.assertTrue(node.is_connected())
+            #the commands waiting on a connection that fails get an error
+            self.assertRaises(MemcacheError, node.get, 'close')
+            self.assertFalse(node.is_connected())
+            self.assertRaises(MemcacheError, node.get, 'slow7')
+            Tasklet.sleep(1.0)
+            self.assertEquals(None, node.get('slow8'))
+            #a closed node does not reconnect
+            node.close()
+            self.assertRaises(MemcacheError, node.get, 'slow9')
+        finally:
+            server.close()
+
 if __name__ == '__main__':
     unittest.main(timeout = 60)
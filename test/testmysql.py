@@ -2,15 +2,65 @@
 from __future__ import with_statement
 
 import time
+import struct
+import datetime
 
 from concurrence import dispatch, unittest, Tasklet
-from concurrence.database.mysql import client, dbapi, PacketReadError
+from concurrence.io import Buffer, BufferedStream, Server
+from concurrence.database.mysql import client, dbapi, PacketReadError, PacketReader, PACKET_READ_RESULT
 
 DB_HOST = 'localhost'
 DB_USER = 'concurrence_test'
 DB_PASSWD = 'concurrence_test'
 DB_DB = 'concurrence_test'
 
+def serve_fake_mysql(port):
+    """serves a minimal mysql server, that answers queries of the form 'select n', 'update...', 'SET...' and 'multi', which 
+    returns 2 results. Queries containing 'error' fail, 'multi error' fails in its second statement. Returns the server and 
+    the list of queries it received"""
+    def packet(number, payload):
+        return struct.pack('<I', len(payload) | (number << 24)) + payload
+    def field(name):
+        return ''.join([chr(len(s)) + s for s in ['def', '', '', '', name, '']]) + '\x0c\x08\x00\x00\x00\x00\x00\xfd\x00\x00\x00\x00\x00'
+    error = '\xff\x28\x04#42000syntax error'
+    received = []
+    def handler(socket):
+        stream = BufferedStream(socket)
+        reader, writer = stream.reader, stream.writer
+        def read_packet():
+            n = struct.unpack('<I', reader.read_bytes(4))[0] & 0xffffff
+            return reader.read_bytes(n)
+        writer.write_bytes(packet(0, '\x0afake\x00' + '\x01\x00\x00\x00' + 'abcdefgh\x00' + struct.pack('<HBH', 512 | 32768, 8, 2) + 
+                                  '\x00' * 13 + 'ijklmnopqrst\x00'))
+        writer.flush()
+        read_packet() #auth
+        writer.write_bytes(packet(2, '\x00\x00\x00\x02\x00\x00\x00'))
+        writer.flush()
+        while True:
+            try:
+                query = read_packet()[1:]
+            except EOFError:
+                return #client closed the connection
+            received.append(query)
+            if query.startswith('multi'):
+                writer.write_bytes(packet(1, '\x00\x01\x00\x0a\x00\x00\x00'))
+                if 'error' in query:
+                    writer.write_bytes(packet(2, error))
+                else:
+                    writer.write_bytes(packet(2, '\x00\x02\x00\x02\x00\x00\x00'))
+            elif 'error' in query:
+                writer.write_bytes(packet(1, error))
+            elif query.startswith('select'):
+                value = query.split(' ')[1]
+                writer.write_bytes(packet(1, '\x01') + packet(2, field('n')) + packet(3, '\xfe\x00\x00\x02\x00') +
+                                   packet(4, chr(len(value)) + value) + packet(5, '\xfe\x00\x00\x02\x00'))
+            elif query.startswith('update') or query.startswith('SET'):
+                writer.write_bytes(packet(1, '\x00\x01\x00\x02\x00\x00\x00'))
+            else:
+                writer.write_bytes(packet(1, error))
+            writer.flush()
+    return Server.serve(('127.0.0.1', port), handler), received
+
 class TestMySQL(unittest.TestCase):
     
     def testMySQLClient(self):
@@ -279,6 +329,290 @@ class TestMySQL(unittest.TestCase):
         self.assertEquals(str, type(b2))
         self.assertEquals(256, len(b2))
         self.assertEquals(blob, b2)
+
+    def testPreparedStatement(self):
+        cnn = client.Connection(statement_cache_size = 2)
+        cnn.connect(host = DB_HOST, user = DB_USER, passwd = DB_PASSWD, db = DB_DB)
+        
+        cnn.query("truncate tbltest")
+
+        for i in range(10):
+            self.assertEquals((1, 0), cnn.execute("insert into tbltest (test_id, test_string, test_blob) values (?, ?, ?)", 
+                                                  (i, 'test%d' % i, '\0\xff' * i)))
+
+        rs = cnn.execute("select test_id, test_string, test_blob, null, 1.5, cast('2009-01-02 03:04:05' as datetime) from tbltest where test_id < ?", (3,))
+        self.assertEquals(['test_id', 'test_string', 'test_blob', 'NULL', '1.5', "cast('2009-01-02 03:04:05' as datetime)"], 
+                          [name for name, _ in rs.fields])
+        for i, row in enumerate(rs):
+            self.assertEquals((i, 'test%d' % i, '\0\xff' * i, None, '1.5', datetime.datetime(2009, 1, 2, 3, 4, 5)), row)
+        rs.close()
+
+        #statements are prepared once, the least recently used is closed when the cache is full
+        statement = cnn.prepare("select test_id from tbltest where test_id = ?")
+        self.assertTrue(statement is cnn.prepare("select test_id from tbltest where test_id = ?"))
+        cnn.prepare("select 1")
+        cnn.prepare("select 2")
+        self.assertFalse(statement is cnn.prepare("select test_id from tbltest where test_id = ?"))
+        #a statement that was closed when it was evicted is prepared again when it is executed
+        cnn.prepare("select 1")
+        cnn.prepare("select 3")
+        rs = cnn.execute(statement, (1,))
+        self.assertEquals([(1,)], list(rs))
+        rs.close()
+
+        self.assertRaises(client.ClientProgrammingError, cnn.execute, statement, ())
+        self.assertRaises(client.ClientCommandError, cnn.prepare, "select from")
+        
+        cnn.close()
+
+    def testBinaryRows(self):
+        fields = [('a', 1, 0), ('b', 3, 0), ('c', 8, 32), ('d', 5, 0), ('e', 0xfd, 0), ('f', 12, 0), ('g', 11, 0), 
+                  ('h', 3, 0), ('i', 10, 0), ('j', 12, 0)]
+        row = ''.join(['\x00', '\x00\x02', #the null bitmap is offset by 2 bits, 'h' is null
+                       '\xff', struct.pack('<i', 123456), struct.pack('<Q', 2 ** 64 - 1), struct.pack('<d', 1.5), '\x05hello',
+                       struct.pack('<BHBBBBB', 7, 2009, 1, 2, 3, 4, 5), struct.pack('<BBIBBBI', 12, 1, 1, 2, 3, 4, 5),
+                       struct.pack('<BHBB', 4, 2009, 12, 31), '\x00'])
+        buffer = Buffer(1024)
+        for i, packet in enumerate([row, row, '\xfe\x00\x00\x02\x00']):
+            buffer.write_bytes(struct.pack('<I', len(packet) | (i << 24)) + packet)
+        buffer.flip()
+
+        reader = PacketReader(buffer)
+        result, rows = reader.read_rows(fields, 100, True)
+        expected = (-1, 123456, 2 ** 64 - 1, 1.5, 'hello', datetime.datetime(2009, 1, 2, 3, 4, 5), 
+                    -datetime.timedelta(1, 2 * 3600 + 3 * 60 + 4, 5), None, datetime.date(2009, 12, 31), None)
+        self.assertEquals([expected, expected], rows)
+
+    def testReadColumns(self):
+        from array import array
+        fields = [('a', 3), ('b', 0xfd)]
+        buffer = Buffer(1024)
+        packets = ['\x01%d\x04row%d' % (i, i) for i in range(5)] + ['\xfe\x00\x00\x02\x00']
+        for i, packet in enumerate(packets):
+            buffer.write_bytes(struct.pack('<I', len(packet) | (i << 24)) + packet)
+        buffer.flip()
+
+        reader = PacketReader(buffer)
+        columns = [array('l'), []]
+        result, n = reader.read_columns(fields, columns, 3)
+        self.assertEquals(3, n)
+        self.assertEquals([array('l', [0, 1, 2]), ['row0', 'row1', 'row2']], columns)
+        result, n = reader.read_columns(fields, columns, 3)
+        self.assertEquals(2, n)
+        self.assertTrue(result & PACKET_READ_RESULT.EOF)
+        self.assertEquals([array('l', [0, 1, 2, 3, 4]), ['row0', 'row1', 'row2', 'row3', 'row4']], columns)
+
+    def testStreamingCursor(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER, passwd = DB_PASSWD, db = DB_DB)
+        cur = cnn.cursor(dbapi.SSCursor)
+        cur.execute("truncate tbltest")
+        cur.executemany("insert into tbltest (test_id, test_string, test_blob) values (%s, %s, '')", [(i, 'test%d' % i) for i in range(1000)])
+
+        cur.execute("select test_id, test_string from tbltest order by test_id")
+        self.assertEquals([(0, 'test0')], cur.fetchmany())
+        self.assertEquals([(1, 'test1'), (2, 'test2')], cur.fetchmany(2))
+        self.assertEquals(range(3, 1000), [row[0] for row in cur])
+        self.assertEquals([], cur.fetchmany(10))
+
+        cur.execute("select test_id, test_string from tbltest order by test_id")
+        ids, strings = cur.fetchcolumns(600)
+        self.assertEquals(range(600), ids)
+        self.assertEquals(['test%d' % i for i in range(600)], strings)
+        ids, strings = cur.fetchcolumns(600)
+        self.assertEquals(range(600, 1000), ids)
+        self.assertEquals([[], []], cur.fetchcolumns(600))
+        
+        #a partially read result is discarded by the next query
+        cur.execute("select test_id from tbltest")
+        cur.fetchcolumns(10)
+        cur.execute("select count(*) from tbltest")
+        self.assertEquals((1000, ), cur.fetchone())
+        
+        cur.close()
+        cnn.close()
+
+    def testPipeline(self):
+        server, received = serve_fake_mysql(13306)
+        try:
+            cnn = client.connect(host = '127.0.0.1', port = 13306, user = DB_USER, passwd = DB_PASSWD)
+            
+            self.assertFalse(cnn.has_more_results())
+            cnn.pipeline(["select 1", "update", "bla", "select 2", "multi"])
+            rs = cnn.next_result()
+            self.assertEquals([('1',)], list(rs))
+            rs.close()
+            self.assertEquals((1, 0), cnn.next_result())
+            self.assertRaises(client.ClientCommandError, cnn.next_result)
+            rs = cnn.next_result()
+            self.assertEquals([('2',)], list(rs))
+            rs.close()
+            self.assertEquals((1, 0), cnn.next_result())
+            self.assertTrue(cnn.has_more_results())
+            self.assertEquals((2, 0), cnn.next_result())
+            self.assertFalse(cnn.has_more_results())
+            self.assertEquals(None, cnn.next_result())
+            self.assertEquals(["select 1", "update", "bla", "select 2", "multi"], received)
+
+            #a query can not be sent before the results of the previous one are read
+            cnn.query("multi")
+            self.assertRaises(AssertionError, cnn.query, "update")
+            self.assertEquals((2, 0), cnn.next_result())
+            self.assertEquals((1, 0), cnn.query("update"))
+            
+            #the results that were not read are forgotten when the connection fails or is closed
+            cnn.pipeline(["select 1", "update"])
+            cnn.socket.close()
+            self.assertRaises(Exception, cnn.next_result)
+            self.assertFalse(cnn.has_more_results())
+            
+            cnn = client.connect(host = '127.0.0.1', port = 13306, user = DB_USER, passwd = DB_PASSWD)
+            cnn.pipeline(["select 1", "update"])
+            cnn.close()
+            self.assertFalse(cnn.has_more_results())
+        finally:
+            server.close()
+
+    def testDBAPINextSet(self):
+        server, received = serve_fake_mysql(13307)
+        try:
+            cnn = dbapi.connect(host = '127.0.0.1', port = 13307, user = DB_USER, passwd = DB_PASSWD, multi_statements = True)
+            cur = cnn.cursor()
+            cur.execute("multi")
+            self.assertEquals(1, cur.rowcount)
+            self.assertEquals(True, cur.nextset())
+            self.assertEquals(2, cur.rowcount)
+            self.assertEquals(None, cur.nextset())
+            #a later statement that failed is raised by nextset
+            cur.execute("multi error")
+            self.assertRaises(dbapi.Error, cur.nextset)
+            self.assertEquals(None, cur.nextset())
+            #or by the next execute, whose query is then not sent
+            cur.execute("multi error")
+            self.assertRaises(dbapi.Error, cur.execute, "select 1")
+            cur.execute("select 1")
+            self.assertEquals([('1',)], cur.fetchall())
+            self.assertEquals(['multi error', 'select 1'], received[-2:])
+            #or by close
+            cur.execute("multi error")
+            self.assertRaises(dbapi.Error, cur.close)
+            self.assertEquals(True, cur.closed)
+            #a new cursor does not read the pending results of another cursor
+            cur = cnn.cursor()
+            cur.execute("multi")
+            other = cnn.cursor()
+            self.assertEquals(True, cur.nextset())
+            self.assertEquals(2, cur.rowcount)
+            cur.close()
+            other.close()
+            cnn.close()
+        finally:
+            server.close()
+
+    def testDBAPIExecuteMany(self):
+        server, received = serve_fake_mysql(13308)
+        pipeline_size = dbapi.PIPELINE_SIZE
+        dbapi.PIPELINE_SIZE = 2
+        try:
+            cnn = dbapi.connect(host = '127.0.0.1', port = 13308, user = DB_USER, passwd = DB_PASSWD)
+            cur = cnn.cursor()
+            cur.executemany("update tbltest set test_string = %s", [('a',), ('b',), ('c',)])
+            self.assertEquals(3, cur.rowcount)
+            #all statements are executed, also those after a statement that failed
+            del received[:]
+            try:
+                cur.executemany("update tbltest set test_string = %s", [('a',), ('error',), ('c',), ('d',), ('error',)])
+                self.fail("expected error")
+            except dbapi.Error, e:
+                self.assertEquals([1, 4], e.failed_rows)
+            self.assertEquals(3, cur.rowcount)
+            self.assertEquals(5, len(received))
+            #the failed rows are those of the queries, also when a query has multiple results
+            try:
+                cur.executemany("multi %s", [(1,), ('error',), (3,), ('error',)])
+                self.fail("expected error")
+            except dbapi.Error, e:
+                self.assertEquals([1, 3], e.failed_rows)
+            self.assertEquals(8, cur.rowcount)
+            cur.close()
+            cnn.close()
+        finally:
+            dbapi.PIPELINE_SIZE = pipeline_size
+            server.close()
+
+    def testPackExecute(self):
+        statement = client.PreparedStatement("", 1, 4, [])
+        self.assertEquals('\x01\x00\x00\x00' '\x00' '\x01\x00\x00\x00' #id, flags, iteration count
+                          '\x02' '\x01' #null bitmap, types follow
+                          '\x08\x00' '\x06\x00' '\xfd\x00' '\x0a\x00' #types
+                          + struct.pack('<q', -2) + '\x03abc' + struct.pack('<BHBB', 4, 2009, 12, 31), 
+                          statement.pack_execute((-2, None, 'abc', datetime.date(2009, 12, 31))))
+        self.assertRaises(client.ClientProgrammingError, statement.pack_execute, (1, 2))
+        self.assertRaises(client.ClientProgrammingError, statement.pack_execute, (1, 2, 3, object()))
+
+    def testFormatQuery(self):
+        from decimal import Decimal
+        from concurrence.database.mysql import escape_string
+        
+        chars = ''.join([chr(i) for i in range(256)])
+        self.assertEquals(chars.replace('\\', '\\\\').replace('\0', '\\0').replace('\n', '\\n').replace('\r', '\\r')
+                          .replace("'", "\\'").replace('"', '\\"').replace('\x1a', '\\Z'), escape_string(chars))
+        self.assertEquals("select 'pi\\'et', 'C\xe9line', 1, 2, 1.5, 1.25, 1, null, '2009-01-02 03:04:05', '2009-01-02', (1,'a%s')",
+                          dbapi.format_query("select %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s", 
+                                             ("pi'et", u'C\xe9line', 1, 2L, 1.5, Decimal('1.25'), True, None, 
+                                              datetime.datetime(2009, 1, 2, 3, 4, 5), datetime.date(2009, 1, 2), [1, 'a%s']), 
+                                             'latin-1'))
+        #a value that contains %s is not substituted again
+        self.assertEquals("insert into t values ('%s'), ('x')", dbapi.format_query("insert into t values (%s), (%s)", ('%s', 'x')))
+        self.assertRaises(dbapi.ProgrammingError, dbapi.format_query, "select %s", (1, 2))
+        self.assertRaises(dbapi.ProgrammingError, dbapi.format_query, "select %s", (object(),))
+        self.assertRaises(dbapi.ProgrammingError, dbapi.format_query, "select 1 from t where a in %s", ([],))
+        self.assertEquals("select '26:03:04', '-00:00:01', '-26:03:04', '00:00:00'", 
+                          dbapi.format_query("select %s, %s, %s, %s", 
+                                             (datetime.timedelta(days = 1, hours = 2, minutes = 3, seconds = 4), 
+                                              datetime.timedelta(seconds = -1),
+                                              -datetime.timedelta(days = 1, hours = 2, minutes = 3, seconds = 4),
+                                              datetime.timedelta(0))))
+        self.assertEquals("select '1850-01-02 03:04:05', '1850-01-02 03:04:05.000006', '1850-01-02', '03:04:05.000006', '00:00:01.500000'",
+                          dbapi.format_query("select %s, %s, %s, %s, %s", 
+                                             (datetime.datetime(1850, 1, 2, 3, 4, 5), datetime.datetime(1850, 1, 2, 3, 4, 5, 6), 
+                                              datetime.date(1850, 1, 2), datetime.time(3, 4, 5, 6), 
+                                              datetime.timedelta(seconds = 1.5))))
+        self.assertRaises(dbapi.ProgrammingError, dbapi.format_query, "select %s", (float('nan'),))
+        self.assertRaises(dbapi.ProgrammingError, dbapi.format_query, "select %s", (float('-inf'),))
+
+    def testExecuteMany(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER, passwd = DB_PASSWD, db = DB_DB)
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+        
+        cur.executemany("insert into tbltest (test_id, test_string, test_blob) values (%s, %s, '')", [(i, 'test%d' % i) for i in range(1000)])
+        self.assertEquals(1000, cur.rowcount)
+        cur.executemany("update tbltest set test_string = %s where test_id = %s", [('x', 1), ('y', 2), ('z', 1000)])
+        self.assertEquals(2, cur.rowcount)
+        
+        cur.execute("select count(*), min(test_id), max(test_id) from tbltest")
+        self.assertEquals([(1000, 0, 999)], cur.fetchall())
+        cur.execute("select test_string from tbltest where test_id in %s order by test_id", ((1, 2, 3),))
+        self.assertEquals([('x',), ('y',), ('test3',)], cur.fetchall())
+        
+        cur.close()
+        cnn.close()
+        
+    def testBatchInsert(self):
+        qry = "INSERT INTO t (a, b) VALUES (%s, concat(%s, ')')) ON DUPLICATE KEY UPDATE b = VALUES(b)"
+        prefix, values, suffix = dbapi._match_insert(qry)
+        self.assertEquals("INSERT INTO t (a, b) VALUES ", prefix)
+        self.assertEquals("(%s, concat(%s, ')'))", values)
+        self.assertEquals(" ON DUPLICATE KEY UPDATE b = VALUES(b)", suffix)
+        
+        statements = list(dbapi._batch_insert(prefix, values, suffix, [(i, 'x') for i in range(10)], 'latin-1', 130))
+        self.assertEquals(["INSERT INTO t (a, b) VALUES (0, concat('x', ')')),(1, concat('x', ')')) ON DUPLICATE KEY UPDATE b = VALUES(b)"] + 
+                          ["INSERT INTO t (a, b) VALUES (%d, concat('x', ')')),(%d, concat('x', ')')) ON DUPLICATE KEY UPDATE b = VALUES(b)" % (i, i + 1) for i in range(2, 10, 2)],
+                          statements)
+        self.assertTrue(max([len(statement) for statement in statements]) <= 130)
+        
+        self.assertEquals(None, dbapi._match_insert("update t set a = %s"))
+        self.assertEquals(None, dbapi._match_insert("insert into t (a) values (%s) on duplicate key update a = %s"))
         
 if __name__ == '__main__':
     unittest.main(timeout = 60)        